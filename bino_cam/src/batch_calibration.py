@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import time
+import pickle
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import cv2
+from chessboard_detector import findChessboard
+from camera_functions import writeCalibration, writeStereoCalibration
+
+def calibrateFolder(folder, outputFile, patternSize=(8,6), squareSize=1.0, processes=None, cacheFile=None):
+	timings = []
+	images = sorted(glob.glob(os.path.join(folder, "*.png")))
+
+	start = time.time()
+	corners, imageSize = findCornersInImages(images, patternSize, processes, cacheFile or __defaultCacheFile(folder))
+	timings.append(("corner detection", time.time() - start))
+
+	found = [c for c in corners if c is not None]
+	print "Chessboard found in %d of %d images" % (len(found), len(images))
+
+	start = time.time()
+	calibration = __calibrateMono(found, patternSize, squareSize, imageSize)
+	timings.append(("calibrateCamera", time.time() - start))
+
+	start = time.time()
+	writeCalibration(outputFile, imageSize, calibration)
+	timings.append(("write", time.time() - start))
+
+	return timings
+
+def calibrateStereoFolder(folder, outputFile, patternSize=(8,6), squareSize=1.0, processes=None, cacheFile=None):
+	timings = []
+	leftImages = sorted(glob.glob(os.path.join(folder, "left-*.png")))
+	rightImages = [os.path.join(folder, "right-" + os.path.basename(path)[len("left-"):]) for path in leftImages]
+	pairs = [(l, r) for (l, r) in zip(leftImages, rightImages) if os.path.exists(r)]
+
+	start = time.time()
+	paths = [l for (l, r) in pairs] + [r for (l, r) in pairs]
+	corners, imageSize = findCornersInImages(paths, patternSize, processes, cacheFile or __defaultCacheFile(folder))
+	leftCorners = corners[:len(pairs)]
+	rightCorners = corners[len(pairs):]
+	timings.append(("corner detection", time.time() - start))
+
+	# Only pairs where both cameras saw the whole board can be used
+	both = [i for i in range(len(pairs)) if (leftCorners[i] is not None) and (rightCorners[i] is not None)]
+	leftCorners = [leftCorners[i] for i in both]
+	rightCorners = [rightCorners[i] for i in both]
+	print "Chessboard found in %d of %d stereo pairs" % (len(both), len(pairs))
+
+	start = time.time()
+	(leftMatrix, leftDistortion, r, p) = __calibrateMono(leftCorners, patternSize, squareSize, imageSize)
+	(rightMatrix, rightDistortion, r, p) = __calibrateMono(rightCorners, patternSize, squareSize, imageSize)
+	timings.append(("calibrateCamera", time.time() - start))
+
+	start = time.time()
+	objectPoints = [__objectPoints(patternSize, squareSize)] * len(both)
+	result = cv2.stereoCalibrate(objectPoints=objectPoints, imagePoints1=leftCorners, imagePoints2=rightCorners,
+		cameraMatrix1=leftMatrix, distCoeffs1=leftDistortion, cameraMatrix2=rightMatrix, distCoeffs2=rightDistortion,
+		imageSize=imageSize, flags=cv2.CALIB_FIX_INTRINSIC)
+	(R, T) = result[5:7]
+	timings.append(("stereoCalibrate", time.time() - start))
+
+	start = time.time()
+	(R1, R2, P1, P2, Q) = cv2.stereoRectify(leftMatrix, leftDistortion, rightMatrix, rightDistortion, imageSize, R, T, alpha=0)[:5]
+	timings.append(("stereoRectify", time.time() - start))
+
+	start = time.time()
+	writeStereoCalibration(outputFile, imageSize, (leftMatrix, leftDistortion.reshape(-1, 1), R1, P1), (rightMatrix, rightDistortion.reshape(-1, 1), R2, P2))
+	timings.append(("write", time.time() - start))
+
+	return timings
+
+def findCornersInImages(paths, patternSize, processes=None, cacheFile=None):
+	# Corners for every image in paths (None where no board was found) and the image size.
+	# Results are cached by file hash, so only new or changed images are searched again.
+	cache = __loadCache(cacheFile)
+	keys = [(__fileHash(path), patternSize) for path in paths]
+
+	missing = [i for i in range(len(paths)) if keys[i] not in cache]
+	if(len(missing) > 0):
+		pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+		try:
+			results = pool.map(__detectImage, [(paths[i], patternSize) for i in missing])
+		finally:
+			pool.close()
+			pool.join()
+		for (i, result) in zip(missing, results):
+			cache[keys[i]] = result
+		__saveCache(cacheFile, cache)
+
+	print "%d images searched, %d taken from the cache" % (len(missing), len(paths) - len(missing))
+
+	# Calibrate at the resolution most of the images were taken at and leave the rest out
+	results = [cache[key] for key in keys]
+	sizes = [size for (size, corners) in results]
+	imageSize = max(set(sizes), key=sizes.count)
+	skipped = len(sizes) - sizes.count(imageSize)
+	if(skipped > 0):
+		print "Skipping %d images that are not %dx%d" % (skipped, imageSize[0], imageSize[1])
+	return ([corners if size == imageSize else None for (size, corners) in results], imageSize)
+
+#----------------------------------------------------------------------------------#
+
+def __detectImage(args):
+	(path, patternSize) = args
+	gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+	return ((gray.shape[1], gray.shape[0]), findChessboard(gray, patternSize))
+
+def __objectPoints(patternSize, squareSize):
+	# (0,0,0), (1,0,0), (2,0,0) ....,(8,5,0) in units of squareSize
+	objp = np.zeros((patternSize[1]*patternSize[0],3), np.float32)
+	objp[:,:2] = np.mgrid[0:patternSize[0],0:patternSize[1]].T.reshape(-1,2) * squareSize
+	return objp
+
+def __calibrateMono(corners, patternSize, squareSize, imageSize):
+	if(len(corners) == 0):
+		raise ValueError("No chessboards found, nothing to calibrate")
+	objectPoints = [__objectPoints(patternSize, squareSize)] * len(corners)
+	ret, cameraMatrix, distortion, rvecs, tvecs = cv2.calibrateCamera(objectPoints, corners, imageSize, None, None)
+	print "RMS reprojection error %f" % ret
+
+	# Same layout as the ROS calibrator, identity rectification and the alpha 0 camera matrix as projection
+	newCameraMatrix, roi = cv2.getOptimalNewCameraMatrix(cameraMatrix, distortion, imageSize, 0)
+	projection = np.hstack((newCameraMatrix, np.zeros((3, 1))))
+	return (cameraMatrix, distortion.reshape(-1, 1), np.eye(3), projection)
+
+def __fileHash(path):
+	f = open(path, 'rb')
+	digest = hashlib.sha1(f.read()).hexdigest()
+	f.close()
+	return digest
+
+def __defaultCacheFile(folder):
+	return os.path.join(folder, ".corners_cache.pkl")
+
+def __loadCache(cacheFile):
+	if((cacheFile is None) or (not os.path.exists(cacheFile))):
+		return {}
+	f = open(cacheFile, 'rb')
+	try:
+		return pickle.load(f)
+	except Exception:
+		print "Ignoring unreadable corner cache " + cacheFile
+		return {}
+	finally:
+		f.close()
+
+def __saveCache(cacheFile, cache):
+	if(cacheFile is None):
+		return
+	f = open(cacheFile, 'wb')
+	pickle.dump(cache, f, 2)
+	f.close()
+
+def __parsePatternSize(value):
+	(columns, rows) = value.lower().split("x")
+	return (int(columns), int(rows))
+
+####################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Calibrate from a folder of chessboard images without the GUI")
+	parser.add_argument("mode", choices=["mono", "stereo"], help="mono uses every *.png, stereo pairs left-*.png with right-*.png")
+	parser.add_argument("folder")
+	parser.add_argument("-o", "--output", default="ost.txt", help="oST calibration file to write")
+	parser.add_argument("--pattern", default="8x6", help="inner corners of the chessboard, columns x rows, the default is the board in Calibration Data")
+	parser.add_argument("--square", type=float, default=1.0, help="size of a chessboard square")
+	parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, defaults to every core")
+	parser.add_argument("--cache", default=None, help="corner cache file, defaults to .corners_cache.pkl in the folder")
+	args = parser.parse_args()
+
+	if(args.mode == "mono"):
+		calibrate = calibrateFolder
+	else:
+		calibrate = calibrateStereoFolder
+
+	start = time.time()
+	timings = calibrate(args.folder, args.output, __parsePatternSize(args.pattern), args.square, args.jobs, args.cache)
+	for (stage, seconds) in timings:
+		print "%-18s %8.3fs" % (stage, seconds)
+	print "%-18s %8.3fs" % ("total", time.time() - start)
+	print "Calibration written to " + args.output
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import cv2
+import rospy
+import ros_functions
+import camera_functions
+from ros_functions import constructDepthMapImage, encodeStereoFrame, RAW, JPEG, PNG
+from voxel_grid import PointLevels, VoxelMap
+from cloud_archive import CloudRecorder, RecordedClouds
+from camera_functions import sideBySide, redGreen, correctedSideBySide, openSavedStereoCalibration, getCalibrationContext
+from sensor_msgs.msg import PointCloud2, PointField
+from stereo_msgs.msg import DisparityImage
+
+resolutions = {"480p": (854, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+
+stereoCalibrationFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Calibration Data", "Stereo Calibration Data", "ost.txt")
+stereoImageFolder = os.path.dirname(stereoCalibrationFile)
+
+# (name, encoding, pyramid levels) of every transport runTransportSuite compares
+transportModes = [
+	("raw", RAW, 0),
+	("jpeg", JPEG, 0),
+	("png", PNG, 0),
+	("pyramid1", RAW, 1),
+	("pyramid2", RAW, 2),
+	("jpeg+pyramid1", JPEG, 1),
+]
+
+def benchmarkDepthMap(resolution, repeat=3):
+	(width, height) = resolution
+	maxDist, points = __syntheticPointCloud(width, height)
+
+	loopTime = __bestTime(lambda: __loopDepthMapImage(True, maxDist, points), 1)
+	vectorTime = __bestTime(lambda: constructDepthMapImage(True, maxDist, points), repeat)
+
+	return (loopTime, vectorTime)
+
+def runSuite(resolutionNames, inputs=("synthetic", "recorded"), source=stereoImageFolder, iterations=50):
+	# One result dict per stage, resolution and input, see measureStage for the fields
+	openSavedStereoCalibration(stereoCalibrationFile)
+	results = []
+	for name in resolutionNames:
+		resolution = resolutions[name]
+		for kind in inputs:
+			pairs = __inputPairs(kind, source, resolution)
+			for (stage, function, skipped) in __stages(resolution, kind, pairs):
+				if(skipped is not None):
+					results.append({"stage": stage, "resolution": name, "input": kind, "skipped": skipped})
+					continue
+				result = measureStage(function, iterations)
+				result.update({"stage": stage, "resolution": name, "input": kind})
+				results.append(result)
+	return results
+
+def runTransportSuite(resolutionNames, inputs=("synthetic", "recorded"), source=stereoImageFolder, iterations=50, bandwidth=100.0):
+	# Bytes per pair and the time from frames to images on the matcher side for every transport.
+	# Encode and decode are measured, the link is not: estimated_link_ms is bytes over an assumed
+	# bandwidth Mbit/s, and estimated_end_to_end_ms adds it to the median encode and decode.
+	# Random synthetic frames are the worst case for JPEG and PNG, recorded pairs show what they really save.
+	results = []
+	for name in resolutionNames:
+		resolution = resolutions[name]
+		for kind in inputs:
+			pairs = __inputPairs(kind, source, resolution)
+			for (mode, encoding, levels) in transportModes:
+				messages = [__encodePair(pair, encoding, levels) for pair in pairs]
+				bytesPerPair = float(np.mean([len(left.data) + len(right.data) for (left, right) in messages]))
+				encode = measureStage(lambda i: __encodePair(pairs[i % len(pairs)], encoding, levels), iterations)
+				decode = measureStage(lambda i: __decodePair(messages[i % len(messages)]), iterations)
+				linkMs = 1000*8*bytesPerPair/(bandwidth*1e6)
+				
+				result = dict(encode)
+				result.update({
+					"stage": "transport " + mode,
+					"resolution": name,
+					"input": kind,
+					"bytes_per_pair": bytesPerPair,
+					"decode_p50_ms": decode["p50_ms"],
+					"estimated_link_ms": linkMs,
+					"estimated_end_to_end_ms": encode["p50_ms"] + linkMs + decode["p50_ms"],
+				})
+				results.append(result)
+	return results
+
+def runArchiveSuite(resolutionNames, clouds=30, folder=None):
+	# Write throughput of CloudRecorder and the time to reopen an archive and read one cloud back.
+	# The archive is read right after it was written, so reads come from the page cache, not the disk.
+	results = []
+	for name in resolutionNames:
+		(width, height) = resolutions[name]
+		(maxDist, points) = __syntheticPointCloud(width, height)
+		directory = tempfile.mkdtemp(dir=folder)
+		path = os.path.join(directory, "clouds.bin")
+		try:
+			recorder = CloudRecorder(path, maxQueued=clouds)
+			start = time.time()
+			for i in range(clouds):
+				recorder.write((maxDist, points), i)
+			recorder.close()
+			writeTime = time.time() - start
+			stats = recorder.getStats()
+
+			start = time.time()
+			archive = RecordedClouds(path)
+			openTime = time.time() - start
+			# Opening only maps the file, the depth of a cloud is summed to make the pages load
+			read = measureStage(lambda i: np.nansum(archive.cloud(i % len(archive))[1][:, :, 2]), min(clouds, 10), 0)
+			results.append({
+				"stage": "cloud archive",
+				"resolution": name,
+				"input": "synthetic",
+				"clouds": clouds,
+				"dropped": stats["dropped"],
+				"clouds_per_second": clouds/writeTime,
+				"mb_per_second": stats["bytes"]/writeTime/1e6,
+				"open_ms": 1000*openTime,
+				"read_p50_ms": read["p50_ms"],
+			})
+		finally:
+			shutil.rmtree(directory)
+	return results
+
+def measureStage(function, iterations=50, warmup=5):
+	# function is called with the iteration number so it can cycle through its inputs.
+	# output_buffers counts the distinct arrays the warmup calls returned, 1 when a stage reuses its
+	# output buffer and warmup when it allocates one every call, None when it returns no array. The
+	# outputs are held until counted, or an allocating stage would be handed the freed buffer back.
+	# rss_growth_kb is the change of the resident set over the timed calls, not of its peak, so memory
+	# a stage allocates and frees again each call does not show and steady growth does.
+	outputs = [function(i) for i in range(warmup)]
+	buffers = set(output.__array_interface__['data'][0] for output in outputs if isinstance(output, np.ndarray))
+	del outputs
+	rssBefore = __residentKb()
+
+	latencies = np.empty(iterations)
+	start = time.time()
+	for i in range(iterations):
+		callStart = time.time()
+		function(i)
+		latencies[i] = time.time() - callStart
+	elapsed = time.time() - start
+
+	rssAfter = __residentKb()
+	return {
+		"iterations": iterations,
+		"throughput": iterations/elapsed if elapsed > 0 else None,
+		"mean_ms": 1000*float(latencies.mean()),
+		"p50_ms": 1000*float(np.percentile(latencies, 50)),
+		"p90_ms": 1000*float(np.percentile(latencies, 90)),
+		"p99_ms": 1000*float(np.percentile(latencies, 99)),
+		"output_buffers": len(buffers) if buffers else None,
+		"rss_kb": rssAfter,
+		"rss_growth_kb": rssAfter - rssBefore if rssAfter is not None else None,
+	}
+
+def compareResults(baseline, results, tolerance=0.1):
+	# (stage, resolution, input, baseline p50, p50, ratio) for every stage measured in both runs
+	# whose median latency got worse by more than tolerance
+	key = lambda r: (r["stage"], r["resolution"], r["input"])
+	before = dict((key(r), r) for r in baseline if "p50_ms" in r)
+	regressions = []
+	for result in results:
+		old = before.get(key(result))
+		if((old is None) or ("p50_ms" not in result) or (old["p50_ms"] <= 0)):
+			continue
+		ratio = result["p50_ms"] / old["p50_ms"]
+		if(ratio > 1 + tolerance):
+			regressions.append(key(result) + (old["p50_ms"], result["p50_ms"], ratio))
+	return regressions
+
+#----------------------------------------------------------------------------------#
+
+def __stages(resolution, kind, pairs):
+	# (name, function(i), reason it was skipped or None)
+	(width, height) = resolution
+	pair = lambda i: pairs[i % len(pairs)]
+	stages = [
+		("sideBySide", lambda i: sideBySide(pair(i)), None),
+		("redGreen", lambda i: redGreen(width//10, pair(i)), None),
+		("correctedSideBySide", lambda i: correctedSideBySide(pair(i)), None),
+		("__resize", lambda i: getattr(camera_functions, "__resize")(pair(i)[0], getCalibrationContext().calibrationSize), None),
+	]
+
+	# Clouds only exist for synthetic input until the matcher output is recorded as well
+	if(kind != "synthetic"):
+		reason = "no recorded point clouds"
+		return stages + [(stage, None, reason) for stage in ("constructDepthMapImage", "__extractPointCloudData", "__reprojectDisparity", "output_pointcloud path", "disparity path", "PointLevels.build", "VoxelMap.integrate", "CloudPolyData.addPoints")]
+
+	(maxDist, points) = __syntheticPointCloud(width, height)
+	message = __syntheticPointCloudMessage(points)
+	extract = getattr(ros_functions, "__extractPointCloudData")
+	reproject = getattr(ros_functions, "__reprojectDisparity")
+	disparityMessage = __syntheticDisparityMessage(width, height)
+	context = getCalibrationContext()
+	stages += [
+		("constructDepthMapImage", lambda i: constructDepthMapImage(True, maxDist, points), None),
+		# Decoding is lazy, so the depth channel is read to make the view do its work
+		("__extractPointCloudData", lambda i: extract(message)[1][:, :, 2].sum(), None),
+		("__reprojectDisparity", lambda i: reproject(disparityMessage, context), None),
+		# Both ways from the matcher to points in bino_cam, each with the copy its message is serialized with:
+		# 32 bytes a point through getPointCloud, or 4 bytes a pixel of disparity reprojected here
+		("output_pointcloud path", lambda i: extract(__reserialized(message))[1][:, :, 2].sum(), None),
+		("disparity path", lambda i: reproject(__reserialized(disparityMessage), context), None),
+	]
+
+	# Every voxel grid level of detail of a frame's cloud, which addPoints builds
+	levels = PointLevels()
+	finite = points.reshape(-1, 3)
+	finite = finite[np.isfinite(finite).all(axis=1)]
+	stages.append(("PointLevels.build", lambda i: levels.build(finite), None))
+	# Fusing a capture into a map that already holds the scene, as every capture after the first does
+	voxelMap = VoxelMap()
+	voxelMap.integrate(finite)
+	stages.append(("VoxelMap.integrate", lambda i: voxelMap.integrate(finite), None))
+	
+	# What VtkPointCloud does with a frame's cloud, without its window: the levels built on the worker
+	# and the finished ones shown
+	try:
+		from cloud_polydata import CloudPolyData
+		cloud = CloudPolyData()
+		stages.append(("CloudPolyData.addPoints", lambda i: (cloud.clearPoints(), cloud.addPoints(points), cloud.wait(), cloud.update()), None))
+	except ImportError as e:
+		stages.append(("CloudPolyData.addPoints", None, "VTK unavailable: " + str(e)))
+	return stages
+
+def __inputPairs(kind, source, resolution):
+	if(kind == "recorded"):
+		return __recordedPairs(source, resolution)
+	return [(__syntheticFrame(*resolution), __syntheticFrame(*resolution)) for i in range(4)]
+
+def __encodePair(pair, encoding, levels):
+	stamp = rospy.Time(0)
+	return (encodeStereoFrame(pair[0], stamp, encoding, levels), encodeStereoFrame(pair[1], stamp, encoding, levels))
+
+def __decodePair(messages):
+	# What the matcher does before matching: copy raw images out of the message, decode compressed ones
+	for message in messages:
+		if(hasattr(message, "encoding")):
+			np.frombuffer(message.data, dtype=np.uint8).reshape((message.height, message.width, -1)).copy()
+		else:
+			cv2.imdecode(np.frombuffer(message.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def __recordedPairs(source, resolution, count=4):
+	# A few decoded pairs from a recording or PNG folder, scaled to resolution, so file access stays out of the timings
+	from frame_sources import openStereoSource, FAST
+	cams = openStereoSource(source, FAST, loop=True)
+	for cam in cams:
+		cam.set(3, resolution[0])
+		cam.set(4, resolution[1])
+	pairs = []
+	for i in range(count):
+		cams[0].grab()
+		cams[1].grab()
+		pairs.append((cams[0].retrieve()[1], cams[1].retrieve()[1]))
+	return pairs
+
+def __syntheticFrame(width, height):
+	return np.random.randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+def __syntheticPointCloud(width, height, invalidFraction=0.05):
+	points = np.random.uniform(-1, 1, (height, width, 3)).astype(np.float32)
+	points[:, :, 2] = np.random.uniform(0.5, 5, (height, width))
+	invalid = np.random.random_sample((height, width)) < invalidFraction
+	points[invalid] = np.nan
+	return (float(np.nanmax(points[:, :, 2])), points)
+
+def __syntheticPointCloudMessage(points):
+	# Laid out like getPointCloud publishes it: unorganised PointXYZRGB, 32 bytes a point, column by column
+	(height, width) = points.shape[:2]
+	dtype = np.dtype({'names': ['x', 'y', 'z', 'rgb'], 'formats': ['<f4', '<f4', '<f4', '<f4'], 'offsets': [0, 4, 8, 16], 'itemsize': 32})
+	cloud = np.zeros(width*height, dtype=dtype)
+	columns = np.swapaxes(points, 0, 1).reshape(-1, 3)
+	for (i, name) in enumerate(('x', 'y', 'z')):
+		cloud[name] = columns[:, i]
+
+	message = PointCloud2()
+	message.height = 1
+	message.width = width*height
+	message.fields = [PointField(name, offset, PointField.FLOAT32, 1) for (name, offset) in (('x', 0), ('y', 4), ('z', 8), ('rgb', 16))]
+	message.is_bigendian = False
+	message.point_step = 32
+	message.row_step = 32*width*height
+	message.data = cloud.tostring()
+	message.is_dense = False
+	return message
+
+def __syntheticDisparityMessage(width, height, invalidFraction=0.05):
+	# 32FC1 horizontal disparity as the matcher publishes it, offsets to the right image are negative
+	disparity = np.random.uniform(-120, -5, (height, width)).astype(np.float32)
+	disparity[np.random.random_sample((height, width)) < invalidFraction] = np.nan
+	message = DisparityImage()
+	message.image.height = height
+	message.image.width = width
+	message.image.encoding = "32FC1"
+	message.image.is_bigendian = 0
+	message.image.step = 4*width
+	message.image.data = disparity.tostring()
+	return message
+
+def __reserialized(message):
+	data = message.image.data if hasattr(message, "image") else message.data
+	copy = np.frombuffer(data, dtype=np.uint8).tostring()
+	if(hasattr(message, "image")):
+		message.image.data = copy
+	else:
+		message.data = copy
+	return message
+
+def __residentKb():
+	# Current resident set from /proc, ru_maxrss only ever grows and hides memory given back
+	try:
+		f = open("/proc/self/statm")
+		resident = int(f.read().split()[1])
+		f.close()
+	except (IOError, IndexError, ValueError):
+		return None
+	return resident*os.sysconf("SC_PAGE_SIZE")//1024
+
+def __bestTime(function, repeat):
+	return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def __loopDepthMapImage(hotNear, maxDist, points):
+	# The original per point implementation of constructDepthMapImage, kept as a baseline
+	z = 2
+	newPoints = []
+	shape = (points.shape[0], points.shape[1], 3)
+
+	for i in range(points.shape[0]):
+		for j in range(points.shape[1]):
+			zPoint = points[i][j][z]
+			if(hotNear):
+				value = (1 - (zPoint/maxDist)) * 255
+			else:
+				value = (zPoint/maxDist) * 255
+			if(not np.isfinite(value)):
+				value = 0
+			newPoints.append((0, int(value), 0))
+
+	image = np.array(newPoints, dtype=np.uint8)
+	image = np.reshape(image, shape)
+	return image
+
+def __gitRevision():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+	except Exception:
+		return None
+
+####################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Time the image and point cloud stages of bino_cam")
+	parser.add_argument("resolutions", nargs="*", default=["480p", "720p", "1080p"], choices=sorted(resolutions.keys()))
+	parser.add_argument("--input", choices=["synthetic", "recorded", "both"], default="both")
+	parser.add_argument("--source", default=stereoImageFolder, help="recording or folder of PNG pairs for recorded input")
+	parser.add_argument("--iterations", type=int, default=50)
+	parser.add_argument("--json", default=None, help="write the results to this file")
+	parser.add_argument("--compare", default=None, help="results of an earlier run, stages that got slower are listed")
+	parser.add_argument("--legacy", action="store_true", help="also compare constructDepthMapImage with the old per point loop")
+	parser.add_argument("--transport", action="store_true", help="also measure bytes per pair and latency of every transport to the matcher")
+	parser.add_argument("--bandwidth", type=float, default=100.0, help="assumed link speed in Mbit/s, the transport suite's link and end to end times are estimates from it")
+	parser.add_argument("--archive", action="store_true", help="also measure writing point clouds to an archive and reading them back")
+	parser.add_argument("--archive-folder", default=None, help="where the archive is written, by default the temporary folder")
+	args = parser.parse_args()
+
+	inputs = ("synthetic", "recorded") if args.input == "both" else (args.input,)
+	results = runSuite(args.resolutions, inputs, args.source, args.iterations)
+	if(args.transport):
+		results += runTransportSuite(args.resolutions, inputs, args.source, args.iterations, args.bandwidth)
+	if(args.archive):
+		results += runArchiveSuite(args.resolutions, folder=args.archive_folder)
+
+	for result in results:
+		if("skipped" in result):
+			print "%-26s %-6s %-10s skipped, %s" % (result["stage"], result["resolution"], result["input"], result["skipped"])
+		elif("bytes_per_pair" in result):
+			print "%-26s %-6s %-10s %9.0fkB/pair  encode %7.2fms  decode %7.2fms  link ~%6.2fms  end to end ~%6.2fms (estimated at %gMbit/s)" % (result["stage"], result["resolution"], result["input"],
+				result["bytes_per_pair"]/1024, result["p50_ms"], result["decode_p50_ms"], result["estimated_link_ms"], result["estimated_end_to_end_ms"], args.bandwidth)
+		elif("mb_per_second" in result):
+			print "%-26s %-6s %-10s %6.1f clouds/s  %7.1fMB/s written, %d dropped  open %7.2fms  read %7.2fms" % (result["stage"], result["resolution"], result["input"],
+				result["clouds_per_second"], result["mb_per_second"], result["dropped"], result["open_ms"], result["read_p50_ms"])
+		else:
+			line = "%-26s %-6s %-10s %8.1f/s  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms" % (result["stage"], result["resolution"], result["input"],
+				result["throughput"], result["p50_ms"], result["p90_ms"], result["p99_ms"])
+			if(result["rss_kb"] is not None):
+				line += "  RSS %dkB (%+dkB)" % (result["rss_kb"], result["rss_growth_kb"])
+			if(result["output_buffers"] is not None):
+				line += "  %d output buffers" % result["output_buffers"]
+			print line
+
+	if(args.legacy):
+		for name in args.resolutions:
+			(loopTime, vectorTime) = benchmarkDepthMap(resolutions[name])
+			print "constructDepthMapImage %s: loop %.3fs, vectorized %.4fs, speedup x%.0f" % (name, loopTime, vectorTime, loopTime/vectorTime)
+
+	if(args.json is not None):
+		f = open(args.json, 'w')
+		json.dump({"revision": __gitRevision(), "time": time.time(), "results": results}, f, indent=1)
+		f.close()
+
+	if(args.compare is not None):
+		f = open(args.compare)
+		baseline = json.load(f)
+		f.close()
+		regressions = compareResults(baseline["results"], results)
+		for (stage, resolution, kind, before, after, ratio) in regressions:
+			print "Slower: %s %s %s p50 %.2fms -> %.2fms (x%.2f)" % (stage, resolution, kind, before, after, ratio)
+		if(len(regressions) > 0):
+			sys.exit(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import threading
+import weakref
+import numpy as np
+
+class CalibrationContext(object):
+	# Immutable snapshot of the camera and calibration state. Every change produces a new
+	# context with a higher version, so a context can be handed to threads, worker processes
+	# and ROS callbacks without locking. Anything derived from it (remap tables, CameraInfo
+	# messages, ...) can be cached on the context with derived().
+
+	def __init__(self, version, cameraSize, calibrationSize, left=None, right=None):
+		self.__version = version
+		self.__cameraSize = tuple(int(v) for v in cameraSize)
+		self.__calibrationSize = tuple(int(v) for v in calibrationSize)
+		self.__left = self.__freeze(left)
+		self.__right = self.__freeze(right)
+		self.__derived = {}
+		self.__derivedLock = threading.Lock()
+
+	version = property(lambda self: self.__version)
+	cameraSize = property(lambda self: self.__cameraSize)
+	calibrationSize = property(lambda self: self.__calibrationSize)
+	left = property(lambda self: self.__left)
+	right = property(lambda self: self.__right)
+
+	def calibration(self, camNo):
+		if(camNo == 0):
+			return self.__left
+		return self.__right
+
+	def replace(self, version, cameraSize=None, calibrationSize=None, left=False, right=False):
+		# Copy of this context with some fields changed, False leaves a calibration as it is
+		return CalibrationContext(version,
+			cameraSize or self.__cameraSize,
+			calibrationSize or self.__calibrationSize,
+			self.__left if left is False else left,
+			self.__right if right is False else right)
+
+	def derived(self, key, factory):
+		with self.__derivedLock:
+			if(key in self.__derived):
+				return (True, self.__derived[key])
+		value = factory()
+		with self.__derivedLock:
+			return (False, self.__derived.setdefault(key, value))
+
+	def __freeze(self, calibration):
+		# (ret, cameraMatrix, distortion, rectification, projection) with private read only arrays
+		if(calibration is None):
+			return None
+		(ret, cameraMatrix, distortion, rectification, projection) = calibration
+		arrays = []
+		for array in (cameraMatrix, np.reshape(distortion, (-1, 1)), rectification, projection):
+			array = np.array(array, dtype=np.float64)
+			array.setflags(write=False)
+			arrays.append(array)
+		return tuple([ret] + arrays)
+
+	def __getstate__(self):
+		# Derived data stays in the process that built it
+		return (self.__version, self.__cameraSize, self.__calibrationSize, self.__left, self.__right)
+
+	def __setstate__(self, state):
+		(self.__version, self.__cameraSize, self.__calibrationSize, left, right) = state
+		self.__left = self.__freeze(left)
+		self.__right = self.__freeze(right)
+		self.__derived = {}
+		self.__derivedLock = threading.Lock()
+
+class CalibrationRegistry(object):
+	# Holds the current context, older versions stay reachable for as long as someone still uses them
+
+	def __init__(self, cameraSize, calibrationSize=None):
+		self.__lock = threading.Lock()
+		self.__current = CalibrationContext(0, cameraSize, calibrationSize or cameraSize)
+		self.__contexts = weakref.WeakValueDictionary({0: self.__current})
+
+	def current(self):
+		return self.__current
+
+	def get(self, version):
+		return self.__contexts.get(version)
+
+	def update(self, **changes):
+		with self.__lock:
+			context = self.__current.replace(self.__current.version + 1, **changes)
+			self.__contexts[context.version] = context
+			self.__current = context
+			return context
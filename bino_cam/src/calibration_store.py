@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import xml.etree.ElementTree as ElementTree
+
+# Every loader returns a list with one (width, height, cameraMatrix, distortion, rectification, projection)
+# tuple per camera in the file, so a stereo file gives [left, right].
+# Results are shared between callers and must not be modified.
+
+__loaded = {}
+
+__ostKeys = {
+	"width": None,
+	"height": None,
+	"camera matrix": (3, 3),
+	"distortion": None,
+	"rectification": (3, 3),
+	"projection": (3, 4),
+}
+
+def loadCalibration(filename):
+	# Parsed once per file version, later calls only cost an os.stat
+	path = os.path.abspath(filename)
+	stat = os.stat(path)
+	version = (stat.st_mtime, stat.st_size)
+
+	cached = __loaded.get(path)
+	if((cached is not None) and (cached[0] == version)):
+		return cached[1]
+
+	extension = os.path.splitext(path)[1].lower()
+	if(extension == ".npz"):
+		cameras = __loadNpz(path)
+	elif(extension == ".xml"):
+		cameras = __loadOpenCVXml(path)
+	else:
+		cameras = __loadOst(path)
+
+	__loaded[path] = (version, cameras)
+	return cameras
+
+def saveCompiledCalibration(filename, cameras):
+	# Binary form of a calibration, loading it skips text parsing altogether
+	arrays = {"cameras": np.array(len(cameras))}
+	for (i, (width, height, cameraMatrix, distortion, rectification, projection)) in enumerate(cameras):
+		arrays["%d_size" % i] = np.array((width, height))
+		arrays["%d_cameraMatrix" % i] = cameraMatrix
+		arrays["%d_distortion" % i] = distortion
+		arrays["%d_rectification" % i] = rectification
+		arrays["%d_projection" % i] = projection
+	np.savez(filename, **arrays)
+
+def clearCalibrationCache():
+	__loaded.clear()
+
+#----------------------------------------------------------------------------------#
+
+def __loadOst(path):
+	f = open(path, 'rt')
+	try:
+		text = f.read()
+	finally:
+		f.close()
+
+	cameras = []
+	current = {}
+	tokens = []
+	for line in text.splitlines():
+		line = line.split("#", 1)[0].strip()
+		if((len(line) == 0) or line.startswith("[")):
+			continue
+		tokens.append(line.lower())
+
+	# One pass over the lines, a key repeating means the next camera of a stereo file has started
+	i = 0
+	while(i < len(tokens)):
+		key = tokens[i]
+		i += 1
+		if(key not in __ostKeys):
+			continue
+
+		values = []
+		while(i < len(tokens) and __isNumberLine(tokens[i])):
+			values.extend(tokens[i].split())
+			i += 1
+
+		if(key in current):
+			cameras.append(current)
+			current = {}
+		current[key] = values
+
+	cameras.append(current)
+	return [__ostCamera(camera) for camera in cameras if __isComplete(camera)]
+
+def __isNumberLine(line):
+	try:
+		float(line.split()[0])
+		return True
+	except ValueError:
+		return False
+
+def __isComplete(camera):
+	return all(key in camera for key in __ostKeys)
+
+def __ostCamera(camera):
+	def matrix(key):
+		array = np.array(camera[key], dtype=np.float64)
+		shape = __ostKeys[key] or (array.size, 1)
+		return array.reshape(shape)
+
+	return (int(camera["width"][0]), int(camera["height"][0]), matrix("camera matrix"), matrix("distortion"), matrix("rectification"), matrix("projection"))
+
+def __loadOpenCVXml(path):
+	# The opencv_storage files in ug_stereomatcher/calibrations, they carry no rectification
+	root = ElementTree.parse(path).getroot()
+
+	def matrix(name):
+		node = root.find(name)
+		if(node is None):
+			return None
+		rows = int(node.find("rows").text)
+		cols = int(node.find("cols").text)
+		return np.array(node.find("data").text.split(), dtype=np.float64).reshape((rows, cols))
+
+	width = int(root.find("width").text)
+	height = int(root.find("height").text)
+	cameraMatrix = matrix("K")
+	distortion = matrix("D").reshape(-1, 1)
+	rectification = matrix("R")
+	if(rectification is None):
+		rectification = np.eye(3)
+	projection = matrix("P")
+	return [(width, height, cameraMatrix, distortion, rectification, projection)]
+
+def __loadNpz(path):
+	data = np.load(path)
+	cameras = []
+	for i in range(int(data["cameras"])):
+		(width, height) = data["%d_size" % i]
+		cameras.append((int(width), int(height), data["%d_cameraMatrix" % i], data["%d_distortion" % i], data["%d_rectification" % i], data["%d_projection" % i]))
+	data.close()
+	return cameras
+
+####################################################################################
+
+if __name__ == '__main__':
+	import sys
+	if(len(sys.argv) != 3):
+		print "Usage: calibration_store.py <calibration.txt|.ini|.xml> <compiled.npz>"
+		sys.exit(1)
+	saveCompiledCalibration(sys.argv[2], loadCalibration(sys.argv[1]))
@@ -3,18 +3,24 @@
 import os
 import numpy as np
 import cv2
-import shlex
+from calibration_store import loadCalibration
+from calibration_context import CalibrationRegistry
 import sys
 
-__width = 1280/2 
-__height = 720
+# Camera resolution and calibrations live in immutable, versioned contexts, see calibration_context
+__registry = CalibrationRegistry((1280/2, 720))
 
-__calibrationWidth = __width
-__calibrationHeight = __height
-__leftCalibration = None
-__rightCalibration = None
+# Reusable output images for the composite views, see __getCanvas
+__canvases = {}
+
+# Undistortion maps for correctedSideBySide are cached on the context they were built from
+__rectificationCacheHits = 0
+__rectificationCacheMisses = 0
 
 def getFrames(cams):
+	if(hasattr(cams, "getLatestPair")):
+		# Threaded StereoCapture, hand back the newest pair grabbed together
+		return cams.getLatestPair()
 	return (getFrame(cams[0]), getFrame(cams[1]))
 
 def getFrame(cam):
@@ -24,23 +30,31 @@ def getFrame(cam):
 	except:
 		return None
 
+def getCalibrationContext(version=None):
+	if(version is None):
+		return __registry.current()
+	return __registry.get(version)
+
 def getHeight():
-	return __height
+	return __registry.current().cameraSize[1]
 	
 def getWidth():
-	return __width
+	return __registry.current().cameraSize[0]
 
 def getCalibrationHeight():
-	return __calibrationHeight
+	return __registry.current().calibrationSize[1]
 	
 def getCalibrationWidth():
-	return __calibrationWidth
+	return __registry.current().calibrationSize[0]
 
 def getLeftCalibration():
-	return __leftCalibration
+	return __registry.current().left
 
 def getRightCalibration():
-	return __rightCalibration
+	return __registry.current().right
+
+def getRectificationCacheStats():
+	return (__rectificationCacheHits, __rectificationCacheMisses)
 		
 def disableAutoFocus():
 	## If that doesn't work try, sudo apt-get install v4l-utils
@@ -64,11 +78,9 @@ def __cameraValid(cam):
 	return (cam is not None) and cam.isOpened()
 
 def __setCameraResolution(cam, w, h):
-	global __width, __height 
 	cam.set(3, w)
 	cam.set(4, h)
-	__width = int(cam.get(3))
-	__height = int(cam.get(4))
+	__registry.update(cameraSize=(cam.get(3), cam.get(4)))
 
 ####################################################################################
 
@@ -79,11 +91,13 @@ def setCameraResolutions16x9(cams, h):
 	if(__cameraValid(cams[1])):
 		__setCameraResolution(cams[1], w, h)
 
-def sideBySide(frames):
-	image = None
-	imagePart1 = returnValidImage(frames[0], (__width, __height) )
-	imagePart2 = returnValidImage(frames[1], (__width, __height) )
-	image = np.hstack((imagePart1, imagePart2))
+def sideBySide(frames, rgb=False):
+	# With rgb the channels are swapped while copying, so the GUI needs no extra conversion pass
+	(leftWidth, height) = __frameSize(frames[0])
+	(rightWidth, rightHeight) = __frameSize(frames[1])
+	image = __getCanvas("sideBySide", (height, leftWidth + rightWidth, 3))
+	__blit(image[:, :leftWidth], frames[0], rgb)
+	__blit(image[:, leftWidth:], frames[1], rgb)
 	return image
 
 def returnValidImage(image, resolution):
@@ -93,65 +107,104 @@ def returnValidImage(image, resolution):
 		blank_image = np.zeros((resolution[1], resolution[0], 3), np.uint8)
 		return blank_image
 
-def redGreen(distance, frames):
-	image = None
-	imagePart1 = __getRedImage(frames[0])
-	imagePart2 = __getGreenBlueImage(frames[1])
-	image = __combineImages(distance, imagePart1, imagePart2)
+def redGreen(distance, frames, rgb=False):
+	(width, height) = __frameSize(frames[0])
+	image = __getCanvas("redGreen", (height, width + distance, 3))
+	
+	# Red channel from the left camera, green and blue from the right, offset by distance
+	(red, greenBlue) = (0, slice(1, 3)) if rgb else (2, slice(0, 2))
+	__blit(image[:, :width, red], None if frames[0] is None else frames[0][:, :, 2])	#(B, G, R)
+	image[:, width:, red] = 0
+	__blit(image[:, distance:, greenBlue], None if frames[1] is None else frames[1][:, :, :2], rgb)
+	image[:, :distance, greenBlue] = 0
 	return image
 	
 #----------------------------------------------------------------------------------#
 
-def __getRedImage(image=None): 
-	red = np.zeros((__height, __width, 3), np.uint8)
-	if image is not None:
-		red[:,:,2] = image[:,:,2]	#(B, G, R)
-	return red
-	
-def __getGreenBlueImage(image=None): 
-	greenBlue = np.zeros((__height, __width, 3), np.uint8)
-	if image is not None:
-		greenBlue[:,:,:2] = image[:,:,:2]	# (B, G, R)
-	return  greenBlue
-
-def __combineImages(distance, image1, image2):
-	width = image1.shape[1]
-	height = image1.shape[0]
-	totalWidth = width + distance
-	image = np.zeros((height, totalWidth, 3), np.uint8)
-	image[:, :width, 2] = image1[:, :, 2]
-	image[:, distance:, :2] = image2[:, :, :2]
-	return image
+def __frameSize(image):
+	if image is None:
+		return __registry.current().cameraSize
+	return (image.shape[1], image.shape[0])
+
+def __getCanvas(view, shape):
+	# One output image per view, reused every frame until the resolution changes.
+	# Callers get the same array back each time, so copy it to keep a frame.
+	canvas = __canvases.get(view)
+	if((canvas is None) or (canvas.shape != shape)):
+		canvas = np.zeros(shape, np.uint8)
+		__canvases[view] = canvas
+	return canvas
+
+def __blit(region, image, reverseChannels=False):
+	# Copy image into the top left of region and black out the rest of it,
+	# reverseChannels turns BGR into RGB on the way
+	if image is None:
+		region[...] = 0
+		return
+	if(reverseChannels):
+		image = image[:, :, ::-1]
+	height = min(image.shape[0], region.shape[0])
+	width = min(image.shape[1], region.shape[1])
+	region[:height, :width] = image[:height, :width]
+	region[height:] = 0
+	region[:height, width:] = 0
 	
 ####################################################################################
 
-def correctedSideBySide(frames):
-	image = None
-	imagePart1 = __returnCorrectedImage(__leftCalibration, frames[0])
-	imagePart2 = __returnCorrectedImage(__rightCalibration, frames[1])
-	image = __combineDifferentResolutionImages(imagePart1, imagePart2)
+def correctedSideBySide(frames, context=None, rgb=False):
+	if(context is None):
+		context = __registry.current()
+	imagePart1 = __returnCorrectedImage(context, 0, frames[0])
+	imagePart2 = __returnCorrectedImage(context, 1, frames[1])
+	image = __combineDifferentResolutionImages(imagePart1, imagePart2, rgb)
 	return image
 	
 #----------------------------------------------------------------------------------#
 
-def __returnCorrectedImage(settings=None, image=None):
+def __returnCorrectedImage(context, camNo, image=None):
+	settings = context.calibration(camNo)
 	if((settings is None) or (image is None)):
-		return returnValidImage(None, (__calibrationWidth, __calibrationHeight))
+		return returnValidImage(None, context.calibrationSize)
+	
+	image = __resize(image, context.calibrationSize, "resize%d" % camNo)
 	
-	ret, mtx, dist, rvecs, tvecs = settings
+	(map1, map2, corrected) = __getRectification(context, camNo, image.shape)
 	
-	image = __resize(image, (__calibrationWidth, __calibrationHeight))
+	# The maps are already cropped to the region of interest
+	image = cv2.remap(image, map1, map2, cv2.INTER_LINEAR, corrected)
 	
-	newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (__calibrationWidth, __calibrationHeight), 1, (__calibrationWidth, __calibrationHeight))
+	return returnValidImage(image, context.calibrationSize)
+
+def __getRectification(context, camNo, imageShape):
+	global __rectificationCacheHits, __rectificationCacheMisses
+	
+	(cached, rectification) = context.derived(("rectification", camNo, imageShape), lambda: __buildRectification(context, camNo, imageShape))
+	if(cached):
+		__rectificationCacheHits += 1
+	else:
+		__rectificationCacheMisses += 1
+	return rectification
+
+def __buildRectification(context, camNo, imageShape):
+	ret, mtx, dist, rectification, projection = context.calibration(camNo)
+	calibrationSize = context.calibrationSize
+	
+	newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, calibrationSize, 1, calibrationSize)
 	
-	image = cv2.undistort(image, mtx, dist, None, newcameramtx)
+	# Fixed point maps, the same representation cv2.undistort builds internally on every call
+	map1, map2 = cv2.initUndistortRectifyMap(mtx, dist, None, newcameramtx, (imageShape[1], imageShape[0]), cv2.CV_16SC2)
 	
 	x,y,w,h = roi
-	image = image[y:y+h, x:x+w]
+	if((w > 0) and (h > 0)):
+		map1 = np.ascontiguousarray(map1[y:y+h, x:x+w])
+		map2 = np.ascontiguousarray(map2[y:y+h, x:x+w])
 	
-	return returnValidImage(image, (__calibrationWidth, __calibrationHeight))
+	# Output buffer remap writes every frame into
+	corrected = np.zeros(map1.shape[:2] + imageShape[2:], np.uint8)
+	
+	return (map1, map2, corrected)
 
-def __resize(image, target):
+def __resize(image, target, view="resize"):
 	width = image.shape[1]
 	height = image.shape[0]
 	invfx = width/target[0]
@@ -164,303 +217,108 @@ def __resize(image, target):
 	
 	fx = 1.0/float(invfx)
 	fy = 1.0/float(invfy)
+	if((fx == 1) and (fy == 1)):
+		return image
 	
-	return cv2.resize(image, (0, 0), fx=fx, fy=fy) 
-
-def __combineDifferentResolutionImages(image1, image2):
-	widthDifference = image1.shape[1] - image2.shape[1]
-	heightDifference = image1.shape[0] - image2.shape[0]
-	black  = np.array([0], dtype=np.uint8)
-	
-	if(widthDifference != 0):
-		if (widthDifference < 0):
-			width = abs(widthDifference)
-			height = image1.shape[0]
-			bufferArray = np.repeat( black, (width*height*3))
-			bufferArray = bufferArray.reshape((height, width, 3))
-			image1 = np.hstack((bufferArray, image1))
-		else:
-			width = abs(widthDifference)
-			height = image2.shape[0]
-			bufferArray = np.repeat( black, (width*height*3))
-			bufferArray = bufferArray.reshape((height, width, 3))
-			image2 = np.hstack((image2, bufferArray))
-	
-	if(heightDifference != 0):
-		if(heightDifference < 0):
-			width = image1.shape[1]
-			height = abs(heightDifference)
-			black  = np.array([0], dtype=np.uint8)
-			bufferArray = np.repeat( black, (width*height*3))
-			bufferArray = bufferArray.reshape((height, width, 3))
-			image1 = np.vstack((image1, bufferArray))
-		else:
-			width = image2.shape[1]
-			height = abs(heightDifference)
-			bufferArray = np.repeat( black, (width*height*3))
-			bufferArray = bufferArray.reshape((height, width, 3))
-			image2 = np.vstack((image2, bufferArray))
-	
-	return np.hstack((image1, image2))
+	# Into a canvas like the composite views, remap only reads it before the next frame comes
+	size = (int(round(width*fx)), int(round(height*fy)))
+	resized = __getCanvas(view, (size[1], size[0]) + image.shape[2:])
+	return cv2.resize(image, size, resized, interpolation=cv2.INTER_LINEAR)
+
+def __combineDifferentResolutionImages(image1, image2, rgb=False):
+	# Both halves are padded to the larger image, image1 on its left and both at the bottom
+	width = max(image1.shape[1], image2.shape[1])
+	height = max(image1.shape[0], image2.shape[0])
+	padding = width - image1.shape[1]
+	
+	image = __getCanvas("correctedSideBySide", (height, 2*width, 3))
+	image[:, :padding] = 0
+	__blit(image[:, padding:width], image1, rgb)
+	__blit(image[:, width:], image2, rgb)
+	return image
 	
 ####################################################################################
 
 def calibrateLeft(objpoints, imgpoints):
-	global __leftCalibration
-	__leftCalibration = __calibrate(objpoints, imgpoints)
+	return __registry.update(left=__calibrate(objpoints, imgpoints), calibrationSize=__registry.current().cameraSize)
 	
 #----------------------------------------------------------------------------------#
 
 def __calibrate(objpoints, imgpoints):
-	__setCalibrationResolution(__width, __height)
-	return cv2.calibrateCamera(objpoints, imgpoints, (__width, __height), None, None)
-
-def __setCalibrationResolution(width, height):
-	global __calibrationWidth, __calibrationHeight
+	size = __registry.current().cameraSize
+	ret, cameraMatrix, distortion, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, size, None, None)
 	
-	__calibrationWidth = width
-	__calibrationHeight = height
+	# Stored like a loaded calibration, identity rectification and the camera matrix as projection
+	projection = np.hstack((cameraMatrix, np.zeros((3, 1))))
+	return (ret, cameraMatrix, distortion, np.eye(3), projection)
 
 ####################################################################################
 
 def calibrateRight(objpoints, imgpoints):
-	global __rightCalibration
-	__rightCalibration = __calibrate(objpoints, imgpoints)
+	return __registry.update(right=__calibrate(objpoints, imgpoints), calibrationSize=__registry.current().cameraSize)
 	
 def openSavedCalibration(filename, camNo):
-	global __leftCalibration, __rightCalibration
 	
 	left = (camNo==0)
 	
-	(width, height, cameraMatrix, distortion, rectification, projection) = __parseSingleCalibrationOstFile(filename)
-	
-	if((width is None) or (height  is None) or (cameraMatrix is None) or (distortion is None) or (rectification is None) or (projection is None)):
+	cameras = loadCalibration(filename)
+	if(len(cameras) == 0):
 		return
 	
-	__setCalibrationResolution(width, height)
+	(width, height, cameraMatrix, distortion, rectification, projection) = cameras[0]
+	calibration = (1, cameraMatrix, distortion, rectification, projection)
 	
 	if(left):
-		__leftCalibration = (1, cameraMatrix, distortion, rectification, projection)
+		return __registry.update(left=calibration, calibrationSize=(width, height))
 	else:
-		__rightCalibration = (1, cameraMatrix, distortion, rectification, projection)
-
-#----------------------------------------------------------------------------------#
-
-def __parseSingleCalibrationOstFile(filename):
-	calibrationFile = file(filename, 'rt')
-	lexer = shlex.shlex(calibrationFile)
-	lexer.wordchars += ".-"
-	
-	width = None
-	height = None
-	cameraMatrix = None
-	distortion = None
-	rectification = None
-	projection = None
-	
-	token = None
-	while token != lexer.eof:
-		token = lexer.get_token()
-		
-		__w = __widthParser(token, lexer)
-		if(__w is not None):
-			width = __w
-		
-		__h = __heightParser(token, lexer)
-		if(__h is not None):
-			height = __h
-		
-		__cam = __cameraMatrix(token, lexer)
-		if(__cam is not None):
-			cameraMatrix = __cam
-		
-		__dist = __distortion(token, lexer)
-		if(__dist is not None):
-			distortion = __dist
-		
-		__rect = __rectification(token, lexer)
-		if(__rect is not None):
-			rectification = __rect
-		
-		__proj = __projection(token, lexer)
-		if(__proj is not None):
-			projection = __proj
-	
-	return (width, height, cameraMatrix, distortion, rectification, projection)
-
-def __widthParser(token, lexer):
-	if(token.lower() != "width"):
-		return
-	
-	nextToken = lexer.get_token()
-	return int(nextToken)
-
-def __heightParser(token, lexer):
-	if(token.lower() != "height"):
-		return
-	
-	nextToken = lexer.get_token()
-	return int(nextToken)
-
-def __cameraMatrix(token, lexer):
-	if(token.lower() != "camera"):
-		return
-	
-	nextToken = lexer.get_token()
-	if(nextToken.lower() != "matrix"):
-		lexer.push_token(nextToken)
-		return
-		
-	return __createFloatArrayFromTokens(lexer, (3,3))
-
-def __distortion(token, lexer):
-	if(token.lower() != "distortion"):
-		return
-	
-	return __createFloatArrayFromTokens(lexer, (5,1))
-
-def __rectification(token, lexer):
-	if(token.lower() != "rectification"):
-		return
-	
-	return __createFloatArrayFromTokens(lexer, (3,3))
-
-def __projection(token, lexer):
-	if(token.lower() != "projection"):
-		return
-	
-	return __createFloatArrayFromTokens(lexer, (3,4))
-
-def __createFloatArrayFromTokens(lexer, shape):
-	numberOfElements = shape[0]*shape[1]
-	
-	matrixString = ""
-	for i in range(numberOfElements-1):
-		matrixString += lexer.get_token() + " "
-	
-	matrixString += lexer.get_token()
-	
-	array = np.fromstring(matrixString, dtype=np.float64, sep=" ")
-	array = array.reshape(shape)
-	
-	return array
+		return __registry.update(right=calibration, calibrationSize=(width, height))
 
 ####################################################################################
 
 def openSavedStereoCalibration(filename):
-	global __leftCalibration, __rightCalibration
 	
-	(width, height, leftCalibration, rightCalibration) = __parseStereoCalibrationOstFile(filename)
-	 
-	if((width is None) or (height  is None) or (leftCalibration is None) or (rightCalibration  is None)):
+	cameras = loadCalibration(filename)
+	if(len(cameras) < 2):
 		return
 	
-	(cameraMatrix, distortion, rectification, projection) = leftCalibration
-	(rCameraMatrix, rDistortion, rRectification, rProjection) = rightCalibration
-	
-	__setCalibrationResolution(width, height)
-	
-	__leftCalibration = (1, cameraMatrix, distortion, rectification, projection)
-	__rightCalibration = (1, rCameraMatrix, rDistortion, rRectification, rProjection)
-
-#----------------------------------------------------------------------------------#
-
-def __parseStereoCalibrationOstFile(filename):
-	calibrationFile = file(filename, 'rt')
-	lexer = shlex.shlex(calibrationFile)
-	lexer.wordchars += ".-"
-	
-	width = None
-	height = None
-	cameraMatrix = None
-	distortion = None
-	rectification = None
-	projection = None
-	
-	rWidth = None
-	rHeight = None
-	rCameraMatrix = None
-	rDistortion = None
-	rRectification = None
-	rProjection = None
-	
-	token = None
-	while token != lexer.eof:
-		token = lexer.get_token()
-		
-		__w = __widthParser(token, lexer)
-		if(__w is not None):
-			if(width is None):
-				width = __w
-			elif(rWidth is None):
-				rWidth = __w
-		
-		__h = __heightParser(token, lexer)
-		if(__h is not None):
-			if(height is None):
-				height = __h
-			elif(rHeight is None):
-				rHeight = __h
-		
-		__cam = __cameraMatrix(token, lexer)
-		if(__cam is not None):
-			if(cameraMatrix is None):
-				cameraMatrix = __cam
-			elif(rCameraMatrix is None):
-				rCameraMatrix = __cam
-		
-		__dist = __distortion(token, lexer)
-		if(__dist is not None):
-			if(distortion is None):
-				distortion = __dist
-			elif(rDistortion is None):
-				rDistortion = __dist
-		
-		__rect = __rectification(token, lexer)
-		if(__rect is not None):
-			if(rectification is None):
-				rectification = __rect
-			elif(rRectification is None):
-				rRectification = __rect
-		
-		__proj = __projection(token, lexer)
-		if(__proj is not None):
-			if(projection is None):
-				projection = __proj
-			elif(rProjection is None):
-				rProjection = __proj
-	
-	leftCalibration = (cameraMatrix, distortion, rectification, projection)
-	rightCalibration = (rCameraMatrix, rDistortion, rRectification, rProjection)
-	
-	if((width is None) or (height  is None) or (cameraMatrix is None) or (distortion is None) or (rectification is None) or (projection is None)):
-		leftCalibration = None
-	if((rWidth is None) or (rHeight  is None) or (rCameraMatrix is None) or (rDistortion is None) or (rRectification is None) or (rProjection is None)):
-		rightCalibration = None
+	(width, height, cameraMatrix, distortion, rectification, projection) = cameras[0]
+	(rWidth, rHeight, rCameraMatrix, rDistortion, rRectification, rProjection) = cameras[1]
 	
-	return (min(width, rWidth), min(height, rHeight), leftCalibration, rightCalibration)
+	return __registry.update(
+		left=(1, cameraMatrix, distortion, rectification, projection),
+		right=(1, rCameraMatrix, rDistortion, rRectification, rProjection),
+		calibrationSize=(min(width, rWidth), min(height, rHeight)))
 
 ####################################################################################
 
-def saveCalibration(filename, camNo):
+def saveCalibration(filename, camNo, context=None):
+	if(context is None):
+		context = __registry.current()
 	
-	left = (camNo==0)
-	
-	if(left):
-		(ret, cameraMatrix, distortion, rectification, projection) = __leftCalibration
-	else:
-		(ret, cameraMatrix, distortion, rectification, projection) = __rightCalibration
-	
-	if((__calibrationWidth is None) or (__calibrationHeight  is None) or (cameraMatrix is None) or (distortion is None) or (rectification is None) or (projection is None)):
+	calibration = context.calibration(camNo)
+	if(calibration is None):
 		return
 	
+	(ret, cameraMatrix, distortion, rectification, projection) = calibration
+	writeCalibration(filename, context.calibrationSize, (cameraMatrix, distortion, rectification, projection))
+
+def writeCalibration(filename, dimensions, calibration):
+	(width, height) = dimensions
+	(cameraMatrix, distortion, rectification, projection) = calibration
+	f = open(filename, 'w')
+	f.write( __ostFormatString(width, height, cameraMatrix, distortion, rectification, projection) )
+	f.close()
+
+def writeStereoCalibration(filename, dimensions, leftCalibration, rightCalibration):
+	(width, height) = dimensions
 	f = open(filename, 'w')
-	f.write( __ostFormatString(__calibrationWidth, __calibrationHeight, cameraMatrix, distortion, rectification, projection) )
+	f.write( __ostFormatString(width, height, *leftCalibration, section="narrow_stereo/left") )
+	f.write( __ostFormatString(width, height, *rightCalibration, section="narrow_stereo/right") )
 	f.close()
 
 #----------------------------------------------------------------------------------#
 
-def __ostFormatString(w, h, m, d, r, p):
+def __ostFormatString(w, h, m, d, r, p, section="narrow_stereo"):
 	return \
 	"""# oST version 5.0 parameters
 
@@ -473,7 +331,7 @@ width
 height
 """ + str(h) + """
 
-[narrow_stereo]
+[""" + section + """]
 
 camera matrix
 """ + __matrixToString(m) + """
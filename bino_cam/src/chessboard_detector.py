@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import Queue
+import threading
+from collections import deque
+import numpy as np
+import cv2
+
+class ChessboardDetector(object):
+	# Finds chessboards on worker threads without blocking the caller. cv2 lets go of the GIL while
+	# it searches, so threads run in parallel, and unlike forked processes they are safe to start
+	# inside the running wx and rospy app. Grayscale frames are copied into preallocated slots and
+	# a frame is simply skipped when every slot is still busy.
+
+	def __init__(self, shape, patternSize=(9,6), threads=2, detectionWidth=640):
+		self.shape = shape
+		self.patternSize = patternSize
+		self.numberOfSlots = threads * 2
+		self.frames = [np.empty(shape, dtype=np.uint8) for i in range(self.numberOfSlots)]
+		self.freeSlots = deque(range(self.numberOfSlots))
+		self.frameNumber = 0
+
+		self.requests = Queue.Queue()
+		self.results = Queue.Queue()
+		self.workers = [threading.Thread(target=detectionWorker, args=(self.frames, patternSize, detectionWidth, self.requests, self.results)) for i in range(threads)]
+		for worker in self.workers:
+			worker.daemon = True
+			worker.start()
+
+	def submit(self, gray):
+		if(len(self.freeSlots) == 0):
+			return False
+		slot = self.freeSlots.popleft()
+		self.frames[slot][...] = gray
+		self.frameNumber += 1
+		self.requests.put((slot, self.frameNumber))
+		return True
+
+	def poll(self):
+		# Returns [(frameNumber, corners)] for every board found since the last call
+		found = []
+		while(True):
+			try:
+				(slot, frameNumber, corners) = self.results.get_nowait()
+			except Queue.Empty:
+				break
+			self.freeSlots.append(slot)
+			if(corners is not None):
+				found.append((frameNumber, corners))
+		return found
+
+	def stop(self):
+		for worker in self.workers:
+			self.requests.put(None)
+		for worker in self.workers:
+			worker.join(1)
+		self.workers = []
+
+def detectionWorker(frames, patternSize, detectionWidth, requests, results):
+	while(True):
+		request = requests.get()
+		if(request is None):
+			break
+		(slot, frameNumber) = request
+		corners = findChessboard(frames[slot], patternSize, detectionWidth)
+		results.put((slot, frameNumber, corners))
+
+def findChessboard(gray, patternSize, detectionWidth=640):
+	# Search on a downscaled copy, then refine the corners on the full resolution image.
+	# Returns None when no board is found.
+	criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+	flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE + cv2.CALIB_CB_FAST_CHECK
+	scale = min(1.0, detectionWidth/float(gray.shape[1]))
+
+	if(scale < 1.0):
+		small = cv2.resize(gray, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+	else:
+		small = gray
+	ret, corners = cv2.findChessboardCorners(small, patternSize, None, flags)
+
+	if(not ret):
+		return None
+	corners = ((corners + 0.5) / scale - 0.5).astype(np.float32)
+	cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), criteria)
+	return corners
+
+def isNewPose(corners, acceptedCorners, imageSize, threshold=0.05):
+	# A board is a near duplicate when its corners moved on average less than
+	# threshold of the image diagonal from a view already captured
+	diagonal = np.hypot(imageSize[0], imageSize[1])
+	points = corners.reshape(-1, 2)
+	for accepted in acceptedCorners:
+		accepted = accepted.reshape(-1, 2)
+		# The same board seen upside down is found with its corners in reverse order
+		for candidate in (accepted, accepted[::-1]):
+			if(np.mean(np.hypot(*(points - candidate).T)) < threshold * diagonal):
+				return False
+	return True
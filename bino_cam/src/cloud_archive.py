@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+import argparse
+import Queue
+import numpy as np
+from frame_sources import indexFile
+
+# Point clouds kept on disk as they arrive, so they outlive the next capture. An archive is a raw
+# file of float32 (height, width, 3) clouds written back to back, read through np.memmap, next to
+# a <archive>.index.npz holding the byte offset, shape, timestamp, calibration version, bounds and
+# furthest depth of every cloud. The index is replaced after every cloud, so an archive that is
+# still being written, or whose writer died, can be opened up to its last complete cloud.
+
+class CloudRecorder(object):
+	# Appends clouds to an archive on a writer thread. write() only queues, at most maxQueued clouds
+	# wait for the disk and any more are dropped, so a slow disk never holds up the caller.
+
+	def __init__(self, path, maxQueued=8):
+		self.path = path
+		self.file = open(path, 'wb')
+		self.queue = Queue.Queue(maxQueued)
+		self.entries = {"offsets": [], "shapes": [], "timestamps": [], "versions": [], "bounds": [], "maxDists": []}
+		self.offset = 0
+		self.dropped = 0
+		self.writeTime = 0.0
+		self.thread = threading.Thread(target=self.__writeLoop)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def __len__(self):
+		return len(self.entries["timestamps"])
+
+	def write(self, cloud, timestamp=None, version=None, decode=None):
+		# cloud is (maxDist, points) or, with decode, whatever decode turns into one on the writer thread.
+		# Returns False if the cloud was dropped.
+		try:
+			self.queue.put_nowait((cloud, time.time() if timestamp is None else timestamp, -1 if version is None else version, decode))
+			return True
+		except Queue.Full:
+			self.dropped += 1
+			return False
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+		self.file.close()
+
+	def getStats(self):
+		# Clouds written and dropped, bytes written and the rate the disk took them at in MB/s
+		return {"written": len(self), "dropped": self.dropped, "queued": self.queue.qsize(), "bytes": self.offset,
+			"mbPerSecond": self.offset/self.writeTime/1e6 if self.writeTime > 0 else None}
+
+	#----------------------------------------------------------------------------------#
+
+	def __writeLoop(self):
+		while(True):
+			item = self.queue.get()
+			if(item is None):
+				return
+			try:
+				self.__writeCloud(*item)
+			except Exception as e:
+				# Whatever made it to the file of this cloud is cut off again, the index never saw it
+				print "Cloud %d not archived: %s" % (len(self), e)
+				self.file.seek(self.offset)
+				self.file.truncate()
+
+	def __writeCloud(self, cloud, timestamp, version, decode):
+		if(decode is not None):
+			cloud = decode(cloud)
+		(maxDist, points) = cloud
+		if(points.ndim == 2):
+			points = points[np.newaxis]
+
+		start = time.time()
+		points = np.ascontiguousarray(points[..., :3], dtype=np.float32)
+		points.tofile(self.file)
+		self.file.flush()
+		self.writeTime += time.time() - start
+
+		self.entries["offsets"].append(self.offset)
+		self.entries["shapes"].append(points.shape)
+		self.entries["timestamps"].append(timestamp)
+		self.entries["versions"].append(version)
+		self.entries["bounds"].append(cloudBounds(points))
+		self.entries["maxDists"].append(maxDist)
+		self.offset += points.nbytes
+		self.__writeIndex()
+
+	def __writeIndex(self):
+		# Written next to the old index and renamed over it, readers never see half of one
+		temporary = indexFile(self.path) + ".tmp.npz"
+		np.savez(temporary,
+			offsets=np.array(self.entries["offsets"], dtype=np.int64),
+			shapes=np.array(self.entries["shapes"], dtype=np.int64).reshape(-1, 3),
+			timestamps=np.array(self.entries["timestamps"], dtype=np.float64),
+			versions=np.array(self.entries["versions"], dtype=np.int64),
+			bounds=np.array(self.entries["bounds"], dtype=np.float32).reshape(-1, 2, 3),
+			maxDists=np.array(self.entries["maxDists"], dtype=np.float64))
+		os.rename(temporary, indexFile(self.path))
+
+class RecordedClouds(object):
+	# An archive opened for reading. cloud(n) is (maxDist, points) like getDataFromROS hands out,
+	# with points a view into the memory mapped file, so nothing is read until it is used.
+
+	def __init__(self, path):
+		index = np.load(indexFile(path))
+		self.offsets = index["offsets"]
+		self.shapes = index["shapes"]
+		self.timestamps = index["timestamps"]
+		self.versions = index["versions"]
+		self.bounds = index["bounds"]
+		self.maxDists = index["maxDists"]
+		index.close()
+
+		# Only the clouds the index knows about, a writer may have appended part of the next one
+		size = int(self.offsets[-1] + 4*np.prod(self.shapes[-1])) if len(self.offsets) else 0
+		self.data = np.memmap(path, dtype=np.float32, mode='r', shape=(size//4,)) if size > 0 else np.empty(0, dtype=np.float32)
+
+	def __len__(self):
+		return len(self.timestamps)
+
+	def cloud(self, n):
+		start = self.offsets[n]//4
+		shape = tuple(int(v) for v in self.shapes[n])
+		return (float(self.maxDists[n]), self.data[start:start + int(np.prod(shape))].reshape(shape))
+
+	def nearest(self, timestamp):
+		# Index of the cloud taken closest to timestamp
+		n = int(np.searchsorted(self.timestamps, timestamp))
+		if((n > 0) and ((n == len(self)) or (timestamp - self.timestamps[n - 1] < self.timestamps[n] - timestamp))):
+			n -= 1
+		return n
+
+#----------------------------------------------------------------------------------#
+
+def cloudBounds(points):
+	# ((xMin, yMin, zMin), (xMax, yMax, zMax)) of an (height, width, 3) cloud, NaN points are skipped
+	# and the bounds are NaN without any. fmin and fmax ignore NaN, and reducing over the rows first
+	# runs along contiguous memory, a hundred times faster than masking out the NaN points.
+	low = np.fmin.reduce(np.fmin.reduce(points, axis=0), axis=0)
+	high = np.fmax.reduce(np.fmax.reduce(points, axis=0), axis=0)
+	return np.array((low, high), dtype=np.float32)
+
+def writePLY(path, points):
+	# Binary little endian PLY of the finite points, the layout PCL and MeshLab read
+	points = np.ascontiguousarray(points[..., :3], dtype=np.float32).reshape(-1, 3)
+	points = points[np.isfinite(points).all(axis=1)].astype('<f4')
+	f = open(path, 'wb')
+	f.write("ply\nformat binary_little_endian 1.0\nelement vertex %d\nproperty float x\nproperty float y\nproperty float z\nend_header\n" % points.shape[0])
+	points.tofile(f)
+	f.close()
+
+def writePCD(path, points):
+	# Binary PCD that keeps an organised cloud organised, points without a depth stay NaN
+	points = np.ascontiguousarray(points[..., :3], dtype='<f4')
+	(height, width) = points.shape[:2] if points.ndim == 3 else (1, points.shape[0])
+	f = open(path, 'wb')
+	f.write("# .PCD v0.7 - Point Cloud Data file format\nVERSION 0.7\nFIELDS x y z\nSIZE 4 4 4\nTYPE F F F\nCOUNT 1 1 1\n"
+		"WIDTH %d\nHEIGHT %d\nVIEWPOINT 0 0 0 1 0 0 0\nPOINTS %d\nDATA binary\n" % (width, height, width*height))
+	points.tofile(f)
+	f.close()
+
+####################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="List the clouds in an archive or export one of them")
+	parser.add_argument("archive")
+	parser.add_argument("--export", nargs=2, metavar=("N", "FILE"), default=None, help="write cloud N to FILE, .ply or .pcd")
+	args = parser.parse_args()
+
+	clouds = RecordedClouds(args.archive)
+	if(args.export is None):
+		for n in range(len(clouds)):
+			(low, high) = clouds.bounds[n]
+			print "%5d  %.3f  calibration %d  %dx%d  z %.3f to %.3f" % (n, clouds.timestamps[n], clouds.versions[n], clouds.shapes[n][1], clouds.shapes[n][0], low[2], high[2])
+	else:
+		(n, path) = (int(args.export[0]), args.export[1])
+		(maxDist, points) = clouds.cloud(n)
+		if(path.lower().endswith(".pcd")):
+			writePCD(path, points)
+		else:
+			writePLY(path, points)
+		print "Cloud %d written to %s" % (n, path)
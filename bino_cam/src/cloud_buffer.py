@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from collections import deque
+
+DROP_OLDEST = "drop-oldest"
+LATEST_WINS = "latest-wins"
+
+class CloudBuffer(object):
+	# Bounded, locked hand-over between the rospy subscriber thread and the GUI.
+	# DROP_OLDEST keeps up to depth clouds in arrival order, LATEST_WINS only ever hands out
+	# the newest cloud and throws away anything older. With a decoder the raw message is stored
+	# and only decoded when a cloud is actually taken, so dropped clouds cost nothing.
+
+	def __init__(self, depth=1, policy=LATEST_WINS, decoder=None):
+		if(policy not in (DROP_OLDEST, LATEST_WINS)):
+			raise ValueError("Unknown cloud buffer policy " + str(policy))
+		self.depth = depth
+		self.policy = policy
+		self.decoder = decoder
+		self.lock = threading.Lock()
+		self.items = deque()
+
+		self.received = 0
+		self.taken = 0
+		self.dropped = 0
+		self.lastAge = None
+		self.totalAge = 0.0
+
+	def __len__(self):
+		with self.lock:
+			return len(self.items)
+
+	def full(self):
+		return len(self) >= self.depth
+
+	def put(self, item):
+		with self.lock:
+			self.received += 1
+			self.items.append((time.time(), item))
+			while(len(self.items) > self.depth):
+				self.items.popleft()
+				self.dropped += 1
+
+	def take(self):
+		with self.lock:
+			if(len(self.items) == 0):
+				return None
+			if(self.policy == LATEST_WINS):
+				self.dropped += len(self.items) - 1
+				(received, item) = self.items.pop()
+				self.items.clear()
+			else:
+				(received, item) = self.items.popleft()
+			self.taken += 1
+			self.lastAge = time.time() - received
+			self.totalAge += self.lastAge
+
+		# Decoding happens outside the lock so the subscriber is never held up by it
+		if(self.decoder is not None):
+			item = self.decoder(item)
+		return item
+
+	def clear(self):
+		with self.lock:
+			self.dropped += len(self.items)
+			self.items.clear()
+
+	def getStats(self):
+		with self.lock:
+			return {
+				"received": self.received,
+				"taken": self.taken,
+				"dropped": self.dropped,
+				"pending": len(self.items),
+				"lastAge": self.lastAge,
+				"meanAge": (self.totalAge / self.taken) if self.taken > 0 else None,
+			}
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+import vtk
+import math
+import Queue
+import threading
+import numpy as np
+from vtk.util import numpy_support
+from voxel_grid import PointLevels
+
+class CloudPolyData(object):
+	# Everything VtkPointCloud draws, without a window: the cloud at several voxel grid levels of
+	# detail, the finest with at most maxNumPoints, and the vtkPolyData the level shown is uploaded to.
+	# chooseLevel() is asked which level to show whenever new points come in, the panel answers from
+	# its camera, without one the finest level is shown.
+	# The levels are built on a worker thread, a 1080p cloud takes seconds. addPoints() and
+	# clearPoints() only queue the work, ready() is called on the worker once level 0 is built and
+	# again with the coarser levels, and update(), on the thread that renders, shows what it built.
+	# With setFusion() clouds are merged into a VoxelMap instead of replacing each other. The worker
+	# owns the map and hands over only the slots a cloud changed, which are copied into the arrays
+	# drawn as the finest level. Coarser fused levels are built by the worker when one is shown.
+	def __init__(self, maxNumPoints=1e6, chooseLevel=None, ready=None):
+		self.maxNumPoints = int(maxNumPoints)
+		self.levels = PointLevels(self.maxNumPoints)
+		self.levels.build(np.empty((0, 3), dtype=np.float32))
+		self.chooseLevel = chooseLevel or (lambda: 0)
+		self.ready = ready or (lambda: None)
+		self.fusion = None
+		self.fusedShown = False
+		self.cells = np.empty((0, 2))
+		self.vtkPolyData = vtk.vtkPolyData()
+		self.points = self.levels.points(0)
+		self.level = None
+		self.pointsIn = 0
+		self.built = 0
+		self.levelsDirty = False
+		self.__resetArrays()
+
+		self.fusionStats = None
+		self.fusedMeans = np.zeros((0, 3), dtype=np.float32)
+		self.fusedLength = 0
+		self.fusedIntegrated = 0
+		self.levelsRequested = False
+
+		# Only the worker touches allPoints, pointsBuilt and the map it fuses into, finished and
+		# finishedFused are handed over under the lock
+		self.allPoints = self.points
+		self.pointsBuilt = 0
+		self.workerFusion = None
+		self.integrated = 0
+		self.finished = None
+		self.finishedFused = None
+		self.lock = threading.Lock()
+		self.jobs = Queue.Queue()
+		self.worker = threading.Thread(target=self.__buildLoop)
+		self.worker.daemon = True
+		self.worker.start()
+
+	def addPoints(self, points):
+		# Accepts an (N, 3) array or an organised (H, W, 3) cloud, points without a depth are dropped
+		self.jobs.put(("add", points))
+
+	def clearPoints(self):
+		# The cloud shown stays until the worker has built what comes after it, so a clear followed
+		# by new points never blanks the view
+		self.jobs.put(("clear", None))
+
+	def update(self):
+		# Shows what the worker finished since the last call, True if there was anything
+		with self.lock:
+			(finished, self.finished) = (self.finished, None)
+			(fused, self.finishedFused) = (self.finishedFused, None)
+		# Whatever was finished for another map, before fusion was switched, is dropped
+		if((fused is not None) and (fused["map"] is self.fusion)):
+			self.__showFused(fused)
+		if((finished is not None) and (finished[2] is self.fusion)):
+			(self.levels, pointsIn, voxels, integrated) = finished
+			if(voxels is not None):
+				# Levels built before the last capture shown are replaced as soon as they are looked at
+				self.levelsDirty = integrated < self.fusedIntegrated
+				self.levelsRequested = False
+			else:
+				self.pointsIn = pointsIn
+				if(self.levels.points(0).shape[0] == 0):
+					self.points = self.levels.points(0)
+					self.__resetArrays()
+			self.level = None
+			self.showLevel(self.chooseLevel())
+		elif(fused is None):
+			return False
+		self.built += 1
+		return True
+
+	def wait(self):
+		# Until the worker is through everything queued so far
+		self.jobs.join()
+
+	def close(self):
+		self.ready = lambda: None
+		self.jobs.put(None)
+
+	def setFusion(self, voxelMap):
+		# A VoxelMap to fuse every later cloud into, None to go back to one cloud at a time.
+		# From here on the map belongs to the worker.
+		self.fusion = voxelMap
+		self.fusionStats = None
+		self.pointsIn = 0
+		self.level = None
+		self.levels = PointLevels(self.maxNumPoints)
+		self.levels.build(self.points[:0])
+		self.levelsDirty = False
+		self.levelsRequested = False
+		self.fusedShown = False
+		self.fusedLength = 0
+		if(voxelMap is not None):
+			self.fusedMeans = np.zeros((voxelMap.capacity, 3), dtype=np.float32)
+		self.jobs.put(("fusion", voxelMap))
+
+	def showLevel(self, level):
+		level = min(max(0, level), len(self.levels) - 1)
+		if((len(self.levels) == 0) or (level == self.level)):
+			return
+		self.level = level
+		if(self.fusion is not None):
+			# The coarser levels are only rebuilt from the map when one of them is about to be shown,
+			# until the worker has them the finest level stays up
+			if(self.levelsDirty and not self.levelsRequested):
+				self.levelsRequested = True
+				self.jobs.put(("levels", None))
+			if((level == 0) or (self.levels.points(0).shape[0] == 0)):
+				self.level = 0
+				self.__uploadFused(None)
+				return
+		self.points = self.levels.points(level)
+		self.__uploadPoints()
+
+	def levelFor(self, footprint):
+		# Coarsest level whose detail is no finer than footprint, the scene size one pixel covers
+		if((self.fusion is not None) and self.fusion.voxelSize):
+			# Fused levels double the map's voxel size, so the level is known without building them
+			return int(math.floor(math.log(max(footprint/self.fusion.voxelSize, 1), 2)))
+		return self.levels.select(footprint)
+
+	def getStats(self):
+		# Points added, points shown at every level, the level shown and how many builds were shown
+		return {
+			"pointsIn": self.pointsIn,
+			"built": self.built,
+			"levels": [self.levels.points(level).shape[0] for level in range(len(self.levels))],
+			"level": self.level,
+			"shown": self.points.shape[0],
+			"fusion": self.fusionStats,
+		}
+
+	def __buildLoop(self):
+		while(True):
+			jobs = [self.jobs.get()]
+			while(True):
+				try:
+					jobs.append(self.jobs.get_nowait())
+				except Queue.Empty:
+					break
+			try:
+				if(None in jobs):
+					return
+				# A clear makes everything queued before it moot, except for switching the map
+				start = max([n for (n, (kind, argument)) in enumerate(jobs) if kind in ("clear", "fusion")] or [0])
+				for (kind, argument) in jobs[:start]:
+					if(kind == "fusion"):
+						self.workerFusion = argument
+				for (n, (kind, argument)) in enumerate(jobs[start:], start):
+					self.__runJob(kind, argument, n == len(jobs) - 1)
+			finally:
+				for job in jobs:
+					self.jobs.task_done()
+
+	def __runJob(self, kind, argument, last):
+		voxels = self.workerFusion
+		if(kind == "fusion"):
+			voxels = self.workerFusion = argument
+		if(kind in ("clear", "fusion")):
+			self.allPoints = self.allPoints[:0]
+			self.pointsBuilt = 0
+			if(voxels is not None):
+				voxels.clear()
+				self.integrated += 1
+				self.__finishFused(None)
+			elif(last):
+				levels = PointLevels(self.maxNumPoints)
+				levels.build(self.allPoints)
+				self.__finish(levels)
+			return
+		if(kind == "levels"):
+			if(voxels is not None):
+				levels = PointLevels(self.maxNumPoints)
+				# A copy, the map's own arrays keep changing on this thread after the levels are handed over
+				levels.build(voxels.points().copy(), voxels.voxelSize or 0)
+				self.__finish(levels)
+			return
+
+		points = np.asarray(argument)[..., :3].reshape(-1, 3)
+		points = points[np.isfinite(points).all(axis=1)].astype(np.float32)
+		self.pointsBuilt += points.shape[0]
+		if(voxels is not None):
+			self.integrated += 1
+			self.__finishFused(voxels.integrate(points))
+			return
+		if(self.allPoints.shape[0] > 0):
+			points = np.vstack((self.allPoints, points))
+		levels = PointLevels(self.maxNumPoints)
+		levels.buildFinest(points)
+		# Later points are merged with the finest level, so memory stays bounded by maxNumPoints
+		self.allPoints = levels.points(0)
+		self.__finish(levels)
+		levels.buildCoarser()
+		self.__finish(levels)
+
+	def __finish(self, levels):
+		with self.lock:
+			self.finished = (levels, self.pointsBuilt, self.workerFusion, self.integrated)
+		self.ready()
+
+	def __finishFused(self, changed):
+		# Copies of the changed slots, added to those not shown yet. None after the map was cleared.
+		voxels = self.workerFusion
+		with self.lock:
+			fused = self.finishedFused
+			if(changed is None):
+				fused = {"reset": True, "slots": np.empty(0, dtype=np.int64)}
+			elif(fused is None):
+				fused = {"reset": False, "slots": changed}
+			else:
+				fused["slots"] = np.union1d(fused["slots"], changed)
+			fused["map"] = voxels
+			fused["integrated"] = self.integrated
+			fused["means"] = voxels.means[fused["slots"]]
+			fused["length"] = len(voxels)
+			fused["pointsIn"] = self.pointsBuilt
+			fused["stats"] = voxels.getStats()
+			self.finishedFused = fused
+		self.ready()
+
+	def __resetArrays(self):
+		self.vtkPoints = vtk.vtkPoints()
+		self.vtkCells = vtk.vtkCellArray()
+		self.vtkDepth = vtk.vtkDoubleArray()
+		self.vtkDepth.SetName('DepthArray')
+		self.vtkPolyData.SetPoints(self.vtkPoints)
+		self.vtkPolyData.SetVerts(self.vtkCells)
+		self.vtkPolyData.GetPointData().SetScalars(self.vtkDepth)
+		self.vtkPolyData.GetPointData().SetActiveScalars('DepthArray')
+
+	def __showFused(self, fused):
+		if(fused["reset"]):
+			self.fusedShown = False
+			self.__resetArrays()
+			self.levels = PointLevels(self.maxNumPoints)
+			self.levels.build(self.points[:0])
+			self.level = None
+		self.fusedMeans[fused["slots"]] = fused["means"]
+		self.fusedLength = fused["length"]
+		self.pointsIn = fused["pointsIn"]
+		self.fusionStats = fused["stats"]
+		self.fusedIntegrated = fused["integrated"]
+		self.levelsDirty = True
+
+		level = self.chooseLevel()
+		if((level == 0) and (self.level == 0)):
+			self.__uploadFused(fused["slots"])
+		else:
+			self.level = None
+			self.showLevel(level)
+
+	def __uploadFused(self, changed):
+		# The vtk points share fusedMeans, laid out like the map's slots, so after the first upload
+		# only the depth of the changed slots is copied and the cells are cut to the live ones
+		means = self.fusedMeans
+		length = self.fusedLength
+		self.points = means[:length]
+		if(not self.fusedShown):
+			self.depth = np.ascontiguousarray(means[:, 2], dtype=np.float64)
+			self.__makeCells(means.shape[0])
+			self.vtkPoints.SetData(numpy_support.numpy_to_vtk(means))
+			self.vtkDepth = numpy_support.numpy_to_vtk(self.depth)
+			self.vtkDepth.SetName('DepthArray')
+			self.vtkPolyData.GetPointData().SetScalars(self.vtkDepth)
+			self.vtkPolyData.GetPointData().SetActiveScalars('DepthArray')
+			self.fusedShown = True
+		elif(changed is None):
+			self.depth[:length] = means[:length, 2]
+		else:
+			self.depth[changed] = means[changed, 2]
+
+		self.cellIds = self.cells[:length].ravel()
+		self.vtkCells.SetCells(length, numpy_support.numpy_to_vtkIdTypeArray(self.cellIds))
+		self.vtkCells.Modified()
+		self.vtkPoints.Modified()
+		self.vtkDepth.Modified()
+
+	def __makeCells(self, numberOfPoints):
+		if(self.cells.shape[0] != numberOfPoints):
+			self.cells = np.empty((numberOfPoints, 2), dtype=self.__idType())
+			self.cells[:, 0] = 1
+			self.cells[:, 1] = np.arange(numberOfPoints)
+
+	def __uploadPoints(self):
+		numberOfPoints = self.points.shape[0]
+		if(numberOfPoints == 0):
+			return
+
+		# The vtk arrays share memory with these numpy arrays, so they are kept alive on self
+		self.fusedShown = False
+		self.depth = np.ascontiguousarray(self.points[:, 2], dtype=np.float64)
+		self.__makeCells(numberOfPoints)
+
+		self.vtkPoints.SetData(numpy_support.numpy_to_vtk(self.points))
+		self.vtkCells.SetCells(numberOfPoints, numpy_support.numpy_to_vtkIdTypeArray(self.cells.ravel()))
+		self.vtkDepth = numpy_support.numpy_to_vtk(self.depth)
+		self.vtkDepth.SetName('DepthArray')
+		self.vtkPolyData.GetPointData().SetScalars(self.vtkDepth)
+		self.vtkPolyData.GetPointData().SetActiveScalars('DepthArray')
+
+		self.vtkCells.Modified()
+		self.vtkPoints.Modified()
+		self.vtkDepth.Modified()
+
+	def __idType(self):
+		if(vtk.vtkIdTypeArray().GetDataTypeSize() == 4):
+			return np.int32
+		return np.int64
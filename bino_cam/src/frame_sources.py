@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import time
+import threading
+import argparse
+import numpy as np
+import cv2
+
+# Frame sources StereoCapture can run on instead of the physical rig. Every source is a pair of
+# cv2.VideoCapture stand-ins (grab, retrieve, read, get, set, isOpened, release), so nothing
+# downstream needs to know whether frames come from cameras, a recording or PNG files.
+#
+# A recording is a raw file of (frames, 2, height, width, 3) uint8, read through np.memmap,
+# next to a <recording>.index.npz holding the timestamp of every pair and the frame shape.
+
+REALTIME = "realtime"
+FAST = "fast"
+
+def openStereoSource(source="live:4,5", replay=REALTIME, loop=False):
+	# live:<left>,<right> for V4L cameras, a recording file, or a folder of left-*.png/right-*.png pairs
+	if(source.startswith("live:")):
+		(left, right) = [int(device) for device in source[len("live:"):].split(",")]
+		return (cv2.VideoCapture(left), cv2.VideoCapture(right))
+
+	if(os.path.isdir(source)):
+		sequence = ImagePairSequence(source)
+	else:
+		sequence = RecordedSequence(source)
+	clock = ReplayClock(sequence, replay, loop)
+	return (SequenceCamera(clock, 0), SequenceCamera(clock, 1))
+
+def indexFile(path):
+	return path + ".index.npz"
+
+class RecordedSequence(object):
+
+	def __init__(self, path):
+		index = np.load(indexFile(path))
+		self.timestamps = index["timestamps"]
+		self.shape = tuple(int(v) for v in index["shape"])
+		index.close()
+		self.frames = np.memmap(path, dtype=np.uint8, mode='r', shape=(len(self.timestamps), 2) + self.shape)
+
+	def __len__(self):
+		return len(self.timestamps)
+
+	def frame(self, n, camNo):
+		return self.frames[n, camNo]
+
+class ImagePairSequence(object):
+	# The PNG pairs the stereo calibrator saves, decoded on demand and timed at fps
+
+	def __init__(self, folder, fps=30.0):
+		leftImages = sorted(glob.glob(os.path.join(folder, "left-*.png")))
+		self.pairs = []
+		for left in leftImages:
+			right = os.path.join(folder, "right-" + os.path.basename(left)[len("left-"):])
+			if(os.path.exists(right)):
+				self.pairs.append((left, right))
+		if(len(self.pairs) == 0):
+			raise IOError("No left-*.png/right-*.png pairs in " + folder)
+		self.timestamps = np.arange(len(self.pairs)) / float(fps)
+		self.shape = cv2.imread(self.pairs[0][0]).shape
+
+	def __len__(self):
+		return len(self.pairs)
+
+	def frame(self, n, camNo):
+		return cv2.imread(self.pairs[n][camNo])
+
+class ReplayClock(object):
+	# Shared by both cameras of a sequence, so the pair stays in step and replays at the recorded pace.
+	# REALTIME waits for each frame's recorded time, FAST hands frames out as quickly as they are asked for.
+
+	def __init__(self, sequence, replay=REALTIME, loop=False):
+		if(replay not in (REALTIME, FAST)):
+			raise ValueError("Unknown replay mode " + str(replay))
+		self.sequence = sequence
+		self.replay = replay
+		self.loop = loop
+		self.lock = threading.Lock()
+		self.start = None
+		# Frames handed out to each camera so far, counted across loops
+		self.positions = [0, 0]
+
+		# A loop lasts as long as the recording plus one average frame interval
+		timestamps = sequence.timestamps
+		self.offsets = timestamps - timestamps[0]
+		self.period = self.offsets[-1] + (self.offsets[-1]/(len(timestamps) - 1) if len(timestamps) > 1 else 0)
+
+	def next(self, camNo):
+		# Frame number the camera should show next, None once a sequence that doesn't loop has ended
+		with self.lock:
+			position = self.positions[camNo]
+			(passes, n) = divmod(position, len(self.sequence))
+			if((passes > 0) and (not self.loop)):
+				return None
+			self.positions[camNo] = position + 1
+			if(self.start is None):
+				self.start = time.time()
+			due = self.start + passes*self.period + self.offsets[n]
+
+		if(self.replay == REALTIME):
+			wait = due - time.time()
+			if(wait > 0):
+				time.sleep(wait)
+		return n
+
+class SequenceCamera(object):
+	# cv2.VideoCapture stand-in for one camera of a sequence. Setting the frame size scales the
+	# replayed frames, so setCameraResolutions16x9 still picks the resolution.
+
+	def __init__(self, clock, camNo):
+		self.clock = clock
+		self.camNo = camNo
+		self.current = None
+		self.released = False
+		(height, width) = clock.sequence.shape[:2]
+		self.size = [width, height]
+
+	def isOpened(self):
+		return not self.released
+
+	def grab(self):
+		if(self.released):
+			return False
+		self.current = self.clock.next(self.camNo)
+		return self.current is not None
+
+	def retrieve(self, image=None):
+		if(self.current is None):
+			return (False, None)
+		frame = self.clock.sequence.frame(self.current, self.camNo)
+		size = tuple(self.size)
+		shape = (size[1], size[0]) + frame.shape[2:]
+		if((image is None) or (image.shape != shape)):
+			image = np.empty(shape, np.uint8)
+		if((frame.shape[1], frame.shape[0]) != size):
+			cv2.resize(frame, size, image, interpolation=cv2.INTER_AREA)
+		else:
+			image[...] = frame
+		return (True, image)
+
+	def read(self, image=None):
+		if(not self.grab()):
+			return (False, None)
+		return self.retrieve(image)
+
+	def get(self, propId):
+		# Same property numbers as cv2.VideoCapture: 1 position, 3 width, 4 height, 7 frame count
+		if(propId == 3):
+			return self.size[0]
+		if(propId == 4):
+			return self.size[1]
+		if(propId == 7):
+			return len(self.clock.sequence)
+		if(propId == 1):
+			return self.clock.positions[self.camNo] % len(self.clock.sequence)
+		return 0
+
+	def set(self, propId, value):
+		if(propId == 3):
+			self.size[0] = int(value)
+		elif(propId == 4):
+			self.size[1] = int(value)
+		else:
+			return False
+		return True
+
+	def release(self):
+		self.released = True
+
+class StereoRecorder(object):
+	# Appends pairs to a recording, the index is written on close
+
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'wb')
+		self.timestamps = []
+		self.shape = None
+
+	def write(self, frames, timestamp=None):
+		(left, right) = frames
+		if(self.shape is None):
+			self.shape = left.shape
+		if((left.shape != self.shape) or (right.shape != self.shape)):
+			raise ValueError("Every frame of a recording must be %s, got %s and %s" % (self.shape, left.shape, right.shape))
+		np.ascontiguousarray(left, dtype=np.uint8).tofile(self.file)
+		np.ascontiguousarray(right, dtype=np.uint8).tofile(self.file)
+		self.timestamps.append(time.time() if timestamp is None else timestamp)
+
+	def close(self):
+		self.file.close()
+		np.savez(indexFile(self.path), timestamps=np.array(self.timestamps, dtype=np.float64), shape=np.array(self.shape or (0, 0, 3)))
+
+####################################################################################
+
+if __name__ == '__main__':
+	from camera_functions import setCameraResolutions16x9
+
+	parser = argparse.ArgumentParser(description="Record a stereo sequence from any frame source")
+	parser.add_argument("output", help="recording to write, the index goes next to it")
+	parser.add_argument("--source", default="live:4,5", help="live:<left>,<right>, a recording or a folder of PNG pairs")
+	parser.add_argument("--frames", type=int, default=300)
+	parser.add_argument("--height", type=int, default=720, help="resolution to record at, the width follows 16:9")
+	args = parser.parse_args()
+
+	# Both sensors are triggered before either frame is decoded, like the StereoCapture threads do
+	cams = openStereoSource(args.source)
+	setCameraResolutions16x9(cams, args.height)
+	recorder = StereoRecorder(args.output)
+	try:
+		while(len(recorder.timestamps) < args.frames):
+			if(not (cams[0].grab() and cams[1].grab())):
+				break
+			timestamp = time.time()
+			(leftRet, left) = cams[0].retrieve()
+			(rightRet, right) = cams[1].retrieve()
+			if(leftRet and rightRet):
+				recorder.write((left, right), timestamp)
+	finally:
+		for cam in cams:
+			cam.release()
+		recorder.close()
+	print "%d pairs written to %s" % (len(recorder.timestamps), args.output)
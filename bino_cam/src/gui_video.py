@@ -2,34 +2,40 @@
 
 import cv2
 import numpy as np
+import threading
+import time
+from collections import deque
 import wx
 import wx.lib.newevent
 import abc
 from camera_functions import *
-from ros_functions import getDataFromROS, sendDataToROS, constructDepthMapImage, initializePointCloud, destroyPointCloud
+from ros_functions import getDataFromROS, sendDataToROS, constructDepthMapImage, initializePointCloud, destroyPointCloud, depthMapColormaps, addPointCloudListener, removePointCloudListener, takeCloudTrace
+from latency_trace import tracer
 from vtk_gui import VtkPointCloud
+from voxel_grid import VoxelMap
+from chessboard_detector import ChessboardDetector, isNewPose
 
 class VideoFeed(wx.Panel):
 	
 	__metaclass__ = abc.ABCMeta
 	
-	def __init__(self, parent, cams, fps=30):
+	def __init__(self, parent, cams, fps=30, scaleToFit=False):
 		wx.Panel.__init__(self, parent)
 
 		self.parent = parent
 		self.Cams = cams
-		image = self.GetImage()
-
-		height, width = image.shape[:2]
 		
-		self.parent.FitInside()
+		# One bitmap per view, updated in place from the RGB image every frame.
+		# With scaleToFit the image is shrunk to the visible area before it is copied.
+		self.bitmap = None
+		self.scaled = None
+		self.scaleToFit = scaleToFit
 		
-		image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-		image = wx.ImageFromData(width, height, image)
+		self.parent.FitInside()
 		
 		self.imagePanel = wx.Panel(self)
-		self.image = wx.StaticBitmap(self.imagePanel)
-		self.image.SetBitmap(image.ConvertToBitmap())
+		self.imagePanel.Bind(wx.EVT_PAINT, self.OnPaint)
+		self.ShowImage(self.GetImage(rgb=True))
 		
 		self.mainSizer = wx.BoxSizer(wx.VERTICAL)
 		self.mainSizer.Add(self.imagePanel)
@@ -38,40 +44,173 @@ class VideoFeed(wx.Panel):
 		self.SetSizer(self.mainSizer)
 		self.Layout()
 
-		self.timer = wx.Timer(self)
-		self.timer.Start(1000./fps)
+		# Redraws are requested by the capture thread / ROS subscriber. At most one is queued on the
+		# GUI thread at a time, anything arriving meanwhile is folded into it, and fps caps the redraw rate.
+		self.minInterval = 1.0/fps
+		self.lastDraw = 0
+		self.pendingLock = threading.Lock()
+		self.pending = False
+		self.pendingSince = None
+		self.coalesced = 0
+		self.drawn = 0
+		self.latencies = deque(maxlen=100)
+		self.subscribed = False
+		self.timer = None
+		self.pendingTrace = None
+		self.latencyLabel = None
 
 		self.SetDoubleBuffered(True)
-		self.Bind(wx.EVT_TIMER, self.NextFrame)
-
-	def NextFrame(self, event):
-		image = self.GetImage()
+		self.Subscribe()
 
+	def NextFrame(self, event=None):
+		with self.pendingLock:
+			self.pending = False
+			since = self.pendingSince
+			self.pendingSince = None
+		
+		self.ShowImage(self.GetImage(rgb=True))
+		
+		self.lastDraw = time.time()
+		self.drawn += 1
+		if(since is not None):
+			self.latencies.append(self.lastDraw - since)
+		self.FinishTrace()
+	
+	def AddLatencyOverlay(self):
+		# One line with the time every stage took for the last pair sent to the matcher
+		self.latencyLabel = wx.StaticText(self)
+		self.mainSizer.Add(self.latencyLabel, flag=wx.EXPAND)
+		self.Layout()
+	
+	def FinishTrace(self):
+		# GetImage leaves the trace of a new cloud in pendingTrace, it ends once the image is shown
+		trace = self.pendingTrace
+		if(trace is None):
+			return
+		self.pendingTrace = None
+		trace.mark("display")
+		tracer.finish(trace)
+		if(self.latencyLabel is not None):
+			self.latencyLabel.SetLabel(trace.describe())
+	
+	def SendNewData(self):
+		trace = tracer.begin()
+		frames = getFrames(self.Cams)
+		trace.mark("getFrames")
+		sendDataToROS(frames, getCalibrationContext(), trace)
+	
+	def ShowImage(self, image):
+		image = np.ascontiguousarray(self.__FitToPanel(image))
 		height, width = image.shape[:2]
 		
-		image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-		image = wx.ImageFromData(width, height, image)
-		
-		self.image.SetBitmap(image.ConvertToBitmap())
+		if((self.bitmap is None) or (tuple(self.bitmap.GetSize()) != (width, height))):
+			self.bitmap = wx.BitmapFromBuffer(width, height, image)
+			self.imagePanel.SetMinSize((width, height))
+			self.imagePanel.SetSize((width, height))
+			if(self.GetSizer() is not None):
+				self.Layout()
+		else:
+			self.bitmap.CopyFromBuffer(image)
 		
-		wx.YieldIfNeeded()
+		self.imagePanel.Refresh(False)
+	
+	def OnPaint(self, event):
+		dc = wx.PaintDC(self.imagePanel)
+		if(self.bitmap is not None):
+			dc.DrawBitmap(self.bitmap, 0, 0)
+	
+	def __FitToPanel(self, image):
+		if(not self.scaleToFit):
+			return image
+		(maxWidth, maxHeight) = self.parent.GetClientSize()
+		(height, width) = image.shape[:2]
+		scale = min(1.0, maxWidth/float(width), maxHeight/float(height))
+		if((scale >= 1.0) or (maxWidth <= 0) or (maxHeight <= 0)):
+			return image
+		
+		size = (max(1, int(width*scale)), max(1, int(height*scale)))
+		if((self.scaled is None) or (self.scaled.shape[:2] != (size[1], size[0]))):
+			self.scaled = np.empty((size[1], size[0]) + image.shape[2:], np.uint8)
+		cv2.resize(image, size, self.scaled, interpolation=cv2.INTER_AREA)
+		return self.scaled
+	
+	def OnDataReady(self, timestamp=None):
+		# Called on the thread that produced the data, only hands a redraw over to the GUI thread
+		with self.pendingLock:
+			if(self.pending):
+				self.coalesced += 1
+				return
+			self.pending = True
+			self.pendingSince = timestamp or time.time()
+		wx.CallAfter(self.__ScheduleFrame)
+	
+	def RequestRedraw(self):
+		self.OnDataReady(time.time())
+	
+	def __ScheduleFrame(self):
+		# The panel may have been destroyed while the event was queued
+		if(not self):
+			return
+		wait = self.minInterval - (time.time() - self.lastDraw)
+		if(wait > 0):
+			wx.CallLater(int(wait*1000) + 1, self.__DrawIfAlive)
+		else:
+			self.NextFrame()
+	
+	def __DrawIfAlive(self):
+		if(self):
+			self.NextFrame()
+	
+	def Subscribe(self):
+		# Sources without listeners (plain cv2.VideoCapture) are still polled on a timer
+		if(self.subscribed):
+			return
+		self.subscribed = True
+		if(hasattr(self.Cams, "addListener")):
+			self.Cams.addListener(self.OnDataReady)
+		else:
+			if(self.timer is None):
+				self.timer = wx.Timer(self)
+				self.Bind(wx.EVT_TIMER, self.NextFrame)
+			self.timer.Start(1000.*self.minInterval)
+	
+	def Unsubscribe(self):
+		if(not self.subscribed):
+			return
+		self.subscribed = False
+		if(hasattr(self.Cams, "addListener")):
+			self.Cams.removeListener(self.OnDataReady)
+		elif(self.timer is not None):
+			self.timer.Stop()
+	
+	def GetLatencyStats(self):
+		# Time from new data being available to it being on screen, over the last 100 redraws
+		latencies = list(self.latencies)
+		if(len(latencies) == 0):
+			return {"drawn": self.drawn, "coalesced": self.coalesced, "mean": None, "max": None}
+		return {"drawn": self.drawn, "coalesced": self.coalesced, "mean": sum(latencies)/len(latencies), "max": max(latencies)}
 	
 	def Show(self, show):
 		if(show):
-			self.timer.Start()
+			self.Subscribe()
+			self.RequestRedraw()
 		else:
-			self.timer.Stop()
+			self.Unsubscribe()
 		super(VideoFeed, self).Show(show)
 	
+	def Destroy(self):
+		self.Unsubscribe()
+		super(VideoFeed, self).Destroy()
+	
 	@abc.abstractmethod
-	def GetImage(self):
-		## Returns the type of image the feed is supposed to represent
+	def GetImage(self, rgb=False):
+		## Returns the type of image the feed is supposed to represent, in RGB order when rgb is set
 		return
 
 class SideBySide(VideoFeed):
 	
-	def GetImage(self):
-		return sideBySide(getFrames(self.Cams))
+	def GetImage(self, rgb=False):
+		return sideBySide(getFrames(self.Cams), rgb)
 
 class RedGreen(VideoFeed):
 	
@@ -88,8 +227,8 @@ class RedGreen(VideoFeed):
 		self.mainSizer.Prepend(self.slider)
 		self.Layout()	
 	
-	def GetImage(self):
-		return redGreen(self.distance, getFrames(self.Cams))
+	def GetImage(self, rgb=False):
+		return redGreen(self.distance, getFrames(self.Cams), rgb)
 	
 	def Show(self, show):
 		self.slider.Show(show)
@@ -105,12 +244,12 @@ class RedGreen(VideoFeed):
 
 class CorrectedSideBySide(VideoFeed):
 	
-	def GetImage(self):
-		return correctedSideBySide(getFrames(self.Cams))
+	def GetImage(self, rgb=False):
+		return correctedSideBySide(getFrames(self.Cams), rgb=rgb)
 
 class DepthMap(VideoFeed):
 	
-	def __init__(self, parent, cams, fps=1.0/6):
+	def __init__(self, parent, cams, fps=5):
 		initializePointCloud()
 		
 		super(DepthMap, self).__init__(parent, cams, fps)
@@ -119,33 +258,59 @@ class DepthMap(VideoFeed):
 		self.newDataButton.Bind(wx.EVT_BUTTON, self.newDataButtonPushed)
 		self.hotNearToggle = wx.ToggleButton(self, label="Hot Near Toggle")
 		self.hotNearToggle.Bind(wx.EVT_TOGGLEBUTTON, self.ToggleChanged)
+		self.colormapChoice = wx.Choice(self, choices=[name for (name, colormap) in depthMapColormaps])
+		self.colormapChoice.SetSelection(0)
+		self.colormapChoice.Bind(wx.EVT_CHOICE, self.ToggleChanged)
 		
 		calibrationSizer = wx.BoxSizer(wx.HORIZONTAL)
 		calibrationSizer.Add(self.newDataButton, flag=wx.EXPAND)
 		calibrationSizer.Add(self.hotNearToggle, flag=wx.EXPAND)
+		calibrationSizer.Add(self.colormapChoice, flag=wx.EXPAND)
 		
 		self.mainSizer.Prepend(calibrationSizer, wx.EXPAND)
+		self.AddLatencyOverlay()
 	
-	def GetImage(self):
+	def GetImage(self, rgb=False):
 		data = getDataFromROS()
 		if(data is None):
 			return returnValidImage(None, (1, 1))
-		else:
-			self.timer.Stop()
 			
 		(maxDist, pointCloudData) = data
-		image = constructDepthMapImage(self.hotNearToggle.GetValue(), maxDist, pointCloudData)
+		colormap = self.GetColormap()
+		image = constructDepthMapImage(self.hotNearToggle.GetValue(), maxDist, pointCloudData, colormap)
+		# The green only image looks the same either way round
+		if(rgb and (colormap is not None)):
+			cv2.cvtColor(image, cv2.COLOR_BGR2RGB, image)
+		
+		trace = takeCloudTrace()
+		if(trace is not None):
+			trace.mark("depthImage")
+			self.pendingTrace = trace
 		return image
 	
+	def GetColormap(self):
+		# GetImage is called once from VideoFeed.__init__ before the controls exist
+		if(not hasattr(self, "colormapChoice")):
+			return None
+		return depthMapColormaps[self.colormapChoice.GetSelection()][1]
+	
+	def Subscribe(self):
+		# Only redrawn when a new cloud arrives, not on every camera frame
+		if(not self.subscribed):
+			self.subscribed = True
+			addPointCloudListener(self.OnDataReady)
+	
+	def Unsubscribe(self):
+		if(self.subscribed):
+			self.subscribed = False
+			removePointCloudListener(self.OnDataReady)
+	
 	def newDataButtonPushed(self, event):
 		print "New images sent to ROS."
-		self.timer.Start()
-		dimensions = (getCalibrationWidth(), getCalibrationHeight())
-		calibrationInfo = (getLeftCalibration(), getRightCalibration())
-		data = sendDataToROS(getFrames(self.Cams), dimensions, calibrationInfo)
+		self.SendNewData()
 	
 	def ToggleChanged(self, evenet):
-		self.timer.Start()
+		self.RequestRedraw()
 	
 	def Destroy(self):
 		destroyPointCloud()
@@ -153,7 +318,7 @@ class DepthMap(VideoFeed):
 
 class PointCloud(VideoFeed):
 	
-	def __init__(self, parent, cams, fps=1.0/6):
+	def __init__(self, parent, cams, fps=5):
 		self.initialized = False
 		initializePointCloud()
 		
@@ -163,53 +328,102 @@ class PointCloud(VideoFeed):
 		
 		self.newDataButton = wx.Button(self, label="Get new data")
 		self.newDataButton.Bind(wx.EVT_BUTTON, self.newDataButtonPushed)
+		# Fused captures build up in one voxel map instead of replacing each other
+		self.fusionToggle = wx.ToggleButton(self, label="Fuse captures")
+		self.fusionToggle.SetValue(False)
+		self.fusionToggle.Bind(wx.EVT_TOGGLEBUTTON, self.FusionToggled)
 		
 		self.vtkPointCloud = VtkPointCloud(self)
 		self.vtkPointCloud.SetSize( (getWidth(), getHeight()) )
 		
 
 		self.mainSizer.Prepend(self.vtkPointCloud.GetSize(), wx.EXPAND)
+		self.mainSizer.Prepend(self.fusionToggle)
 		self.mainSizer.Prepend(self.newDataButton)
+		self.AddLatencyOverlay()
+		
+		# Level of detail shown and render times, refreshed at most every quarter second
+		self.lodLabel = wx.StaticText(self)
+		self.mainSizer.Add(self.lodLabel, flag=wx.EXPAND)
+		self.lastLodUpdate = 0
+		self.vtkPointCloud.addListener(self.ShowLodStats)
+		# The levels of a cloud are built in the background, its trace ends once they are rendered
+		self.buildingTrace = None
+		self.builtBefore = 0
+		self.vtkPointCloud.addListener(self.CloudShown)
 
 		self.Layout()
 		self.initialized = True
 	
-	def GetImage(self):
+	def GetImage(self, rgb=False):
 		z = 2
 		data = getDataFromROS()
 		if(self.initialized and data is not None):
-			self.timer.Stop()
 			(maxDist, pointCloudData) = data
-			self.vtkPointCloud.clearPoints()
+			if(self.vtkPointCloud.fusion is None):
+				self.vtkPointCloud.clearPoints()
+			self.builtBefore = self.vtkPointCloud.getStats()["built"]
 			self.vtkPointCloud.addPoints(pointCloudData)
+			trace = takeCloudTrace()
+			if(trace is not None):
+				trace.mark("addPoints")
+				self.buildingTrace = trace
 		return returnValidImage(None, (1, 1))
 	
+	def Subscribe(self):
+		if(not self.subscribed):
+			self.subscribed = True
+			addPointCloudListener(self.OnDataReady)
+	
+	def Unsubscribe(self):
+		if(self.subscribed):
+			self.subscribed = False
+			removePointCloudListener(self.OnDataReady)
+	
 	def newDataButtonPushed(self, event):
 		print "New images sent to ROS."
-		self.timer.Start()
-		dimensions = (getCalibrationWidth(), getCalibrationHeight())
-		calibrationInfo = (getLeftCalibration(), getRightCalibration())
-		data = sendDataToROS(getFrames(self.Cams), dimensions, calibrationInfo)
+		self.SendNewData()
+	
+	def FusionToggled(self, event):
+		if(self.fusionToggle.GetValue()):
+			self.vtkPointCloud.setFusion(VoxelMap(maxVoxels=self.vtkPointCloud.maxNumPoints))
+		else:
+			self.vtkPointCloud.setFusion(None)
+	
+	def ShowLodStats(self, stats):
+		if((time.time() - self.lastLodUpdate < 0.25) or (stats["level"] is None)):
+			return
+		self.lastLodUpdate = time.time()
+		label = "Level %d of %d: %d of %d points, %.1f ms a frame%s" % (stats["level"], len(stats["levels"]) - 1,
+			stats["shown"], stats["pointsIn"], stats["meanFrameMs"] or 0, " (moving)" if stats["interacting"] else "")
+		fusion = stats["fusion"]
+		if(fusion is not None):
+			label += ", %d captures fused into %d voxels, %d changed by the last" % (fusion["frames"], fusion["voxels"], fusion["changed"])
+		self.lodLabel.SetLabel(label)
+	
+	def CloudShown(self, stats):
+		if((self.buildingTrace is not None) and (stats["built"] > self.builtBefore)):
+			(self.pendingTrace, self.buildingTrace) = (self.buildingTrace, None)
+			self.pendingTrace.mark("levels")
+			self.FinishTrace()
 	
 	def Destroy(self):
+		self.vtkPointCloud.removeListener(self.ShowLodStats)
+		self.vtkPointCloud.removeListener(self.CloudShown)
+		self.vtkPointCloud.close()
 		destroyPointCloud()
 		super(PointCloud, self).Destroy()
 
 class Calibration(VideoFeed):
 	CalibrationEnded, EVT_CALIBRATION_ENDED = wx.lib.newevent.NewEvent()
 	
-	def __init__(self, parent, cams, pool, camNo, fps=30, tolerance=10):
+	def __init__(self, parent, cams, camNo, fps=30):
 		
 		self.fps = fps
-		# tolerance is how long the calibration should wait for cv2.findChessboardCorners
-		# Larger tolerance means for more laggy video stream but easier to find corners.
-		self.tolerance = tolerance
 		self.steps = 0
 		self.Left = (camNo == 0)
 		self.__init = False
 		
-		# termination criteria
-		self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
 		self.patternSize = (9,6)
 
 		# prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
@@ -220,7 +434,10 @@ class Calibration(VideoFeed):
 		self.objPoints = [] # 3d point in real world space
 		self.imgPoints = [] # 2d points in image plane.
 		
-		self.pool = pool
+		# Corners are searched for on worker threads, results are collected as they arrive
+		self.detector = None
+		self.lastCorners = None
+		self.display = None
 		
 		super(Calibration, self).__init__(parent, cams, fps)
 		
@@ -248,40 +465,53 @@ class Calibration(VideoFeed):
 		self.mainSizer.Prepend(panel, flag=wx.EXPAND)
 		self.Layout()
 	
-	def GetImage(self):
-		image = returnValidImage(getFrame(self.Cams), (getWidth(), getHeight()) )
+	def GetImage(self, rgb=False):
+		frame = returnValidImage(getFrame(self.Cams), (getWidth(), getHeight()) )
+		image = frame
+		if(rgb):
+			# Converted into a buffer of our own, the corners are drawn on it rather than on the camera frame
+			if((self.display is None) or (self.display.shape != frame.shape)):
+				self.display = np.empty_like(frame)
+			image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, self.display)
 		
 		if(self.__init and self.searchingToggle.GetValue()):
 			
-			ret = False
-			gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+			gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 			
-			# Find the chess board corners
-			result = self.pool.apply_async(cv2.findChessboardCorners, (gray, self.patternSize, None))
-			try:
-				ret, corners = result.get(timeout=self.tolerance/float(self.fps))
-			except:
-				pass
-
-			# If found, add object points, image points (after refining them)
+			if((self.detector is None) or (self.detector.shape != gray.shape)):
+				self.StopDetector()
+				self.detector = ChessboardDetector(gray.shape, self.patternSize)
 			
-			if ret == True:
-				self.steps += 1
-				
-				self.UpdateLabel()
+			# Never waits, the frame is skipped if the workers are all busy
+			self.detector.submit(gray)
+			
+			# Add object points and image points for every new board position found
+			for (frameNumber, corners) in self.detector.poll():
+				if(not self.searchingToggle.GetValue()):
+					break
+				if(not isNewPose(corners, self.imgPoints, (gray.shape[1], gray.shape[0]))):
+					continue
 				
+				self.steps += 1
 				self.objPoints.append(self.objp)
-
-				cv2.cornerSubPix(gray, corners, (11,11), (-1,-1), self.criteria)
 				self.imgPoints.append(corners)
-
-				# Draw and display the corners
-				cv2.drawChessboardCorners(image, self.patternSize, corners, ret)
+				self.lastCorners = corners
+				
+				self.UpdateLabel()
+			
+			# Draw and display the corners
+			if(self.lastCorners is not None):
+				cv2.drawChessboardCorners(image, self.patternSize, self.lastCorners, True)
 		
 		self.__init = True
 		
 		return image
 	
+	def StopDetector(self):
+		if(self.detector is not None):
+			self.detector.stop()
+			self.detector = None
+	
 	def ToggleChanged(self, event):
 		self.__UpdateCalibrationButtonBackground()
 	
@@ -294,6 +524,7 @@ class Calibration(VideoFeed):
 		self.stepsLabel.SetLabel("Captured Corners: " + str(step))
 		if(step >= 10):
 			self.searchingToggle.SetValue(False)
+			self.StopDetector()
 			
 			if(self.Left):
 				calibrateLeft(self.objPoints, self.imgPoints)
@@ -306,6 +537,8 @@ class Calibration(VideoFeed):
 	
 	def CancelCalibration(self, event):
 		
+		self.StopDetector()
+		
 		evt = self.CalibrationEnded()
 		self.GetEventHandler().ProcessEvent(evt)
 		
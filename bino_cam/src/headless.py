@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+import argparse
+import cv2
+from camera_functions import getFrames, getCalibrationContext, setCameraResolutions16x9, openSavedStereoCalibration, sideBySide, redGreen, correctedSideBySide
+from stereo_capture import StereoCapture
+from frame_sources import openStereoSource, REALTIME, FAST
+from latency_trace import tracer
+
+# The same stages the GUI runs, chained as generators so they can run without a display.
+# Nothing here imports wx or VTK, and rospy is only imported for the depth mode and the ros sink.
+
+modes = ["side-by-side", "red-green", "corrected", "depth"]
+sinks = ["null", "file", "ros"]
+
+def capture(cams, rate=None):
+	# (timestamp, (left, right)) for every new pair, at most rate pairs a second
+	interval = 1.0/rate if rate else 0
+	ready = threading.Event()
+	listener = lambda timestamp: ready.set()
+	cams.addListener(listener)
+	nextTime = time.time()
+	try:
+		while(True):
+			ready.wait(1.0)
+			ready.clear()
+			frames = getFrames(cams)
+			if((frames[0] is None) or (frames[1] is None)):
+				continue
+			yield (time.time(), frames)
+
+			nextTime += interval
+			wait = nextTime - time.time()
+			if(wait > 0):
+				time.sleep(wait)
+			else:
+				nextTime = time.time()
+	finally:
+		cams.removeListener(listener)
+
+def composite(stream, mode, distance=0, reuse=False):
+	# The views draw into one canvas each, so every image is copied out of it unless reuse is set.
+	# With reuse the canvas itself is yielded and only holds the image until the next one is asked for,
+	# for sinks that are done with an image before they return.
+	for (timestamp, frames) in stream:
+		if(mode == "side-by-side"):
+			image = sideBySide(frames)
+		elif(mode == "red-green"):
+			image = redGreen(distance, frames)
+		else:
+			image = correctedSideBySide(frames, getCalibrationContext())
+		yield (timestamp, image if reuse else image.copy())
+
+def depthMaps(stream, hotNear=False, colormap=None, timeout=10.0, quality="full", source=None):
+	# Publishes every pair to the matcher and waits for its point cloud before taking the next one.
+	# quality picks the transport the pairs go out with, see ros_functions.setTransport, and
+	# source whether clouds come from getPointCloud or are reprojected from the disparities here.
+	from ros_functions import initializePointCloud, sendDataToROS, getDataFromROS, constructDepthMapImage, addPointCloudListener, removePointCloudListener, takeCloudTrace
+	initializePointCloud(source=source)
+	arrived = threading.Event()
+	listener = lambda timestamp: arrived.set()
+	addPointCloudListener(listener)
+	try:
+		for (timestamp, frames) in stream:
+			# Traced from the moment the pair was captured
+			trace = tracer.begin(timestamp)
+			trace.mark("getFrames")
+			arrived.clear()
+			if(sendDataToROS(frames, getCalibrationContext(), trace, quality) is None):
+				# The buffer still holds a cloud that came in after its wait timed out, nobody is going
+				# to show it, so it is dropped to make room and the pair is sent again
+				__dropStaleCloud()
+				if(sendDataToROS(frames, getCalibrationContext(), trace, quality) is None):
+					continue
+			if(not arrived.wait(timeout)):
+				print "No point cloud received within %.1fs" % timeout
+				__dropStaleCloud()
+				continue
+			(maxDist, points) = getDataFromROS()
+			image = constructDepthMapImage(hotNear, maxDist, points, colormap)
+			trace = takeCloudTrace()
+			if(trace is not None):
+				trace.mark("depthImage")
+				tracer.finish(trace)
+			yield (timestamp, image)
+	finally:
+		removePointCloudListener(listener)
+
+def run(stream, sink, frames=None, reportEvery=5.0):
+	# Drains the pipeline into sink, returns (frames, seconds)
+	count = 0
+	start = time.time()
+	lastReport = start
+	latency = 0.0
+	try:
+		for (timestamp, image) in stream:
+			sink(image)
+			count += 1
+			latency += time.time() - timestamp
+
+			now = time.time()
+			if(now - lastReport >= reportEvery):
+				print "%d frames, %.1f fps, %.1f ms from capture to sink" % (count, count/(now - start), 1000*latency/count)
+				lastReport = now
+			if((frames is not None) and (count >= frames)):
+				break
+	except KeyboardInterrupt:
+		pass
+	return (count, time.time() - start)
+
+#----------------------------------------------------------------------------------#
+
+def __dropStaleCloud():
+	# Takes whatever cloud is waiting in the buffer without showing it
+	from ros_functions import getDataFromROS, takeCloudTrace
+	getDataFromROS()
+	takeCloudTrace()
+
+def __nullSink(image):
+	pass
+
+def __fileSink(folder):
+	if(not os.path.isdir(folder)):
+		os.makedirs(folder)
+	counter = [0]
+	def write(image):
+		cv2.imwrite(os.path.join(folder, "frame-%06d.png" % counter[0]), image)
+		counter[0] += 1
+	return write
+
+def __rosSink(topic):
+	import rospy
+	from ros_functions import constructROSImage
+	from sensor_msgs.msg import Image
+	publisher = rospy.Publisher(topic, Image, queue_size=1)
+	def publish(image):
+		publisher.publish(constructROSImage(image, rospy.Time.now()))
+	return publish
+
+####################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Run the bino_cam pipelines without the GUI")
+	parser.add_argument("--mode", choices=modes, default="side-by-side")
+	parser.add_argument("--rate", type=float, default=None, help="maximum pairs a second, defaults to as fast as the cameras deliver")
+	parser.add_argument("--sink", choices=sinks, default="null")
+	parser.add_argument("--output", default=None, help="folder for the file sink, topic for the ros sink")
+	parser.add_argument("--frames", type=int, default=None, help="stop after this many frames")
+	parser.add_argument("--source", default="live:4,5", help="live:<left>,<right>, a recording or a folder of PNG pairs")
+	parser.add_argument("--replay", choices=[REALTIME, FAST], default=REALTIME, help="pace of recorded sources")
+	parser.add_argument("--loop", action="store_true", help="start recorded sources over when they end")
+	parser.add_argument("--height", type=int, default=720, help="camera resolution, the width follows 16:9")
+	parser.add_argument("--calibration", default=None, help="stereo calibration for the corrected and depth modes")
+	parser.add_argument("--distance", type=int, default=0, help="offset of the red-green view")
+	parser.add_argument("--hot-near", action="store_true")
+	parser.add_argument("--profile", default=None, help="write the per stage latency of the depth mode to this file on exit")
+	parser.add_argument("--quality", choices=["full", "preview"], default="full", help="CamerasSync quality the depth mode requests")
+	parser.add_argument("--transport", choices=["raw", "jpeg", "png"], default=None, help="encoding the depth mode sends pairs with, jpeg and png go to a matcher subscribed through the compressed transport")
+	parser.add_argument("--pyramid", type=int, default=None, help="halve the pairs sent to the matcher this many times")
+	parser.add_argument("--reproject", action="store_true", help="build clouds from the matcher's disparities instead of waiting for getPointCloud")
+	parser.add_argument("--archive", default=None, help="also write every cloud the depth mode receives to this archive, see cloud_archive")
+	args = parser.parse_args()
+
+	if((args.mode == "depth") or (args.sink == "ros")):
+		import rospy
+		rospy.init_node("camera_headless", anonymous=True)
+
+	cams = StereoCapture(openStereoSource(args.source, args.replay, args.loop))
+	setCameraResolutions16x9(cams, args.height)
+	if(args.calibration is not None):
+		openSavedStereoCalibration(args.calibration)
+	cams.start()
+
+	stream = capture(cams, args.rate)
+	if(args.mode == "depth"):
+		if((args.transport is not None) or (args.pyramid is not None)):
+			from ros_functions import setTransport, getTransport
+			(encoding, levels) = getTransport(args.quality)
+			setTransport(args.quality, args.transport or encoding, levels if args.pyramid is None else args.pyramid)
+		if(args.archive is not None):
+			from ros_functions import startCloudArchive
+			startCloudArchive(args.archive)
+		stream = depthMaps(stream, args.hot_near, quality=args.quality, source="disparity" if args.reproject else None)
+	else:
+		# Every sink here has written or copied the image by the time run() takes the next one
+		stream = composite(stream, args.mode, args.distance, reuse=True)
+
+	if(args.sink == "file"):
+		sink = __fileSink(args.output or "headless_output")
+	elif(args.sink == "ros"):
+		sink = __rosSink(args.output or "bino_cam/output_image")
+	else:
+		sink = __nullSink
+
+	try:
+		(count, seconds) = run(stream, sink, args.frames)
+	finally:
+		stream.close()
+		if(args.mode == "depth"):
+			from ros_functions import destroyPointCloud, stopCloudArchive
+			destroyPointCloud()
+			archived = stopCloudArchive()
+			if(archived is not None):
+				print "%d clouds archived to %s, %d dropped" % (archived["written"], args.archive, archived["dropped"])
+		cams.release()
+		if(args.profile is not None):
+			tracer.dump(args.profile)
+
+	if(seconds > 0):
+		print "%d frames in %.2fs, %.1f fps" % (count, seconds, count/seconds)
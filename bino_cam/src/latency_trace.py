@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import json
+import time
+import threading
+from collections import deque, OrderedDict
+
+# Follows one stereo pair from capture to the image on screen. Each stage marks the time it
+# finished, so a trace holds how long every step took, keyed by the CamerasSync.timeStamp the
+# pair was published with. Marking is a time.time() and a list append, cheap enough to leave on.
+
+class Trace(object):
+
+	def __init__(self, start=None):
+		self.id = None
+		self.start = time.time() if start is None else start
+		self.marks = []
+
+	def mark(self, stage):
+		self.marks.append((stage, time.time()))
+
+	def durations(self):
+		# [(stage, seconds since the previous mark)]
+		result = []
+		previous = self.start
+		for (stage, t) in self.marks:
+			result.append((stage, t - previous))
+			previous = t
+		return result
+
+	def total(self):
+		if(len(self.marks) == 0):
+			return 0.0
+		return self.marks[-1][1] - self.start
+
+	def describe(self):
+		parts = ["%s %.0fms" % (stage, 1000*seconds) for (stage, seconds) in self.durations()]
+		return " | ".join(parts + ["total %.0fms" % (1000*self.total())])
+
+class LatencyTracer(object):
+
+	def __init__(self, history=200, maxInFlight=20):
+		self.lock = threading.Lock()
+		self.inFlight = OrderedDict()
+		self.maxInFlight = maxInFlight
+		self.completed = deque(maxlen=history)
+		self.stages = OrderedDict()
+		self.lost = 0
+		self.listeners = []
+
+	def begin(self, start=None):
+		return Trace(start)
+
+	def sent(self, trace, stamp):
+		# The pair has gone to the matcher, its cloud will be matched back with claim()
+		trace.id = stamp
+		with self.lock:
+			self.inFlight[stamp] = trace
+			while(len(self.inFlight) > self.maxInFlight):
+				self.inFlight.popitem(last=False)
+				self.lost += 1
+
+	def claim(self, stamp=None):
+		# The trace a newly arrived cloud belongs to. getPointCloud doesn't pass the stamp on yet,
+		# so without one the oldest request still waiting is taken.
+		with self.lock:
+			if((stamp is not None) and (stamp in self.inFlight)):
+				return self.inFlight.pop(stamp)
+			if(len(self.inFlight) > 0):
+				return self.inFlight.popitem(last=False)[1]
+			return None
+
+	def finish(self, trace):
+		with self.lock:
+			for (stage, seconds) in trace.durations() + [("total", trace.total())]:
+				stats = self.stages.get(stage)
+				if(stats is None):
+					stats = self.stages[stage] = {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+				stats["count"] += 1
+				stats["sum"] += seconds
+				stats["max"] = max(stats["max"], seconds)
+				stats["last"] = seconds
+			self.completed.append(trace)
+		for listener in list(self.listeners):
+			listener(trace)
+
+	def addListener(self, callback):
+		# callback(trace) for every finished trace, on the thread that finished it
+		if(callback not in self.listeners):
+			self.listeners.append(callback)
+
+	def removeListener(self, callback):
+		if(callback in self.listeners):
+			self.listeners.remove(callback)
+
+	def getStats(self):
+		# {stage: {count, mean_ms, max_ms, last_ms}} in the order the stages happen
+		with self.lock:
+			result = OrderedDict()
+			for (stage, stats) in self.stages.items():
+				result[stage] = {
+					"count": stats["count"],
+					"mean_ms": 1000*stats["sum"]/stats["count"],
+					"max_ms": 1000*stats["max"],
+					"last_ms": 1000*stats["last"],
+				}
+			return result
+
+	def dump(self, filename):
+		# Summary and every recent trace as JSON
+		with self.lock:
+			traces = [{"stamp": trace.id, "start": trace.start, "stages": [[stage, 1000*seconds] for (stage, seconds) in trace.durations()]} for trace in self.completed]
+			lost = self.lost
+		f = open(filename, 'w')
+		json.dump({"stats": self.getStats(), "lost": lost, "traces": traces}, f, indent=1)
+		f.close()
+
+# Shared by the GUI, ros_functions and the headless runner
+tracer = LatencyTracer()
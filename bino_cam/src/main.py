@@ -5,19 +5,22 @@ import roslib
 import cv2
 import wx
 import wx.lib.scrolledpanel
-from multiprocessing import Pool
 from camera_functions import setCameraResolutions16x9, openSavedCalibration, openSavedStereoCalibration, saveCalibration
+from stereo_capture import StereoCapture
+from frame_sources import openStereoSource
+from latency_trace import tracer
+from ros_functions import startCloudArchive, stopCloudArchive, showArchivedCloud
+from cloud_archive import RecordedClouds
 from gui_video import *
 
 displayOptions = ["Side by side", "Red-Green", "Corrected Side By Side", "Depth Map", "Point Cloud"]
 
 class MainWindow(wx.Frame):
-	def __init__(self, parent, title, processPool):
-				
-		self.pool = processPool
+	def __init__(self, parent, title, source="live:4,5"):
 		
-		self.Cams = (cv2.VideoCapture(4), cv2.VideoCapture(5))
+		self.Cams = StereoCapture(openStereoSource(source, loop=True))
 		setCameraResolutions16x9(self.Cams, 720)
+		self.Cams.start()
 		
 		wx.Frame.__init__(self, parent, title=title)
 		
@@ -56,6 +59,9 @@ class MainWindow(wx.Frame):
 		filemenu = wx.Menu()
 		# wx.ID_ABOUT and wx.ID_EXIT are standard ids provided by wxWidgets.
 		menuAbout = filemenu.Append(wx.ID_ABOUT, "&About"," Information about this program")
+		menuProfile = filemenu.Append(wx.ID_ANY, "Save &latency profile"," Time taken by every stage from capture to depth map")
+		self.menuRecordClouds = filemenu.AppendCheckItem(wx.ID_ANY, "&Record point clouds"," Write every point cloud received to an archive")
+		menuOpenClouds = filemenu.Append(wx.ID_ANY, "Open point cloud &archive"," Show the last cloud of an archive in the depth map and point cloud views")
 		menuExit = filemenu.Append(wx.ID_EXIT,"&Exit"," Terminate the program")
 		
 		calibrationMenu = wx.Menu()
@@ -85,6 +91,9 @@ class MainWindow(wx.Frame):
 		# Set events.
 		self.Bind(wx.EVT_MENU, self.OnAbout, menuAbout)
 		self.Bind(wx.EVT_MENU, self.OnExit, menuExit)
+		self.Bind(wx.EVT_MENU, self.SaveLatencyProfile, menuProfile)
+		self.Bind(wx.EVT_MENU, self.RecordClouds, self.menuRecordClouds)
+		self.Bind(wx.EVT_MENU, self.OpenCloudArchive, menuOpenClouds)
 		self.Bind(wx.EVT_MENU, self.StartCalibration, calibrate0)
 		self.Bind(wx.EVT_MENU, self.StartCalibration, calibrate1)
 		self.Bind(wx.EVT_MENU, self.OpenCalibration, openCalibrate0)
@@ -142,18 +151,53 @@ class MainWindow(wx.Frame):
 			self.depthMap.Destroy()
 		if(hasattr(self, "pointCloud")):
 			self.pointCloud.Destroy()
-		self.Cams[0].release()
-		self.Cams[1].release()
+		stopCloudArchive()
+		self.Cams.release()
 		self.Close(True)  # Close the frame.
 		wx.GetApp().ExitMainLoop()
 	
+	def SaveLatencyProfile(self, event):
+		saveFileDialog = wx.FileDialog(self, "Save latency profile", "", "latency.json", "Latency profiles (*.json)|*.json", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+		
+		if saveFileDialog.ShowModal() == wx.ID_CANCEL:
+			return
+		
+		tracer.dump(saveFileDialog.GetPath())
+	
+	def RecordClouds(self, event):
+		if(not self.menuRecordClouds.IsChecked()):
+			stats = stopCloudArchive()
+			if(stats is not None):
+				print "%d point clouds archived, %d dropped" % (stats["written"], stats["dropped"])
+			return
+		
+		saveFileDialog = wx.FileDialog(self, "Record point clouds", "", "clouds.bin", "Point cloud archives (*.bin)|*.bin", wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+		
+		if saveFileDialog.ShowModal() == wx.ID_CANCEL:
+			self.menuRecordClouds.Check(False)
+			return
+		
+		startCloudArchive(saveFileDialog.GetPath())
+	
+	def OpenCloudArchive(self, event):
+		openFileDialog = wx.FileDialog(self, "Open point cloud archive", "", "", "Point cloud archives (*.bin)|*.bin", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+		
+		if openFileDialog.ShowModal() == wx.ID_CANCEL:
+			return
+		
+		# Kept open, the views read the memory mapped cloud for as long as they show it
+		self.cloudArchive = RecordedClouds(openFileDialog.GetPath())
+		if(len(self.cloudArchive) > 0):
+			showArchivedCloud(self.cloudArchive.cloud(len(self.cloudArchive) - 1))
+		print "%d point clouds in %s" % (len(self.cloudArchive), openFileDialog.GetPath())
+	
 	def StartCalibration(self, event):
 		self.combo.Show(False)
 		self.sideBySide.Show(False)
 		self.redGreen.Show(False)
 		self.correctedSideBySide.Show(False)
 		
-		self.calibrationFeed = Calibration(self.panel, self.Cams[event.Id-1], self.pool, event.Id-1)
+		self.calibrationFeed = Calibration(self.panel, self.Cams[event.Id-1], event.Id-1)
 		self.calibrationFeed.Bind(Calibration.EVT_CALIBRATION_ENDED, self.EndCalibration)
 		
 		mainSizer = self.panel.GetSizer()
@@ -169,7 +213,7 @@ class MainWindow(wx.Frame):
 		self.sideBySide.Show(True)
 	
 	def OpenCalibration(self, event):
-		openFileDialog = wx.FileDialog(self, "Open saved calibration", "", "","Calibration files (*.txt)|*.txt|Calibration files (*.ini)|*.ini", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+		openFileDialog = wx.FileDialog(self, "Open saved calibration", "", "","Calibration files (*.txt)|*.txt|Calibration files (*.ini)|*.ini|OpenCV calibration files (*.xml)|*.xml|Compiled calibration files (*.npz)|*.npz", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
 		
 		if openFileDialog.ShowModal() == wx.ID_CANCEL:
 			return	# the user changed idea...
@@ -180,7 +224,7 @@ class MainWindow(wx.Frame):
 		self.Refresh()
 	
 	def OpenStereoCalibration(self, event):
-		openFileDialog = wx.FileDialog(self, "Open saved calibration", "", "","Calibration files (*.txt)|*.txt|Calibration files (*.ini)|*.ini", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+		openFileDialog = wx.FileDialog(self, "Open saved calibration", "", "","Calibration files (*.txt)|*.txt|Calibration files (*.ini)|*.ini|OpenCV calibration files (*.xml)|*.xml|Compiled calibration files (*.npz)|*.npz", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
 		
 		if openFileDialog.ShowModal() == wx.ID_CANCEL:
 			return	# the user changed idea...
@@ -203,8 +247,9 @@ class MainWindow(wx.Frame):
 
 if __name__ == '__main__':
 	rospy.init_node("camera_gui", anonymous=True)
-	processPool = Pool()
+	# Optional frame source, live:<left>,<right>, a recording or a folder of PNG pairs
+	argv = rospy.myargv()
 	app = wx.App(False)
-	frame = MainWindow(None, "Binocular Algorithm Example", processPool)
+	frame = MainWindow(None, "Binocular Algorithm Example", argv[1] if len(argv) > 1 else "live:4,5")
 	frame.SetSize((900,700))
 	app.MainLoop()
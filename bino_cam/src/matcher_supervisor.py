@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+import os
+import time
+import atexit
+import signal
+import threading
+import subprocess
+import rospy
+
+# Keeps one warm matcher for the whole session, shared by every view that needs point clouds.
+# A spare is started in the other namespace together with it and kept warm there. The matcher
+# leaks, so its memory is watched and once it has grown too much traffic is switched over to the
+# spare, the old one is stopped and a new spare started in its place. Requests never wait for a
+# matcher to start, nor for one to be restarted.
+
+class MatcherSupervisor(object):
+
+	def __init__(self, command=("roslaunch", "bino_cam", "matcher_nodes.launch"), namespaces=("matcher_a", "matcher_b"),
+			rssGrowthLimit=512*1024, vramGrowthLimit=256*1024, checkInterval=5.0, startTimeout=60.0):
+		# Growth limits in kB above the memory the matcher used after its first result
+		self.command = list(command)
+		self.namespaces = namespaces
+		self.rssGrowthLimit = rssGrowthLimit
+		self.vramGrowthLimit = vramGrowthLimit
+		self.checkInterval = checkInterval
+		self.startTimeout = startTimeout
+		self.lock = threading.Lock()
+		self.users = 0
+		self.active = None
+		self.spare = None
+		self.recycling = False
+		self.listeners = []
+		self.monitor = None
+		self.stopping = threading.Event()
+		self.served = 0
+		self.recycles = 0
+		self.lastSample = None
+		self.imageTransport = "raw"
+
+	def acquire(self):
+		# Namespace the matcher's topics live in, the matcher is started by the first caller
+		with self.lock:
+			self.users += 1
+			if(self.active is None):
+				self.active = self.__start(self.namespaces[0])
+				atexit.register(self.shutdown)
+			if(self.spare is None):
+				self.spare = self.__start(self.__spareNamespace())
+			if(self.monitor is None):
+				self.stopping.clear()
+				self.monitor = threading.Thread(target=self.__monitorLoop)
+				self.monitor.daemon = True
+				self.monitor.start()
+			return self.active["namespace"]
+
+	def release(self):
+		# The matcher stays warm for the next view, shutdown() stops it
+		with self.lock:
+			self.users = max(0, self.users - 1)
+
+	def shutdown(self):
+		self.stopping.set()
+		with self.lock:
+			matchers = [matcher for matcher in (self.active, self.spare) if matcher is not None]
+			self.active = None
+			self.spare = None
+			self.monitor = None
+		for matcher in matchers:
+			self.__stop(matcher)
+
+	def namespace(self):
+		with self.lock:
+			return None if self.active is None else self.active["namespace"]
+
+	def resultServed(self):
+		# Called for every cloud the active matcher delivers, the first one sets the memory baseline
+		with self.lock:
+			self.served += 1
+			if(self.active is not None):
+				self.active["served"] += 1
+
+	def addListener(self, callback):
+		# callback(namespace) once traffic should go to a new matcher, on the monitor thread
+		if(callback not in self.listeners):
+			self.listeners.append(callback)
+
+	def removeListener(self, callback):
+		if(callback in self.listeners):
+			self.listeners.remove(callback)
+
+	def recycle(self):
+		# Switches traffic to the spare once its topics are up, stops the old matcher and warms a
+		# new spare in its namespace. The spare has usually been up since the active one started.
+		with self.lock:
+			if((self.active is None) or self.recycling):
+				return False
+			self.recycling = True
+			spare = self.spare
+		try:
+			if((spare is None) or (spare["process"].poll() is not None) or (spare["imageTransport"] != self.imageTransport)):
+				# Nothing warm to switch to, this one has to be waited for
+				spare = self.__warmSpare(spare)
+				if(spare is None):
+					return False
+
+			deadline = time.time() + self.startTimeout
+			while(not self.__ready(spare)):
+				if(self.stopping.is_set() or (spare["process"].poll() is not None) or (time.time() > deadline)):
+					print "Spare matcher in /%s did not come up, keeping the current one" % spare["namespace"]
+					with self.lock:
+						if(self.spare is spare):
+							self.spare = None
+					self.__stop(spare)
+					return False
+				time.sleep(0.5)
+
+			with self.lock:
+				if(self.spare is not spare):
+					return False
+				old = self.active
+				self.active = spare
+				self.spare = None
+				self.recycles += 1
+			for listener in list(self.listeners):
+				listener(spare["namespace"])
+			self.__stop(old)
+			self.__warmSpare()
+			return True
+		finally:
+			with self.lock:
+				self.recycling = False
+
+	def setImageTransport(self, transport):
+		# "raw" or "compressed", how matchers subscribe to the pairs. A running matcher is replaced
+		# by one subscribed the new way in the background, see recycle().
+		with self.lock:
+			if(transport == self.imageTransport):
+				return
+			self.imageTransport = transport
+			running = self.active is not None
+		if(running):
+			thread = threading.Thread(target=self.recycle)
+			thread.daemon = True
+			thread.start()
+
+	def getStats(self):
+		# Namespace, pid, users, results served, recycles, the spare's namespace and the last memory sample in kB
+		with self.lock:
+			active = self.active
+			spare = self.spare
+			stats = {"users": self.users, "served": self.served, "recycles": self.recycles, "spare": None if spare is None else spare["namespace"]}
+			if(active is not None):
+				stats.update({"namespace": active["namespace"], "pid": active["process"].pid, "baseline": active["baseline"]})
+			stats["memory"] = self.lastSample
+			return stats
+
+	#----------------------------------------------------------------------------------#
+
+	def __start(self, namespace):
+		environment = dict(os.environ)
+		environment["ROS_NAMESPACE"] = rospy.get_namespace() + namespace
+		# Read by image_transport::TransportHints in the matcher and getPointCloud, and by the CPU matcher
+		rospy.set_param(environment["ROS_NAMESPACE"] + "/image_transport", self.imageTransport)
+		process = subprocess.Popen(self.command, env=environment)
+		print "Matcher started in /%s (pid %d, %s transport)" % (namespace, process.pid, self.imageTransport)
+		return {"namespace": namespace, "process": process, "started": time.time(), "served": 0, "baseline": None, "imageTransport": self.imageTransport}
+
+	def __stop(self, matcher):
+		process = matcher["process"]
+		if(process.poll() is None):
+			process.send_signal(signal.SIGINT)
+			deadline = time.time() + 10
+			while((process.poll() is None) and (time.time() < deadline)):
+				time.sleep(0.1)
+			if(process.poll() is None):
+				process.kill()
+		print "Matcher in /%s stopped" % matcher["namespace"]
+
+	def __spareNamespace(self):
+		return [ns for ns in self.namespaces if ns != self.active["namespace"]][0]
+
+	def __warmSpare(self, old=None):
+		# Replaces old, a spare that died or subscribes the wrong way, or fills an empty spare slot.
+		# The old spare is stopped first, the new one starts in the same namespace.
+		if(old is not None):
+			self.__stop(old)
+		with self.lock:
+			if((self.active is None) or (self.spare is not old)):
+				return self.spare
+			self.spare = self.__start(self.__spareNamespace())
+			return self.spare
+
+	def __ready(self, matcher):
+		# Both the matcher and getPointCloud have advertised their outputs
+		prefix = rospy.get_namespace() + matcher["namespace"] + "/"
+		try:
+			topics = [name for (name, kind) in rospy.get_published_topics(prefix)]
+		except Exception:
+			return False
+		return (prefix + "output_disparityH" in topics) and (prefix + "output_pointcloud" in topics)
+
+	def __monitorLoop(self):
+		while(not self.stopping.wait(self.checkInterval)):
+			with self.lock:
+				matcher = self.active
+				spare = self.spare
+				recycling = self.recycling
+			if(matcher is None):
+				continue
+			if((not recycling) and ((spare is None) or (spare["process"].poll() is not None))):
+				if(spare is not None):
+					print "Spare matcher in /%s exited, starting a new one" % spare["namespace"]
+				self.__warmSpare(spare)
+
+			if(matcher["process"].poll() is not None):
+				print "Matcher in /%s exited, starting a new one" % matcher["namespace"]
+				self.recycle()
+				continue
+			if(matcher["imageTransport"] != self.imageTransport):
+				# The transport changed while a spare with the old one was already starting
+				self.recycle()
+				continue
+
+			sample = memoryUsage(matcher["process"].pid)
+			self.lastSample = sample
+			if(matcher["served"] == 0):
+				continue
+			if(matcher["baseline"] is None):
+				matcher["baseline"] = sample
+				continue
+
+			if(self.__leaking(matcher["baseline"], sample)):
+				print "Matcher in /%s grew from %d to %d kB, recycling it" % (matcher["namespace"], matcher["baseline"]["rss"], sample["rss"])
+				self.recycle()
+
+	def __leaking(self, baseline, sample):
+		if(sample["rss"] - baseline["rss"] > self.rssGrowthLimit):
+			return True
+		if((sample["vram"] is not None) and (baseline["vram"] is not None)):
+			return sample["vram"] - baseline["vram"] > self.vramGrowthLimit
+		return False
+
+#----------------------------------------------------------------------------------#
+
+def processTree(pid):
+	# pid and every process below it, roslaunch runs the nodes as its children
+	children = {}
+	for entry in os.listdir("/proc"):
+		if(not entry.isdigit()):
+			continue
+		try:
+			f = open("/proc/%s/stat" % entry)
+			stat = f.read()
+			f.close()
+		except IOError:
+			continue
+		# The command name can hold spaces, the parent pid is the second field after it
+		parent = int(stat[stat.rindex(")") + 2:].split()[1])
+		children.setdefault(parent, []).append(int(entry))
+
+	tree = [pid]
+	for process in tree:
+		tree.extend(children.get(process, []))
+	return tree
+
+def memoryUsage(pid):
+	# {"rss": kB, "vram": kB or None without nvidia-smi} summed over the process tree
+	pids = processTree(pid)
+	rss = 0
+	for process in pids:
+		try:
+			f = open("/proc/%d/status" % process)
+			for line in f:
+				if(line.startswith("VmRSS:")):
+					rss += int(line.split()[1])
+			f.close()
+		except IOError:
+			pass
+	return {"rss": rss, "vram": gpuMemory(pids)}
+
+def gpuMemory(pids):
+	try:
+		output = subprocess.check_output(["nvidia-smi", "--query-compute-apps=pid,used_memory", "--format=csv,noheader,nounits"])
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	used = 0
+	for line in output.splitlines():
+		fields = [field.strip() for field in line.split(",")]
+		if((len(fields) == 2) and fields[0].isdigit() and (int(fields[0]) in pids)):
+			used += int(fields[1])*1024
+	return used
+
+# Shared by every view in the process
+supervisor = MatcherSupervisor()
@@ -2,160 +2,526 @@
 
 import rospy
 import roslib
+import message_filters
 from math import sqrt
 import numpy as np
-import subprocess
-import signal
-from cv_bridge import CvBridge, CvBridgeError
+from numpy.lib.stride_tricks import as_strided
+import cv2
+import time
+import copy
 from std_msgs.msg import Header
-from sensor_msgs.msg import Image, CameraInfo, PointCloud2
-import sensor_msgs.point_cloud2 as pc2
+from sensor_msgs.msg import Image, CompressedImage, CameraInfo, PointCloud2, PointField
+from stereo_msgs.msg import DisparityImage
 from ug_stereomatcher.msg import CamerasSync
+from cloud_buffer import CloudBuffer, DROP_OLDEST, LATEST_WINS
+from latency_trace import tracer
+from matcher_supervisor import supervisor
+from cloud_archive import CloudRecorder
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 
-__bridge = CvBridge()
-__proc = None
+__namespace = None
 __pubAcquireImages = None
 __pubImageLeft = None
 __pubImageRight = None
-__imageQueue = []
+__cloudSubscribers = []
+__cloudSource = None
+__sentContext = None
+__cloudBuffer = None
+__cloudListeners = []
 __lastPointCloud = None
+__lastTrace = None
+__cloudArchive = None
+__pubDiagnostics = None
+__lastDiagnostics = 0
 
-def initializePointCloud():
-	global __imageQueue
-	__launchMatcherNode()
-	__imageQueue = []
-	__initializeROSTopics()
-	rospy.Subscriber('output_pointcloud', PointCloud2, __collectPointCloudData)
+# Where clouds come from: getPointCloud's output_pointcloud, or the matcher's disparities
+# reprojected here, which skips getPointCloud and a PointCloud2 round trip
+POINT_CLOUD = "pointcloud"
+DISPARITY = "disparity"
 
-#----------------------------------------------------------------------------------#
+# How a stereo pair travels to the matcher. RAW goes out as sensor_msgs/Image, JPEG and PNG as
+# sensor_msgs/CompressedImage on <topic>/compressed, where image_transport's compressed plugin
+# picks them up. Any of them can be halved in size pyramid levels times first.
+# The matchers subscribe through a single image_transport, set by the supervisor when it starts
+# them, so either every quality goes out RAW or every one compressed. JPEG and PNG can be mixed.
+RAW = "raw"
+JPEG = "jpeg"
+PNG = "png"
+
+# (encoding, pyramid levels) for each CamerasSync.data quality
+__transports = {"full": (RAW, 0), "preview": (RAW, 1)}
+__jpegQuality = 90
+__pngCompression = 1
+
+# numpy types for the sensor_msgs/PointField datatypes
+__pointFieldTypes = {
+	PointField.INT8: 'i1',
+	PointField.UINT8: 'u1',
+	PointField.INT16: 'i2',
+	PointField.UINT16: 'u2',
+	PointField.INT32: 'i4',
+	PointField.UINT32: 'u4',
+	PointField.FLOAT32: 'f4',
+	PointField.FLOAT64: 'f8',
+}
 
-def __launchMatcherNode():
-	global __proc
-	__proc = subprocess.Popen(['roslaunch', 'bino_cam', 'matcher_nodes.launch'])
+# Colour maps offered for the depth map, None keeps the original green only image
+depthMapColormaps = [
+	("Green", None),
+	("Jet", cv2.COLORMAP_JET),
+	("Hot", cv2.COLORMAP_HOT),
+	("Bone", cv2.COLORMAP_BONE),
+	("Rainbow", cv2.COLORMAP_RAINBOW),
+]
 
-def __initializeROSTopics():
-	global __pubAcquireImages, __pubImageLeft, __pubImageRight
-	__pubAcquireImages = rospy.Publisher("acquire_images", CamerasSync, queue_size=10)
-	__pubImageLeft = ( rospy.Publisher("input_left_image", Image, queue_size=30), rospy.Publisher("camera_info_left", CameraInfo, queue_size=30) )
-	__pubImageRight = ( rospy.Publisher("input_right_image", Image, queue_size=30), rospy.Publisher("camera_info_right", CameraInfo, queue_size=30) )
+def initializePointCloud(depth=1, policy=LATEST_WINS, lazy=True, source=None):
+	# depth clouds are kept until the GUI takes them, LATEST_WINS only shows the newest one.
+	# With lazy the raw message is kept and only decoded once it is actually displayed.
+	# source is POINT_CLOUD or DISPARITY, by default the ~cloud_source parameter or POINT_CLOUD.
+	# Every view shares the one matcher the supervisor keeps warm, and the first view's buffer.
+	global __cloudBuffer, __pubDiagnostics, __cloudSource
+	namespace = supervisor.acquire()
+	if(__cloudBuffer is None):
+		__cloudSource = source or rospy.get_param("~cloud_source", POINT_CLOUD)
+		__cloudBuffer = CloudBuffer(depth, policy, __decodeCloud if lazy else None)
+		__pubDiagnostics = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=1)
+		tracer.addListener(__publishDiagnostics)
+		supervisor.addListener(__connectMatcher)
+	if(namespace != __namespace):
+		__connectMatcher(namespace)
+
+#----------------------------------------------------------------------------------#
+
+def __connectMatcher(namespace):
+	# (Re)creates the topics to the matcher in namespace, called again when the supervisor swaps matchers
+	global __namespace, __pubAcquireImages, __pubImageLeft, __pubImageRight, __cloudSubscribers
+	old = [__pubAcquireImages] + __cloudSubscribers + list(__pubImageLeft or ()) + list(__pubImageRight or ())
+	
+	prefix = namespace + "/"
+	__pubAcquireImages = rospy.Publisher(prefix + "acquire_images", CamerasSync, queue_size=10)
+	__pubImageLeft = ( rospy.Publisher(prefix + "input_left_image", Image, queue_size=30), rospy.Publisher(prefix + "camera_info_left", CameraInfo, queue_size=30), rospy.Publisher(prefix + "input_left_image/compressed", CompressedImage, queue_size=30) )
+	__pubImageRight = ( rospy.Publisher(prefix + "input_right_image", Image, queue_size=30), rospy.Publisher(prefix + "camera_info_right", CameraInfo, queue_size=30), rospy.Publisher(prefix + "input_right_image/compressed", CompressedImage, queue_size=30) )
+	if(__cloudSource == DISPARITY):
+		__cloudSubscribers = [message_filters.Subscriber(prefix + "output_disparityH", DisparityImage), message_filters.Subscriber(prefix + "output_disparityV", DisparityImage)]
+		message_filters.TimeSynchronizer(__cloudSubscribers, 5).registerCallback(__collectDisparityData)
+	else:
+		__cloudSubscribers = [rospy.Subscriber(prefix + "output_pointcloud", PointCloud2, __collectPointCloudData)]
+	__namespace = namespace
+	
+	for topic in old:
+		if(topic is not None):
+			topic.unregister()
 
 def __collectPointCloudData(data):
-	global __imageQueue
+	# Runs on the rospy subscriber thread
+	print "PointCloud data received."
+	supervisor.resultServed()
+	trace = tracer.claim(data.header.stamp.to_sec() or None)
+	if(trace is not None):
+		trace.mark("matcher")
+	
+	__archiveCloud(data, data.header.stamp.to_sec(), __sentContext)
+	item = (data, trace)
+	if(__cloudBuffer.decoder is None):
+		item = __decodeCloud(item)
+	__cloudBuffer.put(item)
+	received = time.time()
+	for listener in list(__cloudListeners):
+		listener(received)
+
+def __collectDisparityData(dispH, dispV):
+	# Runs on the rospy subscriber thread. The matcher copies the input header, so the stamp is the pair's.
+	print "Disparities received."
+	supervisor.resultServed()
+	trace = tracer.claim(dispH.header.stamp.to_sec() or None)
+	if(trace is not None):
+		trace.mark("matcher")
 	
-	(maxDist, points) = __extractPointCloudData(data)
+	__archiveCloud((dispH, __sentContext), dispH.header.stamp.to_sec(), __sentContext)
+	item = ((dispH, __sentContext), trace)
+	if(__cloudBuffer.decoder is None):
+		item = __decodeCloud(item)
+	__cloudBuffer.put(item)
+	received = time.time()
+	for listener in list(__cloudListeners):
+		listener(received)
 
-	__imageQueue.append( (maxDist, points) )
+def __archiveCloud(data, stamp, context):
+	# The recorder's thread decodes its own copy, so archiving never holds up the subscriber
+	if(__cloudArchive is not None):
+		__cloudArchive.write(data, stamp or None, None if context is None else context.version, __decodeArchived)
+
+def __decodeArchived(data):
+	return __decodeCloud((data, None))[0]
+
+def __decodeCloud(item):
+	(data, trace) = item
+	if(isinstance(data, tuple)):
+		cloud = __reprojectDisparity(*data)
+	else:
+		cloud = __extractPointCloudData(data)
+	if(trace is not None):
+		trace.mark("decode")
+	return (cloud, trace)
 
 def __extractPointCloudData(data):
-	iterData = pc2.read_points(data)
-	points = []
-	height = sqrt((data.width/float(16))*9)
-	width = 16 * ( height/float(9) )
-	height = int(height)
-	width = int(width)
-	maxDist = 0
-	z = 2
-	print "PointCloud data received."
-	for i in range(width):
-		intermediate = []
-		for j in range(height):
-			point = next(iterData)
-			if(point[z]>maxDist):
-				maxDist=point[z]
-			intermediate.append(point)
-		points.append(intermediate)
-	
-	points = np.array(points)
-	points = np.swapaxes(points, 0, 1)
-	print "New point cloud available"
+	cloud = __pointCloudView(data)
+	
+	if(data.height > 1):
+		points = __xyzView(cloud)
+	else:
+		# getPointCloud publishes unorganised clouds (height 1) column by column,
+		# so fold them back into a 16:9 image and swap to (height, width)
+		height = int(sqrt((data.width/float(16))*9))
+		width = int(16 * ( height/float(9) ))
+		points = __xyzView(cloud[0, :width*height].reshape((width, height)))
+		points = np.swapaxes(points, 0, 1)
+	
+	maxDist = __maxDistance(points[:, :, 2])
 	return (maxDist, points)
 
+def __pointCloudView(data):
+	dtype = __pointCloudDtype(data.fields, data.point_step, data.is_bigendian)
+	buf = np.frombuffer(data.data, dtype=np.uint8)
+	return np.ndarray((data.height, data.width), dtype=dtype, buffer=buf, strides=(data.row_step, data.point_step))
+
+def __pointCloudDtype(fields, pointStep, bigEndian):
+	byteOrder = '>' if bigEndian else '<'
+	names = []
+	formats = []
+	offsets = []
+	for field in fields:
+		if(field.datatype not in __pointFieldTypes):
+			continue
+		names.append(field.name)
+		formats.append((byteOrder + __pointFieldTypes[field.datatype], (field.count,)) if field.count > 1 else byteOrder + __pointFieldTypes[field.datatype])
+		offsets.append(field.offset)
+	return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': pointStep})
+
+def __xyzView(cloud):
+	x = cloud['x']
+	itemSize = x.dtype.itemsize
+	offsets = [cloud.dtype.fields[name][1] for name in ('x', 'y', 'z')]
+	packed = (cloud['y'].dtype == x.dtype == cloud['z'].dtype) and (offsets == [offsets[0], offsets[0] + itemSize, offsets[0] + 2*itemSize])
+	
+	if(packed):
+		# x, y and z sit next to each other in every point, so expose them as one strided view
+		return as_strided(x, shape=x.shape + (3,), strides=x.strides + (itemSize,))
+	
+	return np.dstack((x, cloud['y'], cloud['z']))
+
+def __reprojectDisparity(message, context):
+	# (maxDist, points) from the matcher's horizontal disparity, shaped like __extractPointCloudData's
+	disparity = __disparityView(message)
+	points = np.empty(disparity.shape + (3,), dtype=np.float32)
+	reprojection = __reprojection(context, disparity.shape)
+	if(reprojection is None):
+		print "No stereo calibration loaded, disparities can't be reprojected."
+		points.fill(np.nan)
+		return (0, points)
+	
+	# dispH is the offset from the left pixel to the right one, the usual disparity with its sign flipped:
+	# W = (cx - cx' - d)/Tx = (cx - cx' + dispH)/Tx and the point is (x - cx, y - cy, f)/W
+	(xOffsets, yOffsets, f, Tx, cxDifference) = reprojection
+	inverseW = np.add(disparity, np.float32(cxDifference), dtype=np.float32)
+	np.divide(np.float32(Tx), inverseW, out=inverseW)
+	inverseW[~(inverseW > 0)] = np.nan
+	np.multiply(xOffsets, inverseW, out=points[:, :, 0])
+	np.multiply(yOffsets, inverseW, out=points[:, :, 1])
+	np.multiply(np.float32(f), inverseW, out=points[:, :, 2])
+	
+	maxDist = __maxDistance(points[:, :, 2])
+	return (maxDist, points)
+
+def __disparityView(message):
+	image = message.image
+	dtype = np.dtype('>f4' if image.is_bigendian else '<f4')
+	buf = np.frombuffer(image.data, dtype=np.uint8)
+	return np.ndarray((image.height, image.width), dtype=dtype, buffer=buf, strides=(image.step, 4))
+
+def __reprojection(context, shape):
+	# Q matrix terms and pixel grid, built once per calibration version and disparity size
+	if((context is None) or (context.left is None) or (context.right is None)):
+		return None
+	(cached, reprojection) = context.derived(("reprojection", shape), lambda: __buildReprojection(context, shape))
+	return reprojection
+
+def __buildReprojection(context, shape):
+	# Terms of the Q matrix stereoRectify would give for the left and right projection matrices,
+	# scaled to disparities computed at a different size than the calibration (pyramid transport)
+	(height, width) = shape
+	P1 = context.left[4]
+	P2 = context.right[4]
+	scale = width / float(context.calibrationSize[0])
+	f = P1[0, 0] * scale
+	cx = P1[0, 2] * scale
+	cy = P1[1, 2] * scale
+	Tx = P2[0, 3] / P2[0, 0]
+	cxDifference = (P1[0, 2] - P2[0, 2]) * scale
+	
+	xOffsets = np.arange(width, dtype=np.float32) - np.float32(cx)
+	yOffsets = np.arange(height, dtype=np.float32)[:, np.newaxis] - np.float32(cy)
+	xOffsets = np.repeat(xOffsets[np.newaxis, :], height, axis=0)
+	yOffsets = np.repeat(yOffsets, width, axis=1)
+	return (xOffsets, yOffsets, f, Tx, cxDifference)
+
+def __maxDistance(depth):
+	finite = depth[np.isfinite(depth)]
+	if(finite.size == 0):
+		return 0
+	return max(0, float(finite.max()))
+
 ####################################################################################
 
-def constructDepthMapImage(hotNear, maxDist, points):
+def constructDepthMapImage(hotNear, maxDist, points, colormap=None):
 	z = 2
-	newPoints = []
-	shape = (points.shape[0], points.shape[1], 3)
-	
-	for i in range(points.shape[0]):
-		for j in range(points.shape[1]):
-			zPoint = points[i][j][z]
-			if(hotNear):
-				value = (1 - (zPoint/maxDist)) * 255
-			else:
-				value = (zPoint/maxDist) * 255
-			newPoints.append((0, int(value), 0))
-	
-	image = np.array(newPoints, dtype=np.uint8)
-	image = np.reshape(image, shape)
+	depth = points[:, :, z]
+	image = np.zeros((depth.shape[0], depth.shape[1], 3), dtype=np.uint8)
+	
+	if((maxDist is None) or (not np.isfinite(maxDist)) or (maxDist <= 0)):
+		print "New Depth Map Image"
+		return image
+	
+	# Scale straight into a float32 buffer, NaN/inf points end up black
+	value = np.multiply(depth, np.float32(255.0/maxDist), dtype=np.float32)
+	if(hotNear):
+		np.subtract(np.float32(255), value, out=value)
+	invalid = ~np.isfinite(value)
+	value[invalid] = 0
+	np.clip(value, 0, 255, out=value)
+	intensity = value.astype(np.uint8)
+	
+	if(colormap is None):
+		image[:, :, 1] = intensity	# (B, G, R)
+	else:
+		cv2.applyColorMap(intensity, colormap, image)
+		image[invalid] = 0
+	
 	print "New Depth Map Image"
 	return image
 
 def destroyPointCloud():
-	global __proc
-	__proc.send_signal(signal.SIGINT)
+	# The matcher is kept warm for the next view, the supervisor stops it when the process exits
+	supervisor.release()
+
+def getMatcherStats():
+	return supervisor.getStats()
 
 def getDataFromROS():
-	global __imageQueue, __lastPointCloud
-	if( len(__imageQueue)>0 ):
-		image = __imageQueue.pop(0)
-	else:
-		# print "helper_functions, getImageFromROS: Empty Queue"
-		image = __lastPointCloud
+	global __lastPointCloud, __lastTrace
+	item = None
+	if(__cloudBuffer is not None):
+		item = __cloudBuffer.take()
+	if(item is None):
+		return __lastPointCloud
 
-	__lastPointCloud = image
-	return image
+	(__lastPointCloud, __lastTrace) = item
+	return __lastPointCloud
+
+def startCloudArchive(path, maxQueued=8):
+	# Every cloud received from now on is also written to the archive at path, see cloud_archive
+	global __cloudArchive
+	stopCloudArchive()
+	__cloudArchive = CloudRecorder(path, maxQueued)
+
+def stopCloudArchive():
+	# Waits for the queued clouds to be written, returns the recorder's stats or None
+	global __cloudArchive
+	archive = __cloudArchive
+	__cloudArchive = None
+	if(archive is None):
+		return None
+	archive.close()
+	return archive.getStats()
+
+def getCloudArchiveStats():
+	return None if __cloudArchive is None else __cloudArchive.getStats()
+
+def showArchivedCloud(cloud):
+	# Hands (maxDist, points) from cloud_archive.RecordedClouds to the views as if it had just been
+	# received, the memory mapped points are used as they are
+	global __lastPointCloud, __lastTrace
+	__lastPointCloud = cloud
+	__lastTrace = None
+	received = time.time()
+	for listener in list(__cloudListeners):
+		listener(received)
+
+def takeCloudTrace():
+	# Latency trace of the cloud getDataFromROS last handed out, only returned once so redraws don't count again
+	global __lastTrace
+	trace = __lastTrace
+	__lastTrace = None
+	return trace
+
+def addPointCloudListener(callback):
+	# callback(timestamp) is called on the rospy subscriber thread for every new cloud
+	if(callback not in __cloudListeners):
+		__cloudListeners.append(callback)
+
+def removePointCloudListener(callback):
+	if(callback in __cloudListeners):
+		__cloudListeners.remove(callback)
+
+def getCloudBufferStats():
+	# received, taken, dropped and pending clouds, lastAge/meanAge in seconds from arrival to display
+	if(__cloudBuffer is None):
+		return None
+	return __cloudBuffer.getStats()
+
+def sendDataToROS(frames, context, trace=None, quality="full"):
+	# Hold back new requests while the GUI still has a full buffer of clouds to show.
+	# quality is sent as CamerasSync.data and picks the transport, see setTransport.
+	# Returns the CamerasSync stamp the pair went out with, None when it wasn't sent.
+	if( (__cloudBuffer is not None) and __cloudBuffer.full() ):
+		return None
+	
+	global __sentContext
+	(encoding, levels) = __transports[quality]
+	__sentContext = context
+	cameraSync = CamerasSync()
+	cameraSync.data = quality
+	cameraSync.timeStamp = rospy.Time.now()
+	messages = (
+		encodeStereoFrame(frames[0], cameraSync.timeStamp, encoding, levels),
+		__constructROSCameraInfo(context, 0, cameraSync.timeStamp, levels),
+		encodeStereoFrame(frames[1], cameraSync.timeStamp, encoding, levels),
+		__constructROSCameraInfo(context, 1, cameraSync.timeStamp, levels),
+	)
+	if(trace is not None):
+		trace.mark("messages")
+	
+	# Raw images and compressed ones go out on different topics
+	image = 0 if encoding == RAW else 2
+	__pubAcquireImages.publish(cameraSync)
+	__pubImageLeft[image].publish(messages[0])
+	__pubImageLeft[1].publish(messages[1])
+	__pubImageRight[image].publish(messages[2])
+	__pubImageRight[1].publish(messages[3])
+	if(trace is not None):
+		trace.mark("publish")
+		tracer.sent(trace, cameraSync.timeStamp.to_sec())
+	return cameraSync.timeStamp
 
-def sendDataToROS(frames, dimensions, calibration):
-	global __imageQueue, __lastPointCloud
-	(leftCalibration, rightCalibration) = calibration
-	if( len(__imageQueue)<10 ):
-		cameraSync = CamerasSync()
-		cameraSync.data = "full"
-		cameraSync.timeStamp = rospy.Time.now()
-		__pubAcquireImages.publish(cameraSync)
-		__pubImageLeft[0].publish(__constructROSImage(frames[0], cameraSync.timeStamp))
-		__pubImageLeft[1].publish(__constructROSCameraInfo(leftCalibration, dimensions, cameraSync.timeStamp))
-		__pubImageRight[0].publish(__constructROSImage(frames[1], cameraSync.timeStamp))
-		__pubImageRight[1].publish(__constructROSCameraInfo(rightCalibration, dimensions, cameraSync.timeStamp))
+def setTransport(quality, encoding=RAW, levels=0, jpegQuality=None, pngCompression=None):
+	# Transport for the "full" or "preview" requests. levels pyramid levels halve the width and
+	# height that many times, the CameraInfo sent along is scaled to match. Switching between RAW
+	# and a compressed encoding switches the other quality too, and has the supervisor move to a
+	# matcher subscribed the new way if one is already running.
+	global __jpegQuality, __pngCompression
+	if(quality not in __transports):
+		raise ValueError("Unknown quality " + str(quality) + ", expected full or preview")
+	if(encoding not in (RAW, JPEG, PNG)):
+		raise ValueError("Unknown encoding " + str(encoding))
+	__transports[quality] = (encoding, int(levels))
+	for (other, (otherEncoding, otherLevels)) in __transports.items():
+		if(imageTransport(otherEncoding) != imageTransport(encoding)):
+			__transports[other] = (encoding, otherLevels)
+	supervisor.setImageTransport(imageTransport(encoding))
+	if(jpegQuality is not None):
+		__jpegQuality = int(jpegQuality)
+	if(pngCompression is not None):
+		__pngCompression = int(pngCompression)
+
+def getTransport(quality="full"):
+	return __transports[quality]
+
+def imageTransport(encoding):
+	# The image_transport a matcher has to subscribe through to receive encoding
+	return "raw" if encoding == RAW else "compressed"
+
+def __publishDiagnostics(trace):
+	# At most once a second, mean and last time of every stage
+	global __lastDiagnostics
+	if((__pubDiagnostics is None) or (time.time() - __lastDiagnostics < 1.0)):
+		return
+	__lastDiagnostics = time.time()
+	
+	status = DiagnosticStatus()
+	status.level = DiagnosticStatus.OK
+	status.name = "bino_cam: capture to depth latency"
+	status.hardware_id = "bino_cam"
+	status.message = trace.describe()
+	for (stage, stats) in tracer.getStats().items():
+		status.values.append(KeyValue(stage + " mean ms", "%.1f" % stats["mean_ms"]))
+		status.values.append(KeyValue(stage + " last ms", "%.1f" % stats["last_ms"]))
+	
+	array = DiagnosticArray()
+	array.header.stamp = rospy.Time.now()
+	array.status = [status]
+	__pubDiagnostics.publish(array)
 
 #----------------------------------------------------------------------------------#
 
-def __constructROSImage(image, timestamp):
-	image = __bridge.cv2_to_imgmsg(image, encoding="rgb8")
-	image.header.stamp = timestamp
-	return image
+def constructROSImage(image, timestamp):
+	# Filled in straight from the frame, tostring() is the only copy. OpenCV frames are BGR.
+	image = np.ascontiguousarray(image, dtype=np.uint8)
+	message = Image()
+	message.header.stamp = timestamp
+	message.height = image.shape[0]
+	message.width = image.shape[1]
+	message.encoding = "bgr8" if image.ndim == 3 else "mono8"
+	message.is_bigendian = 0
+	message.step = image.strides[0]
+	message.data = image.tostring()
+	return message
+
+def encodeStereoFrame(image, timestamp, encoding=RAW, levels=0):
+	# The Image or CompressedImage a frame is sent to the matcher as
+	for level in range(levels):
+		image = cv2.pyrDown(image)
+	if(encoding == RAW):
+		return constructROSImage(image, timestamp)
+	
+	if(encoding == JPEG):
+		(ret, data) = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, __jpegQuality])
+	else:
+		(ret, data) = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, __pngCompression])
+	if(not ret):
+		raise ValueError("Could not encode frame as " + encoding)
+	message = CompressedImage()
+	message.header.stamp = timestamp
+	# Same format string compressed_image_transport writes
+	pixelFormat = "bgr8" if image.ndim == 3 else "mono8"
+	message.format = "%s; %s compressed %s" % (pixelFormat, encoding, pixelFormat)
+	message.data = data.tostring()
+	return message
 
-def __constructROSCameraInfo(calibration, dimensions, timestamp):
+#----------------------------------------------------------------------------------#
+
+def __constructROSCameraInfo(context, camNo, timestamp, levels=0):
+	# Built once per calibration version and pyramid level, every send only gets a new header
+	(cached, cameraInfo) = context.derived(("cameraInfo", camNo, levels), lambda: __buildROSCameraInfo(context.calibration(camNo), context.calibrationSize, levels))
+	cameraInfo = copy.copy(cameraInfo)
+	cameraInfo.header = Header()
+	cameraInfo.header.stamp = timestamp
+	return cameraInfo
+
+def __buildROSCameraInfo(calibration, dimensions, levels=0):
 	(calibrationWidth, calibrationHeight) = dimensions
 	(ret, cameraMatrix, distortion, rectification, projection) = calibration
-	h = Header()
-	h.stamp = timestamp
-	distortion = __makeTuple(__unwrapValues(distortion))
 	cameraInfo = CameraInfo()
 	cameraInfo.width = calibrationWidth
 	cameraInfo.height = calibrationHeight
-	cameraInfo.header = h
 	cameraInfo.distortion_model = "plumb_bob"
-	cameraInfo.D = distortion
-	cameraInfo.K = cameraMatrix.flatten()
-	cameraInfo.R = rectification.flatten()
-	cameraInfo.P = projection.flatten()
+	cameraInfo.D = distortion.ravel().tolist()
+	cameraInfo.K = cameraMatrix.ravel().tolist()
+	cameraInfo.R = rectification.ravel().tolist()
+	cameraInfo.P = projection.ravel().tolist()
+	
+	if(levels > 0):
+		# pyrDown rounds odd sizes up. Focal lengths, principal points and the baseline term of P
+		# all sit in the first two rows, distortion and rectification don't depend on the scale.
+		for level in range(levels):
+			cameraInfo.width = (cameraInfo.width + 1)//2
+			cameraInfo.height = (cameraInfo.height + 1)//2
+		scale = 0.5**levels
+		K = np.array(cameraInfo.K, dtype=np.float64).reshape(3, 3)
+		K[:2] *= scale
+		cameraInfo.K = K.ravel().tolist()
+		P = np.array(cameraInfo.P, dtype=np.float64).reshape(3, 4)
+		P[:2] *= scale
+		cameraInfo.P = P.ravel().tolist()
 	return cameraInfo
 
-def __unwrapValues(array):
-	shape = array.shape
-	if(shape[1]==1):
-		newArray = np.empty(shape[0], dtype=array[0].dtype)
-		for i in range(shape[0]):
-			newArray[i] = array[i][0]
-		return newArray
-	else:
-		for i in range(shape[0]):
-			array[i] = __unwrapValues(array[i])
-		return array
-
-def __makeTuple(array):
-	return tuple(array)
-
 ####################################################################################
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import numpy as np
+
+class FrameRing(object):
+	# Fixed number of preallocated frames, written in turn by one capture thread.
+	# Frames handed out are views into the ring and stay valid until their slot comes round again.
+	# The capture thread reserves the slot it decodes into under the lock, readers never see that
+	# slot, and the slot last handed to a reader is skipped so a frame in use is not overwritten.
+
+	def __init__(self, depth=4):
+		self.depth = depth
+		self.frames = None
+		self.timestamps = np.zeros(depth)
+		self.cycles = np.full(depth, -1, dtype=np.int64)
+		# Number of the frame each slot holds, -1 while empty
+		self.numbers = np.full(depth, -1, dtype=np.int64)
+		self.written = 0
+		self.writing = None
+		self.reading = None
+		self.lastRead = 0
+		self.dropped = 0
+		self.lock = threading.Lock()
+
+	def nextBuffer(self):
+		with self.lock:
+			if(self.frames is None):
+				return None
+			self.writing = self.__oldestSlot()
+			return self.frames[self.writing]
+
+	def commit(self, frame, timestamp, cycle):
+		with self.lock:
+			if((self.frames is None) or (self.frames.shape[1:] != frame.shape) or (self.frames.dtype != frame.dtype)):
+				self.frames = np.zeros((self.depth,) + frame.shape, dtype=frame.dtype)
+				self.numbers[:] = -1
+				self.writing = None
+				self.reading = None
+
+			slot = self.writing if self.writing is not None else self.__oldestSlot()
+			self.writing = None
+			# retrieve() normally decodes straight into the slot, copy only when it didn't
+			if(frame.__array_interface__['data'][0] != self.frames[slot].__array_interface__['data'][0]):
+				self.frames[slot] = frame
+			self.timestamps[slot] = timestamp
+			self.cycles[slot] = cycle
+			self.numbers[slot] = self.written
+			self.written += 1
+
+	def latest(self):
+		with self.lock:
+			available = self.__available()
+			if(len(available) == 0):
+				return None
+			return self.__take(available[-1])
+
+	def latestTimestamp(self):
+		# Without handing the frame out, so it neither counts as read nor protects the slot
+		with self.lock:
+			available = self.__available()
+			if(len(available) == 0):
+				return None
+			return self.timestamps[available[-1]]
+
+	def nearest(self, timestamp):
+		with self.lock:
+			available = self.__available()
+			if(len(available) == 0):
+				return None
+			best = np.argmin(np.abs(self.timestamps[available] - timestamp))
+			return self.__take(available[best])
+
+	def cycle(self, cycle):
+		with self.lock:
+			for slot in self.__available():
+				if(self.cycles[slot] == cycle):
+					return self.__take(slot)
+			return None
+
+	def availableCycles(self):
+		with self.lock:
+			return [self.cycles[slot] for slot in reversed(self.__available())]
+
+	def fps(self):
+		with self.lock:
+			available = self.__available()
+			if(len(available) < 2):
+				return 0.0
+			(first, last) = (available[0], available[-1])
+			elapsed = self.timestamps[last] - self.timestamps[first]
+			if(elapsed <= 0):
+				return 0.0
+			# A slot held for a reader can keep a much older frame, so frames are counted by number
+			return (self.numbers[last] - self.numbers[first]) / elapsed
+
+	def __available(self):
+		# Slots holding a frame, oldest first, without the one being written
+		slots = [slot for slot in range(self.depth) if (self.numbers[slot] >= 0) and (slot != self.writing)]
+		return sorted(slots, key=lambda slot: self.numbers[slot])
+
+	def __oldestSlot(self):
+		# Empty slots count as oldest, with a single slot there is nothing else to write into
+		slots = [slot for slot in range(self.depth) if slot != self.reading] or range(self.depth)
+		return min(slots, key=lambda slot: self.numbers[slot])
+
+	def __take(self, slot):
+		# Frames that were overwritten or skipped before anyone asked for them count as dropped
+		n = int(self.numbers[slot])
+		if(n >= self.lastRead):
+			self.dropped += max(0, n - self.lastRead)
+			self.lastRead = n + 1
+		self.reading = slot
+		return (self.frames[slot], self.timestamps[slot])
+
+class CameraStream(object):
+	# Stands in for a cv2.VideoCapture so getFrame, setCameraResolutions and release keep working
+
+	def __init__(self, capture, index):
+		self.capture = capture
+		self.index = index
+
+	def read(self):
+		frame = self.capture.getLatestFrame(self.index)
+		return (frame is not None, frame)
+
+	def isOpened(self):
+		return self.capture.cams[self.index].isOpened()
+
+	def get(self, propId):
+		return self.capture.cams[self.index].get(propId)
+
+	def set(self, propId, value):
+		with self.capture.camLocks[self.index]:
+			return self.capture.cams[self.index].set(propId, value)
+
+	def release(self):
+		self.capture.release()
+
+	def addListener(self, callback):
+		self.capture.addListener(callback)
+
+	def removeListener(self, callback):
+		self.capture.removeListener(callback)
+
+class StereoCapture(object):
+	# One grab thread per camera. The threads meet before every grab() so both sensors are
+	# triggered together, then retrieve() decodes into the camera's ring buffer.
+
+	def __init__(self, cams, depth=4, syncTimeout=0.1):
+		self.cams = cams
+		self.rings = [FrameRing(depth) for cam in cams]
+		self.camLocks = [threading.Lock() for cam in cams]
+		self.failedGrabs = [0 for cam in cams]
+		self.syncTimeout = syncTimeout
+		self.running = False
+		self.threads = []
+		self.listeners = []
+
+		self.__condition = threading.Condition()
+		self.__waiting = 0
+		self.__cycle = 0
+		self.__participants = 0
+
+	def __getitem__(self, index):
+		return CameraStream(self, index)
+
+	def __len__(self):
+		return len(self.cams)
+
+	def start(self):
+		if(self.running):
+			return
+		self.running = True
+		opened = [i for i in range(len(self.cams)) if (self.cams[i] is not None) and self.cams[i].isOpened()]
+		self.__participants = len(opened)
+		self.threads = [threading.Thread(target=self.__grabLoop, args=(i,)) for i in opened]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def stop(self):
+		self.running = False
+		with self.__condition:
+			self.__condition.notify_all()
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+	def release(self):
+		self.stop()
+		for cam in self.cams:
+			if(cam is not None):
+				cam.release()
+
+	def addListener(self, callback):
+		# callback(timestamp) is called on the grab threads after every new frame
+		if(callback not in self.listeners):
+			self.listeners.append(callback)
+
+	def removeListener(self, callback):
+		if(callback in self.listeners):
+			self.listeners.remove(callback)
+
+	def getLatestFrame(self, index):
+		latest = self.rings[index].latest()
+		if(latest is None):
+			return None
+		return latest[0]
+
+	def getLatestPair(self):
+		# Newest grab cycle both cameras delivered, otherwise whatever each has last
+		left, right = self.rings[0], self.rings[1]
+		rightCycles = set(right.availableCycles())
+		for cycle in left.availableCycles():
+			if(cycle in rightCycles):
+				return (left.cycle(cycle)[0], right.cycle(cycle)[0])
+		return (self.getLatestFrame(0), self.getLatestFrame(1))
+
+	def getPairNearest(self, timestamp):
+		pair = [ring.nearest(timestamp) for ring in self.rings]
+		return tuple(None if p is None else p[0] for p in pair)
+
+	def getStats(self):
+		latest = [ring.latestTimestamp() for ring in self.rings]
+		skew = None
+		if(all(l is not None for l in latest)):
+			skew = abs(latest[0] - latest[1])
+		return {
+			"fps": tuple(ring.fps() for ring in self.rings),
+			"dropped": tuple(ring.dropped + failed for (ring, failed) in zip(self.rings, self.failedGrabs)),
+			"skew": skew,
+		}
+
+	def __synchronize(self):
+		with self.__condition:
+			cycle = self.__cycle
+			self.__waiting += 1
+			if(self.__waiting >= self.__participants):
+				self.__waiting = 0
+				self.__cycle += 1
+				self.__condition.notify_all()
+				return cycle
+
+			# Don't let a stalled camera freeze the other one
+			self.__condition.wait(self.syncTimeout)
+			if(self.__cycle == cycle):
+				self.__waiting -= 1
+			return cycle
+
+	def __grabLoop(self, index):
+		cam = self.cams[index]
+		ring = self.rings[index]
+
+		while(self.running):
+			cycle = self.__synchronize()
+			with self.camLocks[index]:
+				grabbed = cam.grab()
+				timestamp = time.time()
+				if(grabbed):
+					buffer = ring.nextBuffer()
+					ret, frame = cam.retrieve(buffer) if buffer is not None else cam.retrieve()
+
+			if((not grabbed) or (not ret) or (frame is None)):
+				self.failedGrabs[index] += 1
+				time.sleep(self.syncTimeout)
+				continue
+
+			ring.commit(frame, timestamp, cycle)
+			for listener in list(self.listeners):
+				listener(timestamp)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# Voxel grid downsampling of point clouds. Points are binned into cubes of voxelSize and every
+# occupied cube is replaced by the centroid of its points, so the shape of surfaces survives
+# where randomly dropping points would thin them out unevenly.
+
+def voxelKeys(points, voxelSize, origin=None):
+	# (keys, origin): one int64 per point, equal for points in the same voxel
+	if(origin is None):
+		origin = points.min(axis=0)
+	# Every offset from the origin is positive, so truncating is the same as flooring
+	cells = ((points - origin) * np.float32(1.0/voxelSize)).astype(np.int64)
+	dims = cells.max(axis=0) + 1
+	return (cells[:, 0] + dims[0]*(cells[:, 1] + dims[1]*cells[:, 2]), origin)
+
+def mapKeys(points, voxelSize):
+	# One int64 per point that stays the same for a voxel from one cloud to the next, 21 bits an axis
+	cells = np.floor(points * (1.0/voxelSize)).astype(np.int64) + (1 << 20)
+	cells = np.clip(cells, 0, (1 << 21) - 1)
+	return cells[:, 0] | (cells[:, 1] << 21) | (cells[:, 2] << 42)
+
+def voxelDownsample(points, voxelSize):
+	# (centroids, counts) of the occupied voxels, centroids as float32
+	if((points.shape[0] == 0) or (voxelSize <= 0)):
+		return (points.astype(np.float32), np.ones(points.shape[0], dtype=np.int64))
+
+	(keys, origin) = voxelKeys(points, voxelSize)
+	(unique, inverse) = np.unique(keys, return_inverse=True)
+	counts = np.bincount(inverse)
+	centroids = np.empty((unique.shape[0], 3), dtype=np.float32)
+	for axis in range(3):
+		centroids[:, axis] = np.bincount(inverse, weights=points[:, axis]) / counts
+	return (centroids, counts)
+
+def downsampleToBudget(points, budget):
+	# (points, voxelSize) with at most budget points. Clouds are surfaces, so the number of occupied
+	# voxels falls roughly with the square of their size: the first guess spreads budget over the
+	# bounding box, a second pass grows the voxels by the square root of how many too many there
+	# were, and if that is still over, whole voxels are dropped at random to make up the rest.
+	if(points.shape[0] <= budget):
+		return (points, 0.0)
+
+	voxelSize = surfaceSpacing(points, budget)
+	for attempt in range(2):
+		(downsampled, counts) = voxelDownsample(points, voxelSize)
+		if(downsampled.shape[0] <= budget):
+			return (downsampled, voxelSize)
+		if(attempt == 0):
+			voxelSize *= 1.1*np.sqrt(downsampled.shape[0] / float(budget))
+
+	keep = np.random.choice(downsampled.shape[0], budget, replace=False)
+	return (downsampled[keep], voxelSize)
+
+def surfaceSpacing(points, count=None):
+	# Distance between count points spread evenly over the two largest extents of the bounding box
+	extents = np.sort(points.max(axis=0) - points.min(axis=0))
+	return float(np.sqrt(max(extents[1]*extents[2], 1e-12) / (count or points.shape[0])))
+
+class PointLevels(object):
+	# The same cloud at several resolutions, level 0 the finest with at most maxPoints. Every
+	# further level doubles the voxel size of the one before and is built from it, so it has
+	# about a quarter of its points and building all of them costs little more than the first.
+
+	def __init__(self, maxPoints=1000000, count=4):
+		self.maxPoints = int(maxPoints)
+		self.count = count
+		self.levels = []
+		self.gridSize = 0
+
+	def __len__(self):
+		return len(self.levels)
+
+	def build(self, points, voxelSize=0):
+		# voxelSize of points already on a grid, such as a VoxelMap's, saves working out their spacing
+		self.buildFinest(points, voxelSize)
+		self.buildCoarser()
+
+	def buildFinest(self, points, voxelSize=0):
+		# Only level 0, so it can be shown before buildCoarser() adds the others
+		if(points.shape[0] == 0):
+			self.levels = [(points, 0.0)]*self.count
+			return
+		(points, downsampledSize) = downsampleToBudget(points, self.maxPoints)
+		self.levels = [(points, downsampledSize)]
+		self.gridSize = voxelSize
+
+	def buildCoarser(self):
+		# The levels only ever grow and the list is swapped in whole, another thread reading them
+		# sees either level 0 alone or all of them
+		if(len(self.levels) != 1):
+			return
+		(points, downsampledSize) = self.levels[0]
+		voxelSize = max(downsampledSize, self.gridSize) or surfaceSpacing(points)
+		levels = list(self.levels)
+		for level in range(1, self.count):
+			voxelSize *= 2
+			(points, counts) = voxelDownsample(points, voxelSize)
+			levels.append((points, voxelSize))
+		self.levels = levels
+
+	def points(self, level):
+		return self.levels[level][0]
+
+	def voxelSize(self, level):
+		return self.levels[level][1]
+
+	def select(self, footprint):
+		# Coarsest level whose voxels are no bigger than footprint, the size a pixel covers in the
+		# scene. Anything finer than that can't be seen at the current distance.
+		chosen = 0
+		for (level, (points, voxelSize)) in enumerate(self.levels):
+			if(voxelSize <= footprint):
+				chosen = level
+		return chosen
+
+class VoxelMap(object):
+	# Clouds from successive captures fused into one sparse map of voxelSize cubes, each holding the
+	# running average of the points that fell in it, weighted by at most maxWeight points so it can
+	# still follow a scene that changes. The keys are kept sorted next to the slot holding their voxel
+	# and slots 0..len-1 are always the live ones, so the slot arrays can be drawn as they are and
+	# only the slots integrate() reports need pushing again.
+	# At most maxVoxels are kept: voxels not seen for maxAge captures or further than maxDistance are
+	# dropped, and when the map is full the ones seen longest ago make room, the furthest first.
+	# Without a voxelSize it is picked from the first cloud so a quarter of maxVoxels would cover it.
+	# Clouds are fused in the camera's frame, the rig has to stay put between captures.
+
+	def __init__(self, voxelSize=None, maxVoxels=1000000, maxAge=None, maxDistance=None, maxWeight=50):
+		self.voxelSize = voxelSize
+		self.capacity = int(maxVoxels)
+		self.maxAge = maxAge
+		self.maxDistance = maxDistance
+		self.maxWeight = maxWeight
+		self.means = np.zeros((self.capacity, 3), dtype=np.float32)
+		self.weights = np.zeros(self.capacity, dtype=np.float32)
+		self.lastSeen = np.zeros(self.capacity, dtype=np.int64)
+		self.slotKeys = np.zeros(self.capacity, dtype=np.int64)
+		# keys and slots are views into one row of these, changes are merged into the other row and
+		# the two swapped, so neither is ever reallocated
+		self.sortedKeys = np.zeros((2, self.capacity), dtype=np.int64)
+		self.sortedSlots = np.zeros((2, self.capacity), dtype=np.int64)
+		self.positions = np.arange(self.capacity, dtype=np.int64)
+		self.clear()
+
+	def __len__(self):
+		return self.keys.shape[0]
+
+	def clear(self):
+		self.__useRow(0, 0)
+		self.frame = 0
+		self.evicted = {"stale": 0, "far": 0, "full": 0}
+		self.lastChanged = 0
+
+	def points(self):
+		# The live voxels' averages, a view that integrate() updates in place
+		return self.means[:len(self)]
+
+	def integrate(self, points):
+		# Slots whose contents changed: voxels updated or added, and those moved into freed slots
+		points = np.asarray(points)[..., :3].reshape(-1, 3)
+		points = points[np.isfinite(points).all(axis=1)]
+		if(self.maxDistance is not None):
+			points = points[(points*points).sum(axis=1) <= self.maxDistance**2]
+		self.frame += 1
+		if(points.shape[0] == 0):
+			changed = self.__evict(0)
+			self.lastChanged = changed.shape[0]
+			return changed
+		if(self.voxelSize is None):
+			self.voxelSize = surfaceSpacing(points, max(1, self.capacity//4))
+
+		# Average of this capture in every voxel it touches
+		(frameKeys, inverse) = np.unique(mapKeys(points, self.voxelSize), return_inverse=True)
+		counts = np.bincount(inverse).astype(np.float32)
+		frameMeans = np.empty((frameKeys.shape[0], 3), dtype=np.float32)
+		for axis in range(3):
+			frameMeans[:, axis] = np.bincount(inverse, weights=points[:, axis]) / counts
+
+		found = np.zeros(frameKeys.shape[0], dtype=bool)
+		if(len(self) > 0):
+			position = np.minimum(np.searchsorted(self.keys, frameKeys), len(self) - 1)
+			found = self.keys[position] == frameKeys
+
+		# Voxels already in the map move towards this capture by its share of their weight
+		updated = self.slots[position[found]] if found.any() else np.empty(0, dtype=np.int64)
+		weights = self.weights[updated]
+		share = counts[found] / (weights + counts[found])
+		self.means[updated] += (frameMeans[found] - self.means[updated]) * share[:, np.newaxis]
+		self.weights[updated] = np.minimum(weights + counts[found], self.maxWeight)
+		self.lastSeen[updated] = self.frame
+
+		# New voxels, the best supported ones if they don't all fit
+		(newKeys, newMeans, newCounts) = (frameKeys[~found], frameMeans[~found], counts[~found])
+		if(newKeys.shape[0] > self.capacity):
+			keep = np.sort(np.argsort(-newCounts, kind="mergesort")[:self.capacity])
+			(newKeys, newMeans, newCounts) = (newKeys[keep], newMeans[keep], newCounts[keep])
+		moved = self.__evict(newKeys.shape[0])
+
+		start = len(self)
+		added = np.arange(start, start + newKeys.shape[0])
+		self.means[added] = newMeans
+		self.weights[added] = np.minimum(newCounts, self.maxWeight)
+		self.lastSeen[added] = self.frame
+		self.slotKeys[added] = newKeys
+		self.__insert(newKeys, added)
+
+		changed = np.unique(np.concatenate((updated, moved, added)))
+		changed = changed[changed < len(self)]
+		self.lastChanged = changed.shape[0]
+		return changed
+
+	def getStats(self):
+		return {"voxels": len(self), "capacity": self.capacity, "frames": self.frame, "voxelSize": self.voxelSize,
+			"changed": self.lastChanged, "evicted": dict(self.evicted)}
+
+	#----------------------------------------------------------------------------------#
+
+	def __useRow(self, row, size):
+		self.row = row
+		self.keys = self.sortedKeys[row, :size]
+		self.slots = self.sortedSlots[row, :size]
+
+	def __insert(self, newKeys, newSlots):
+		# Merges sorted keys that aren't in the map yet into the other row: every key moves up by the
+		# number of new keys below it, every new key up by the number of old keys below it
+		(size, count) = (len(self), newKeys.shape[0])
+		if(count == 0):
+			return
+		(keys, slots) = (self.sortedKeys[1 - self.row], self.sortedSlots[1 - self.row])
+		moved = np.searchsorted(newKeys, self.keys)
+		moved += self.positions[:size]
+		keys[moved] = self.keys
+		slots[moved] = self.slots
+		placed = np.searchsorted(self.keys, newKeys)
+		placed += self.positions[:count]
+		keys[placed] = newKeys
+		slots[placed] = newSlots
+		self.__useRow(1 - self.row, size + count)
+
+	def __evict(self, incoming):
+		# Drops stale and far voxels and, if incoming still doesn't fit, the ones seen longest ago.
+		# Returns the slots survivors were moved into.
+		size = len(self)
+		drop = np.zeros(size, dtype=bool)
+		if(self.maxAge is not None):
+			stale = self.lastSeen[:size] < self.frame - self.maxAge
+			self.evicted["stale"] += int(np.count_nonzero(stale))
+			drop |= stale
+		if(self.maxDistance is not None):
+			far = (self.means[:size]**2).sum(axis=1) > self.maxDistance**2
+			self.evicted["far"] += int(np.count_nonzero(far & ~drop))
+			drop |= far
+
+		excess = size - np.count_nonzero(drop) + incoming - self.capacity
+		if(excess > 0):
+			candidates = np.flatnonzero(~drop)
+			distance = (self.means[candidates]**2).sum(axis=1)
+			order = np.lexsort((-distance, self.lastSeen[candidates]))
+			drop[candidates[order[:excess]]] = True
+			self.evicted["full"] += int(excess)
+		return self.__remove(np.flatnonzero(drop))
+
+	def __remove(self, removed):
+		# Live slots stay packed at the front, survivors from the tail fill the holes left in it
+		if(removed.shape[0] == 0):
+			return removed
+		size = len(self)
+		newSize = size - removed.shape[0]
+
+		keep = np.ones(size, dtype=bool)
+		keep[np.searchsorted(self.keys, self.slotKeys[removed])] = False
+		other = 1 - self.row
+		np.compress(keep, self.keys, out=self.sortedKeys[other, :newSize])
+		np.compress(keep, self.slots, out=self.sortedSlots[other, :newSize])
+		self.__useRow(other, newSize)
+
+		holes = removed[removed < newSize]
+		tailRemoved = np.zeros(size - newSize, dtype=bool)
+		tailRemoved[removed[removed >= newSize] - newSize] = True
+		movers = newSize + np.flatnonzero(~tailRemoved)
+		for array in (self.means, self.weights, self.lastSeen, self.slotKeys):
+			array[holes] = array[movers]
+		self.slots[np.searchsorted(self.keys, self.slotKeys[holes])] = holes
+		return holes
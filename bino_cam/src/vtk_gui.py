@@ -2,11 +2,17 @@
 
 import wx
 import vtk
-import random
+import math
+import numpy as np
+from collections import deque
 from vtk.wx.wxVTKRenderWindowInteractor import wxVTKRenderWindowInteractor
+from cloud_polydata import CloudPolyData
 
 class VtkPointCloud(wx.Panel):
-	def __init__(self, parent, pointSize=3, zMin=-10.0, zMax=10.0, maxNumPoints=1e6):
+	# Shows a CloudPolyData, rendering again whenever its worker has built new levels. While the camera moves the level of detail is stepped coarser until a
+	# frame takes no more than interactiveFrameTime, refineDelay ms after it stops the finest level
+	# that can still be told apart at the camera's distance is shown.
+	def __init__(self, parent, pointSize=3, zMin=-10.0, zMax=10.0, maxNumPoints=1e6, interactiveFrameTime=1/30.0, refineDelay=200):
 		wx.Panel.__init__(self, parent)
 		 
 		#to interact with the scene using the mouse use an instance of vtkRenderWindowInteractor. 
@@ -20,11 +26,16 @@ class VtkPointCloud(wx.Panel):
 		
 		wx.YieldIfNeeded()
 		
-		self.maxNumPoints = maxNumPoints
-		self.vtkPolyData = vtk.vtkPolyData()
-		self.clearPoints()
+		self.interactiveFrameTime = interactiveFrameTime
+		self.refineDelay = refineDelay
+		self.interacting = False
+		self.interactiveLevel = 1
+		self.refineTimer = None
+		self.frameTimes = deque(maxlen=30)
+		self.listeners = []
+		self.data = CloudPolyData(maxNumPoints, self.__ChooseLevel, lambda: wx.CallAfter(self.__OnBuilt))
 		mapper = vtk.vtkPolyDataMapper()
-		mapper.SetInput(self.vtkPolyData)
+		mapper.SetInput(self.data.vtkPolyData)
 		mapper.SetColorModeToDefault()
 		mapper.SetScalarRange(zMin, zMax)
 		mapper.SetScalarVisibility(1)
@@ -37,8 +48,12 @@ class VtkPointCloud(wx.Panel):
 		renderer.AddActor(self.vtkActor)
 		renderer.SetBackground(0.0, 0.0, 0.0)
 		renderer.ResetCamera()
+		renderer.AddObserver("EndEvent", self.__OnRendered)
+		self.renderer = renderer
 
 		self.widget.GetRenderWindow().AddRenderer(renderer)
+		self.widget.AddObserver("StartInteractionEvent", self.__OnStartInteraction)
+		self.widget.AddObserver("EndInteractionEvent", self.__OnEndInteraction)
 		
 		axes = vtk.vtkAxesActor()
 		self.marker = vtk.vtkOrientationMarkerWidget()
@@ -52,48 +67,104 @@ class VtkPointCloud(wx.Panel):
 		cam = renderer.GetActiveCamera()
 
 		cam.Azimuth(180)
+	
+	maxNumPoints = property(lambda self: self.data.maxNumPoints)
+	fusion = property(lambda self: self.data.fusion)
  
 	def addPoint(self, point):
-		if self.vtkPoints.GetNumberOfPoints() < self.maxNumPoints:
-			pointId = self.vtkPoints.InsertNextPoint(point[:])
-			self.vtkDepth.InsertNextValue(point[2])
-			self.vtkCells.InsertNextCell(1)
-			self.vtkCells.InsertCellPoint(pointId)
-		else:
-			r = random.randint(0, self.maxNumPoints)
-			self.vtkPoints.SetPoint(r, point[:])
-		
-		self.vtkCells.Modified()
-		self.vtkPoints.Modified()
-		self.vtkDepth.Modified()
+		self.addPoints(np.array([point[:3]]))
 	
 	def addPoints(self, points):
-		for i in range(points.shape[0]):
-			for j in range(points.shape[1]):
-				point = points[i][j]
-				point = (point[0], point[1], point[2])
-				if self.vtkPoints.GetNumberOfPoints() < self.maxNumPoints:
-					pointId = self.vtkPoints.InsertNextPoint(point[:])
-					self.vtkDepth.InsertNextValue(point[2])
-					self.vtkCells.InsertNextCell(1)
-					self.vtkCells.InsertCellPoint(pointId)
-				else:
-					r = random.randint(0, self.maxNumPoints)
-					self.vtkPoints.SetPoint(r, point[:])
-		
-		self.vtkCells.Modified()
-		self.vtkPoints.Modified()
-		self.vtkDepth.Modified()
- 
+		self.data.addPoints(points)
+	
+	def setFusion(self, voxelMap):
+		self.data.setFusion(voxelMap)
+	
+	def showLevel(self, level):
+		self.data.showLevel(level)
+	
 	def clearPoints(self):
-		self.vtkPoints = vtk.vtkPoints()
-		self.vtkCells = vtk.vtkCellArray()
-		self.vtkDepth = vtk.vtkDoubleArray()
-		self.vtkDepth.SetName('DepthArray')
-		self.vtkPolyData.SetPoints(self.vtkPoints)
-		self.vtkPolyData.SetVerts(self.vtkCells)
-		self.vtkPolyData.GetPointData().SetScalars(self.vtkDepth)
-		self.vtkPolyData.GetPointData().SetActiveScalars('DepthArray')
+		self.data.clearPoints()
+	
+	def close(self):
+		# Stops the worker building the levels, before the panel is destroyed
+		self.data.close()
+	
+	def getStats(self):
+		# CloudPolyData's stats, whether the camera is moving and recent render times
+		frameTimes = list(self.frameTimes)
+		stats = self.data.getStats()
+		stats.update({
+			"interacting": self.interacting,
+			"meanFrameMs": 1000*sum(frameTimes)/len(frameTimes) if frameTimes else None,
+			"lastFrameMs": 1000*frameTimes[-1] if frameTimes else None,
+		})
+		return stats
+	
+	def addListener(self, callback):
+		# callback(stats) after every render, on the wx thread
+		if(callback not in self.listeners):
+			self.listeners.append(callback)
+	
+	def removeListener(self, callback):
+		if(callback in self.listeners):
+			self.listeners.remove(callback)
+	
+	def __OnBuilt(self):
+		# The panel may have been destroyed while the event was queued
+		if(not self):
+			return
+		if(self.data.update()):
+			self.widget.Render()
+	
+	def __ChooseLevel(self):
+		return self.interactiveLevel if self.interacting else self.__RefinedLevel()
+	
+	def __OnStartInteraction(self, obj, event):
+		self.interacting = True
+		if(self.refineTimer is not None):
+			self.refineTimer.Stop()
+			self.refineTimer = None
+		self.data.showLevel(max(self.interactiveLevel, self.data.level or 0))
+	
+	def __OnEndInteraction(self, obj, event):
+		self.interacting = False
+		self.refineTimer = wx.CallLater(self.refineDelay, self.__Refine)
+	
+	def __Refine(self):
+		self.refineTimer = None
+		if(self.interacting):
+			return
+		level = self.__RefinedLevel()
+		if(level != self.data.level):
+			self.data.showLevel(level)
+			self.widget.Render()
+	
+	def __RefinedLevel(self):
+		# Scene size one pixel covers at the camera's distance from what it looks at
+		camera = self.renderer.GetActiveCamera() if hasattr(self, "renderer") else None
+		height = self.widget.GetRenderWindow().GetSize()[1] if hasattr(self, "widget") else 0
+		if((camera is None) or (height <= 0)):
+			return 0
+		footprint = 2*camera.GetDistance()*math.tan(math.radians(camera.GetViewAngle())/2) / height
+		return self.data.levelFor(footprint)
+	
+	def __OnRendered(self, obj, event):
+		frameTime = self.renderer.GetLastRenderTimeInSeconds()
+		self.frameTimes.append(frameTime)
+		
+		if(self.interacting):
+			# Step coarser while frames are slow, back finer when there is plenty of headroom
+			if((frameTime > self.interactiveFrameTime) and (self.interactiveLevel < len(self.data.levels) - 1)):
+				self.interactiveLevel += 1
+				self.data.showLevel(self.interactiveLevel)
+			elif((frameTime < self.interactiveFrameTime/4) and (self.interactiveLevel > 0)):
+				self.interactiveLevel -= 1
+				self.data.showLevel(self.interactiveLevel)
+		
+		stats = self.getStats()
+		for listener in list(self.listeners):
+			listener(stats)
  
 class TestFrame(wx.Frame):
 	def __init__(self,parent,title):
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "src"))
+from calibration_store import loadCalibration, saveCompiledCalibration, clearCalibrationCache
+
+# The calibrations bundled with the repo, loaded through calibration_store. For the oST files the
+# expected values are what the old shlex parser in camera_functions.openSavedCalibration read from
+# them, calL.xml is checked against its own opencv_storage data.
+
+calibrationData = os.path.join(here, "..", "Calibration Data")
+calibrations = os.path.join(here, "..", "..", "ug_stereomatcher", "calibrations")
+
+camera0 = (1920, 1080,
+	[[1827.404149, 0, 1110.285425], [0, 1811.526621, 506.778744], [0, 0, 1]],
+	[0.000064, -0.022242, -0.007017, 0.015032, 0],
+	np.eye(3),
+	[[1811.667725, 0, 1135.408633, 0], [0, 1828.729980, 500.553914, 0], [0, 0, 1, 0]])
+
+camera1 = (1920, 1080,
+	[[1821.057706, 0, 929.720445], [0, 1821.747824, 579.758654], [0, 0, 1]],
+	[-0.023417, -0.035429, -0.003621, -0.003692, 0],
+	np.eye(3),
+	[[1801.301282, 0, 922.462085, 0], [0, 1814.219043, 577.415974, 0], [0, 0, 1, 0]])
+
+stereoLeft = (1920, 1080,
+	[[1590.212391, 0, 1423.423923], [0, 1596.347485, 574.664808], [0, 0, 1]],
+	[0.054215, -0.074951, 0.003137, -0.009301, 0],
+	[[0.583610, -0.046289, 0.810714], [0.035583, 0.998873, 0.031417], [-0.811254, 0.010513, 0.584599]],
+	[[5782.910421, 0, -1382.263832, 0], [0, 5782.910421, 533, 0], [0, 0, 1, 0]])
+
+stereoRight = (1920, 1080,
+	[[2261.579267, 0, 671.941507], [0, 2341.525819, 556.734058], [0, 0, 1]],
+	[0.049582, -0.582902, -0.009423, 0.088124, 0],
+	[[0.771868, -0.017167, 0.635551], [0.025097, 0.999679, -0.003477], [-0.635287, 0.018634, 0.772051]],
+	[[5782.910421, 0, -1382.263832, 7837.982864], [0, 5782.910421, 533, 0], [0, 0, 1, 0]])
+
+calL = (3264, 4928,
+	[[7.3230899280915291e+03, 0, 2.4836974544986647e+03], [0, 7.3035803715514758e+03, 1.7170248033347561e+03], [0, 0, 1]],
+	[-5.5816774802151095e-02, 5.2386423851846409e-01, 0, 0, 0],
+	np.eye(3),
+	[[7.3230899280915291e+03, 0, 2.4836974544986647e+03, 0], [0, 7.3035803715514758e+03, 1.7170248033347561e+03, 0], [0, 0, 1, 0]])
+
+class CalibrationStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		clearCalibrationCache()
+
+	def checkCamera(self, camera, expected):
+		(width, height, cameraMatrix, distortion, rectification, projection) = camera
+		self.assertEqual((width, height), expected[:2])
+		self.assertTrue(isinstance(width, int) and isinstance(height, int))
+		for (array, values, shape) in zip(camera[2:], expected[2:], [(3, 3), (5, 1), (3, 3), (3, 4)]):
+			self.assertEqual(array.shape, shape)
+			self.assertEqual(array.dtype, np.float64)
+			self.assertTrue(np.array_equal(array, np.array(values, dtype=np.float64).reshape(shape)))
+
+	def testSingleCameraOstFiles(self):
+		for (folder, expected) in [("Camera 0 Calibration data", camera0), ("Camera 1 Calibration data", camera1)]:
+			cameras = loadCalibration(os.path.join(calibrationData, folder, "ost.txt"))
+			self.assertEqual(len(cameras), 1)
+			self.checkCamera(cameras[0], expected)
+
+	def testStereoOstFile(self):
+		cameras = loadCalibration(os.path.join(calibrationData, "Stereo Calibration Data", "ost.txt"))
+		self.assertEqual(len(cameras), 2)
+		self.checkCamera(cameras[0], stereoLeft)
+		self.checkCamera(cameras[1], stereoRight)
+
+	def testOpenCVXml(self):
+		cameras = loadCalibration(os.path.join(calibrations, "calL.xml"))
+		self.assertEqual(len(cameras), 1)
+		self.checkCamera(cameras[0], calL)
+
+	def testLoadsOncePerVersion(self):
+		path = os.path.join(calibrationData, "Camera 0 Calibration data", "ost.txt")
+		self.assertTrue(loadCalibration(path) is loadCalibration(path))
+
+	def testCompiledRoundTrip(self):
+		folder = tempfile.mkdtemp()
+		try:
+			for (source, expected) in [(os.path.join("Camera 0 Calibration data", "ost.txt"), [camera0]),
+					(os.path.join("Stereo Calibration Data", "ost.txt"), [stereoLeft, stereoRight])]:
+				path = os.path.join(folder, "%d.npz" % len(expected))
+				saveCompiledCalibration(path, loadCalibration(os.path.join(calibrationData, source)))
+				cameras = loadCalibration(path)
+				self.assertEqual(len(cameras), len(expected))
+				for (camera, values) in zip(cameras, expected):
+					self.checkCamera(camera, values)
+		finally:
+			shutil.rmtree(folder)
+
+if __name__ == '__main__':
+	unittest.main()
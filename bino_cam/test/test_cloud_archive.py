@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from cloud_archive import CloudRecorder, RecordedClouds
+from frame_sources import indexFile
+
+# Clouds written through CloudRecorder and read back through RecordedClouds, the index included.
+
+def organisedCloud(generator, height, width, offset):
+	points = (offset + generator.uniform(-1, 1, (height, width, 3))).astype(np.float32)
+	points[generator.uniform(size=(height, width)) < 0.2] = np.nan
+	return points
+
+def sameCloud(points, expected):
+	# Equal, with the points without a depth in the same places
+	missing = np.isnan(expected)
+	return (points.shape == expected.shape) and np.array_equal(np.isnan(points), missing) and np.array_equal(points[~missing], expected[~missing])
+
+def expectedBounds(points):
+	points = points.reshape(-1, 3)
+	points = points[np.isfinite(points).all(axis=1)]
+	return np.array((points.min(axis=0), points.max(axis=0)), dtype=np.float32)
+
+class CloudArchiveTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, "clouds.raw")
+		self.generator = np.random.RandomState(3)
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def waitForIndex(self, count, timeout=5.0):
+		# The writer thread has no flush, the index says how far it got
+		deadline = time.time() + timeout
+		while(time.time() < deadline):
+			if(os.path.exists(indexFile(self.path)) and (len(RecordedClouds(self.path)) == count)):
+				return
+			time.sleep(0.01)
+		self.fail("%d clouds never made it to the index" % count)
+
+	def testRoundTrip(self):
+		clouds = [
+			(2.5, organisedCloud(self.generator, 48, 64, 0)),
+			# Only the first three channels are kept and they are stored as float32
+			(3.0, np.dstack((organisedCloud(self.generator, 30, 40, 5), np.ones((30, 40)))).astype(np.float64)),
+			# An unorganised cloud is kept as a single row
+			(1.5, organisedCloud(self.generator, 1, 500, -2)[0]),
+		]
+		recorder = CloudRecorder(self.path)
+		self.assertTrue(recorder.write(clouds[0], timestamp=100.0, version=1))
+		self.assertTrue(recorder.write(clouds[1], timestamp=100.5, version=2))
+		self.assertTrue(recorder.write("encoded", timestamp=101.25, decode=lambda cloud: clouds[2]))
+		recorder.close()
+		self.assertEqual(recorder.getStats()["written"], 3)
+		self.assertEqual(recorder.getStats()["dropped"], 0)
+
+		recorded = RecordedClouds(self.path)
+		self.assertEqual(len(recorded), 3)
+		self.assertTrue(np.array_equal(recorded.timestamps, [100.0, 100.5, 101.25]))
+		self.assertTrue(np.array_equal(recorded.versions, [1, 2, -1]))
+		self.assertTrue(np.array_equal(recorded.maxDists, [2.5, 3.0, 1.5]))
+		self.assertTrue(np.array_equal(recorded.shapes, [(48, 64, 3), (30, 40, 3), (1, 500, 3)]))
+		self.assertEqual(recorded.offsets[0], 0)
+		self.assertEqual(os.path.getsize(self.path), recorded.offsets[-1] + 4*np.prod(recorded.shapes[-1]))
+
+		for (n, (maxDist, points)) in enumerate(clouds):
+			expected = np.float32(points[..., :3]).reshape(recorded.shapes[n])
+			(recordedMaxDist, recordedPoints) = recorded.cloud(n)
+			self.assertEqual(recordedMaxDist, maxDist)
+			self.assertEqual(recordedPoints.dtype, np.float32)
+			self.assertTrue(sameCloud(recordedPoints, expected))
+			self.assertTrue(np.array_equal(recorded.bounds[n], expectedBounds(expected)))
+
+	def testNearest(self):
+		recorder = CloudRecorder(self.path)
+		for timestamp in [10.0, 11.0, 13.0]:
+			recorder.write((1.0, organisedCloud(self.generator, 4, 4, 0)), timestamp=timestamp)
+		recorder.close()
+
+		recorded = RecordedClouds(self.path)
+		for (timestamp, n) in [(0.0, 0), (10.0, 0), (10.4, 0), (10.6, 1), (11.9, 1), (12.1, 2), (13.0, 2), (99.0, 2)]:
+			self.assertEqual(recorded.nearest(timestamp), n)
+
+	def testIndexIsReadableWhileWriting(self):
+		recorder = CloudRecorder(self.path)
+		first = organisedCloud(self.generator, 20, 30, 0)
+		recorder.write((1.0, first), timestamp=1.0)
+		self.waitForIndex(1)
+
+		# A cloud whose decoding fails is cut off again and never reaches the index
+		def fail(cloud):
+			raise ValueError("corrupt")
+		recorder.write(None, timestamp=2.0, decode=fail)
+		recorder.write((1.0, organisedCloud(self.generator, 20, 30, 1)), timestamp=3.0)
+		self.waitForIndex(2)
+		self.assertFalse(os.path.exists(indexFile(self.path) + ".tmp.npz"))
+
+		# Half a cloud after the last indexed one, as a writer that died would leave it
+		recorder.close()
+		f = open(self.path, 'ab')
+		f.write(b"\0"*1000)
+		f.close()
+		recorded = RecordedClouds(self.path)
+		self.assertTrue(np.array_equal(recorded.timestamps, [1.0, 3.0]))
+		self.assertTrue(sameCloud(recorded.cloud(0)[1], first))
+		self.assertFalse(os.path.exists(indexFile(self.path) + ".tmp.npz"))
+
+if __name__ == '__main__':
+	unittest.main()
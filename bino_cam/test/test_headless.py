@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import types
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from cloud_buffer import CloudBuffer
+
+# headless.depthMaps against a stand-in for ros_functions: the matcher is a CloudBuffer the test
+# fills itself, so a cloud can be made to arrive exactly when it would be too late.
+
+class FakeMatcher(object):
+
+	def __init__(self):
+		self.buffer = CloudBuffer(1)
+		self.listeners = []
+		self.sent = []
+		self.answer = True
+		self.last = None
+
+	def module(self):
+		module = types.ModuleType("ros_functions")
+		module.initializePointCloud = lambda source=None: None
+		module.sendDataToROS = self.sendDataToROS
+		module.getDataFromROS = self.getDataFromROS
+		module.takeCloudTrace = lambda: None
+		module.constructDepthMapImage = lambda hotNear, maxDist, points, colormap=None: points
+		module.addPointCloudListener = self.listeners.append
+		module.removePointCloudListener = self.listeners.remove
+		return module
+
+	def sendDataToROS(self, frames, context, trace=None, quality="full"):
+		if(self.buffer.full()):
+			return None
+		self.sent.append(frames)
+		if(self.answer):
+			self.deliver(frames)
+		return len(self.sent)
+
+	def deliver(self, frames):
+		self.buffer.put(((0, frames), None))
+		for listener in list(self.listeners):
+			listener(0)
+
+	def getDataFromROS(self):
+		item = self.buffer.take()
+		if(item is not None):
+			self.last = item[0]
+		return self.last
+
+class DepthMapsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.matcher = FakeMatcher()
+		self.saved = sys.modules.get("ros_functions")
+		sys.modules["ros_functions"] = self.matcher.module()
+		import headless
+		self.headless = headless
+
+	def tearDown(self):
+		if(self.saved is None):
+			del sys.modules["ros_functions"]
+		else:
+			sys.modules["ros_functions"] = self.saved
+
+	def testLateCloudDoesNotStallThePipeline(self):
+		matcher = self.matcher
+		pairs = [("pair", n) for n in range(4)]
+
+		def stream():
+			# The first pair's cloud only turns up after depthMaps gave up waiting for it
+			matcher.answer = False
+			yield (0, pairs[0])
+			matcher.deliver(pairs[0])
+			matcher.answer = True
+			for pair in pairs[1:]:
+				yield (0, pair)
+
+		images = [image for (timestamp, image) in self.headless.depthMaps(stream(), timeout=0.05)]
+		self.assertEqual(images, pairs[1:])
+		self.assertEqual(matcher.sent, pairs)
+		self.assertEqual(len(matcher.buffer), 0)
+
+class CompositeTest(unittest.TestCase):
+
+	def setUp(self):
+		import headless
+		self.headless = headless
+
+	def testImagesOutliveTheNextFrame(self):
+		pairs = [(0, (np.full((4, 6, 3), n, dtype=np.uint8), np.full((4, 6, 3), 10 + n, dtype=np.uint8))) for n in range(3)]
+		images = [image for (timestamp, image) in self.headless.composite(iter(pairs), "side-by-side")]
+		for (n, image) in enumerate(images):
+			self.assertEqual(image.shape, (4, 12, 3))
+			self.assertTrue((image[:, :6] == n).all() and (image[:, 6:] == 10 + n).all())
+
+		# With reuse every image is the same canvas, only the last frame is left in it
+		images = [image for (timestamp, image) in self.headless.composite(iter(pairs), "side-by-side", reuse=True)]
+		self.assertTrue(images[0] is images[-1])
+		self.assertTrue((images[0][:, :6] == 2).all())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from voxel_grid import VoxelMap, mapKeys
+
+# VoxelMap's bookkeeping after mixed captures and evictions: the sorted keys, the slot each of them
+# points at and the live slots packed at the front have to stay in step, whatever was dropped.
+
+def capture(generator, count, centre, spread):
+	return (centre + generator.uniform(-spread, spread, (count, 3))).astype(np.float32)
+
+class VoxelMapTest(unittest.TestCase):
+
+	def setUp(self):
+		self.generator = np.random.RandomState(7)
+
+	def checkInvariants(self, voxels):
+		size = len(voxels)
+		self.assertLessEqual(size, voxels.capacity)
+		self.assertEqual(voxels.slots.shape[0], size)
+		self.assertTrue((np.diff(voxels.keys) > 0).all())
+		self.assertTrue(np.array_equal(voxels.slotKeys[voxels.slots], voxels.keys))
+		self.assertTrue(np.array_equal(np.sort(voxels.slots), np.arange(size)))
+		self.assertTrue((voxels.weights[:size] > 0).all())
+
+	def checkChanged(self, voxels, before, changed):
+		# Every live slot whose key or mean differs from the last capture has to be reported
+		size = len(voxels)
+		self.assertTrue((changed < size).all())
+		(keys, means) = before
+		common = min(size, keys.shape[0])
+		differs = (voxels.slotKeys[:common] != keys[:common]) | (voxels.means[:common] != means[:common]).any(axis=1)
+		differs = np.concatenate((np.flatnonzero(differs), np.arange(common, size)))
+		self.assertEqual(np.setdiff1d(differs, changed).shape[0], 0)
+
+	def integrate(self, voxels, points):
+		before = (voxels.slotKeys[:len(voxels)].copy(), voxels.means[:len(voxels)].copy())
+		changed = voxels.integrate(points)
+		self.checkInvariants(voxels)
+		self.checkChanged(voxels, before, changed)
+		return changed
+
+	def testNewVoxelsMergeIntoSortedKeys(self):
+		voxels = VoxelMap(voxelSize=0.1, maxVoxels=5000)
+		for n in range(6):
+			self.integrate(voxels, capture(self.generator, 2000, n*0.3, 0.5))
+		self.assertEqual(voxels.getStats()["evicted"], {"stale": 0, "far": 0, "full": 0})
+		points = capture(self.generator, 500, 0, 0.5)
+		voxels.integrate(points)
+		self.assertEqual(np.setdiff1d(mapKeys(points, 0.1), voxels.keys).shape[0], 0)
+
+	def testEvictionByStaleFarAndFull(self):
+		voxels = VoxelMap(voxelSize=0.1, maxVoxels=3000, maxAge=2, maxDistance=3.0)
+		centres = [0, 1.5, -1.5, 0.5, 2.0, -0.5, 1.0, 0, -2.0, 1.5]
+		for (n, centre) in enumerate(centres):
+			if(n == 6):
+				# Moving the limit in leaves voxels past it, they go on the next capture
+				voxels.maxDistance = 2.0
+			self.integrate(voxels, capture(self.generator, 3000, centre, 0.8))
+			self.assertLessEqual(voxels.frame - voxels.lastSeen[:len(voxels)].min(), voxels.maxAge)
+		evicted = voxels.getStats()["evicted"]
+		self.assertGreater(evicted["stale"], 0)
+		self.assertGreater(evicted["far"], 0)
+		self.assertGreater(evicted["full"], 0)
+		self.assertTrue(((voxels.points()**2).sum(axis=1) <= 2.0**2).all())
+
+	def testEmptyCapturesOnlyEvict(self):
+		voxels = VoxelMap(voxelSize=0.1, maxVoxels=2000, maxAge=1)
+		self.integrate(voxels, capture(self.generator, 1000, 0, 0.5))
+		self.integrate(voxels, np.empty((0, 3), dtype=np.float32))
+		self.assertGreater(len(voxels), 0)
+		self.integrate(voxels, np.full((10, 3), np.nan, dtype=np.float32))
+		self.assertEqual(len(voxels), 0)
+		self.assertEqual(voxels.slots.shape[0], 0)
+		self.integrate(voxels, capture(self.generator, 1000, 0, 0.5))
+
+	def testCaptureLargerThanTheMap(self):
+		voxels = VoxelMap(voxelSize=0.05, maxVoxels=500)
+		for n in range(4):
+			self.integrate(voxels, capture(self.generator, 5000, n*0.2, 1.0))
+			self.assertEqual(len(voxels), voxels.capacity)
+		voxels.clear()
+		self.checkInvariants(voxels)
+		self.integrate(voxels, capture(self.generator, 300, 0, 1.0))
+
+if __name__ == '__main__':
+	unittest.main()
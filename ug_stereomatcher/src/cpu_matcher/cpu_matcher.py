@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""
+CPU stand-in for the GPU matcher.
+
+Subscribes to the same input_left_image/input_right_image pair and
+publishes output_disparityH/V/C and the get_disparities_srv service
+the same way UG_matcher_gpu does, so getPointCloud and bino_cam run
+unchanged on machines without CUDA. Pairs are matched with
+StereoSGBM, split into horizontal bands that a thread pool matches
+in parallel. SGBM releases the GIL while it computes, so threads
+scale like processes without copying the bands between them, and
+the pool can be created after rospy has started its own threads.
+
+SGBM only searches along rows. When camera_info_left/right carry a
+stereo rectification the pair is rectified first and the disparities
+are mapped back to the original pixels, which gives the horizontal
+and vertical offsets getPointCloud expects. Without it the pair is
+assumed to be row aligned already and the vertical disparity is 0.
+
+Like UG_matcher_gpu, the pair is subscribed to through the transport
+named by the image_transport parameter in the node's namespace: raw
+sensor_msgs/Image by default, or compressed to take the JPEG or PNG
+sensor_msgs/CompressedImage on input_*_image/compressed.
+
+Run with --benchmark to print frames per second per resolution
+without a ROS master.
+"""
+
+import roslib; roslib.load_manifest('ug_stereomatcher')
+import rospy
+import message_filters
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import time
+import numpy as np
+import cv2
+from collections import deque
+from sensor_msgs.msg import Image, CompressedImage, CameraInfo
+from stereo_msgs.msg import DisparityImage
+from ug_stereomatcher.srv import GetDisparitiesGPU, GetDisparitiesGPUResponse
+
+# Same names as UG_GPU_matcher.cpp
+CAM_SUB_LEFT = "input_left_image"
+CAM_SUB_RIGHT = "input_right_image"
+CAM_PUB_HOR = "output_disparityH"
+CAM_PUB_VER = "output_disparityV"
+CAM_PUB_CONF = "output_disparityC"
+DISPARITIES_SRV = "get_disparities_srv"
+
+RESOLUTIONS = {"480p": (854, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+
+# ********* BAND MATCHING (runs in the pool threads) *********
+
+# A StereoSGBM can't compute two bands at once, every pool thread gets its own
+worker = threading.local()
+
+def createMatcher(numDisparities, blockSize):
+    channels = 1
+    P1 = 8 * channels * blockSize * blockSize
+    P2 = 32 * channels * blockSize * blockSize
+    if hasattr(cv2, "StereoSGBM_create"):
+        return cv2.StereoSGBM_create(minDisparity=0, numDisparities=numDisparities, blockSize=blockSize,
+                                     P1=P1, P2=P2, uniquenessRatio=10, speckleWindowSize=100, speckleRange=2)
+    # OpenCV 2.4
+    return cv2.StereoSGBM(minDisparity=0, numDisparities=numDisparities, SADWindowSize=blockSize,
+                          P1=P1, P2=P2, uniquenessRatio=10, speckleWindowSize=100, speckleRange=2)
+
+def initWorker(numDisparities, blockSize):
+    worker.matcher = createMatcher(numDisparities, blockSize)
+
+def matchBand(task):
+    # (left band, right band, rows to keep) -> float32 disparity of the kept rows, NaN where unmatched
+    (left, right, keep) = task
+    disparity = worker.matcher.compute(left, right).astype(np.float32)
+    disparity = disparity[keep[0]:keep[1]]
+    invalid = disparity < 0
+    disparity *= 1.0 / 16
+    disparity[invalid] = np.nan
+    return disparity
+
+# ********* MATCHER *********
+
+class BandMatcher(object):
+    """Matches a grey pair band by band across a thread pool."""
+
+    def __init__(self, threads=None, bands=None, numDisparities=128, blockSize=5):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.bands = bands or self.threads
+        # Rows shared with the neighbouring band so SGBM's vertical paths don't leave seams
+        self.overlap = max(16, blockSize)
+        self.numDisparities = numDisparities
+        self.pool = ThreadPool(self.threads, initWorker, (numDisparities, blockSize))
+
+    def match(self, left, right):
+        height = left.shape[0]
+        edges = np.linspace(0, height, self.bands + 1).astype(int)
+        tasks = []
+        for (top, bottom) in zip(edges[:-1], edges[1:]):
+            start = max(0, top - self.overlap)
+            end = min(height, bottom + self.overlap)
+            tasks.append((left[start:end], right[start:end], (top - start, bottom - start)))
+        return np.vstack(self.pool.map(matchBand, tasks))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class Rectification(object):
+    """Maps for one stereo calibration: rectifying the pair and taking disparities back to the raw pixels."""
+
+    def __init__(self, infoL, infoR, size):
+        (width, height) = size
+        (self.K1, self.D1, self.R1, self.P1) = cameraMatrices(infoL)
+        (self.K2, self.D2, self.R2, self.P2) = cameraMatrices(infoR)
+        self.mapsL = cv2.initUndistortRectifyMap(self.K1, self.D1, self.R1, self.P1[:, :3], size, cv2.CV_32FC1)
+        self.mapsR = cv2.initUndistortRectifyMap(self.K2, self.D2, self.R2, self.P2[:, :3], size, cv2.CV_32FC1)
+
+        # Where every raw left pixel lands in the rectified left image
+        (xx, yy) = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        self.pixels = np.dstack((xx, yy))
+        rectified = cv2.undistortPoints(self.pixels.reshape(-1, 1, 2), self.K1, self.D1, R=self.R1, P=self.P1[:, :3])
+        self.rectified = rectified.reshape(height, width, 2)
+
+    def rectify(self, left, right):
+        return (cv2.remap(left, self.mapsL[0], self.mapsL[1], cv2.INTER_LINEAR),
+                cv2.remap(right, self.mapsR[0], self.mapsR[1], cv2.INTER_LINEAR))
+
+    def rawDisparities(self, disparity):
+        # Rectified left disparity -> (horizontal, vertical) offsets from each raw left pixel to the raw right one
+        (height, width) = self.pixels.shape[:2]
+        (u, v) = (self.rectified[:, :, 0], self.rectified[:, :, 1])
+        d = cv2.remap(disparity, u, v, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=np.nan)
+
+        # Ray through the matching right rectified pixel, back into the raw right camera
+        rays = np.dstack(((u - d - self.P2[0, 2]) / self.P2[0, 0], (v - self.P2[1, 2]) / self.P2[1, 1], np.ones_like(u)))
+        rays = rays.reshape(-1, 3).dot(self.R2)  # R2 transposed
+        (right, jacobian) = cv2.projectPoints(rays.reshape(-1, 1, 3), np.zeros(3), np.zeros(3), self.K2, self.D2)
+        right = right.reshape(height, width, 2)
+        return (right[:, :, 0] - self.pixels[:, :, 0], right[:, :, 1] - self.pixels[:, :, 1])
+
+def cameraMatrices(info):
+    return (np.array(info.K, dtype=np.float64).reshape(3, 3), np.array(info.D, dtype=np.float64),
+            np.array(info.R, dtype=np.float64).reshape(3, 3), np.array(info.P, dtype=np.float64).reshape(3, 4))
+
+def toGrey(msg):
+    if isinstance(msg, CompressedImage):
+        return cv2.imdecode(np.frombuffer(msg.data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    channels = 1 if msg.encoding in ("mono8", "8UC1") else 3
+    image = np.frombuffer(msg.data, dtype=np.uint8)
+    image = np.lib.stride_tricks.as_strided(image, (msg.height, msg.width * channels), (msg.step, 1)).reshape(msg.height, msg.width, channels)
+    if channels == 1:
+        return np.ascontiguousarray(image[:, :, 0])
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY if msg.encoding == "rgb8" else cv2.COLOR_BGR2GRAY)
+
+def toDisparityImage(disparity, header, numDisparities):
+    disparity = np.ascontiguousarray(disparity, dtype=np.float32)
+    msg = DisparityImage()
+    msg.header = header
+    msg.image.header = header
+    msg.image.height = disparity.shape[0]
+    msg.image.width = disparity.shape[1]
+    msg.image.encoding = "32FC1"
+    msg.image.is_bigendian = 0
+    msg.image.step = disparity.strides[0]
+    msg.image.data = disparity.tostring()
+    msg.min_disparity = -numDisparities
+    msg.max_disparity = numDisparities
+    msg.delta_d = 1.0 / 16
+    return msg
+
+# ********* NODE *********
+
+class CPUMatcher(object):
+
+    def __init__(self, threads=None, bands=None, numDisparities=128, blockSize=5, reportEvery=10.0):
+        self.matcher = BandMatcher(threads, bands, numDisparities, blockSize)
+        self.lock = threading.Lock()
+        self.infos = [None, None]
+        self.rectification = None
+        self.rectificationKey = None
+        # Seconds per match for every resolution seen
+        self.timings = {}
+        self.reportEvery = reportEvery
+        self.lastReport = time.time()
+
+    def disparities(self, imL, imR):
+        # (horizontal, vertical, confidence) for a pair of sensor_msgs/Image or CompressedImage
+        left = toGrey(imL)
+        right = toGrey(imR)
+        start = time.time()
+        with self.lock:
+            rectification = self.getRectification((left.shape[1], left.shape[0]))
+            if rectification is not None:
+                (left, right) = rectification.rectify(left, right)
+            disparity = self.matcher.match(left, right)
+        if rectification is not None:
+            (dispH, dispV) = rectification.rawDisparities(disparity)
+        else:
+            dispH = -disparity
+            dispV = np.where(np.isfinite(disparity), 0, np.nan).astype(np.float32)
+        confidence = np.isfinite(dispH).astype(np.float32)
+        self.record((left.shape[1], left.shape[0]), time.time() - start)
+        return (dispH, dispV, confidence)
+
+    def getRectification(self, size):
+        (infoL, infoR) = self.infos
+        if infoL is None or infoR is None or not any(infoL.P) or not any(infoR.P):
+            return None
+        key = (size, tuple(infoL.K), tuple(infoL.D), tuple(infoL.R), tuple(infoL.P), tuple(infoR.K), tuple(infoR.D), tuple(infoR.R), tuple(infoR.P))
+        if key != self.rectificationKey:
+            self.rectification = Rectification(infoL, infoR, size)
+            self.rectificationKey = key
+            rospy.loginfo("Rectification maps built for %dx%d", size[0], size[1])
+        return self.rectification
+
+    def record(self, size, seconds):
+        timings = self.timings.setdefault(size, deque(maxlen=50))
+        timings.append(seconds)
+        if time.time() - self.lastReport >= self.reportEvery:
+            self.lastReport = time.time()
+            for line in self.report():
+                rospy.loginfo(line)
+
+    def report(self):
+        return ["%dx%d: %.2f fps (%.0f ms a pair over %d threads)" % (size[0], size[1], len(t) / sum(t), 1000 * sum(t) / len(t), self.matcher.threads)
+                for (size, t) in sorted(self.timings.items()) if len(t) > 0]
+
+    def pairCB(self, imL, imR):
+        rospy.loginfo("Received images!")
+        (dispH, dispV, dispC) = self.disparities(imL, imR)
+        self.pubH.publish(toDisparityImage(dispH, imL.header, self.matcher.numDisparities))
+        self.pubV.publish(toDisparityImage(dispV, imR.header, self.matcher.numDisparities))
+        self.pubC.publish(toDisparityImage(dispC, imL.header, self.matcher.numDisparities))
+        rospy.loginfo("Disparities published!")
+
+    def disparitySrv(self, req):
+        # Only the non foveated disparities, the foveated stacks are left empty
+        (dispH, dispV, dispC) = self.disparities(req.imL, req.imR)
+        rsp = GetDisparitiesGPUResponse()
+        rsp.dispH = toDisparityImage(dispH, req.imL.header, self.matcher.numDisparities)
+        rsp.dispV = toDisparityImage(dispV, req.imR.header, self.matcher.numDisparities)
+        rsp.dispC = toDisparityImage(dispC, req.imL.header, self.matcher.numDisparities)
+        rospy.loginfo("Disparities computed!")
+        return rsp
+
+    def infoCB(self, camNo):
+        def store(info):
+            self.infos[camNo] = info
+        return store
+
+    def start(self):
+        self.pubH = rospy.Publisher(CAM_PUB_HOR, DisparityImage, queue_size=1)
+        self.pubV = rospy.Publisher(CAM_PUB_VER, DisparityImage, queue_size=1)
+        self.pubC = rospy.Publisher(CAM_PUB_CONF, DisparityImage, queue_size=1)
+        rospy.Subscriber("camera_info_left", CameraInfo, self.infoCB(0))
+        rospy.Subscriber("camera_info_right", CameraInfo, self.infoCB(1))
+        # Same parameter image_transport::TransportHints reads in UG_matcher_gpu
+        transport = rospy.get_param("image_transport", "raw")
+        if transport == "compressed":
+            subL = message_filters.Subscriber(CAM_SUB_LEFT + "/compressed", CompressedImage)
+            subR = message_filters.Subscriber(CAM_SUB_RIGHT + "/compressed", CompressedImage)
+        elif transport == "raw":
+            subL = message_filters.Subscriber(CAM_SUB_LEFT, Image)
+            subR = message_filters.Subscriber(CAM_SUB_RIGHT, Image)
+        else:
+            raise ValueError("Unsupported image_transport " + transport + ", expected raw or compressed")
+        self.sync = message_filters.ApproximateTimeSynchronizer([subL, subR], 1, 0.1)
+        self.sync.registerCallback(self.pairCB)
+        self.srv = rospy.Service(DISPARITIES_SRV, GetDisparitiesGPU, self.disparitySrv)
+        rospy.loginfo("CPU matcher node initialised with %d threads, %s transport!", self.matcher.threads, transport)
+
+def benchmark(matcher, resolutions, frames):
+    # Synthetic textured pairs shifted by a known disparity, one line per resolution
+    for name in resolutions:
+        (width, height) = RESOLUTIONS[name]
+        left = cv2.GaussianBlur(np.random.randint(0, 256, (height, width)).astype(np.uint8), (3, 3), 0)
+        right = np.roll(left, -width // 40, axis=1)
+        matcher.match(left, right)
+        start = time.time()
+        for i in range(frames):
+            matcher.match(left, right)
+        seconds = time.time() - start
+        print "%-6s %dx%d: %.2f fps, %.0f ms a pair, %d threads" % (name, width, height, frames / seconds, 1000 * seconds / frames, matcher.threads)
+
+# ********* MAIN *********
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CPU stand-in for UG_matcher_gpu")
+    parser.add_argument("--threads", "--processes", dest="threads", type=int, default=None, help="pool size, defaults to the number of cores")
+    parser.add_argument("--bands", type=int, default=None, help="bands a pair is split into, defaults to the pool size")
+    parser.add_argument("--num-disparities", type=int, default=128, help="disparity search range, a multiple of 16")
+    parser.add_argument("--block-size", type=int, default=5)
+    parser.add_argument("--benchmark", nargs="*", default=None, choices=sorted(RESOLUTIONS.keys()), help="print frames per second for these resolutions and exit")
+    parser.add_argument("--frames", type=int, default=10, help="pairs matched per resolution by --benchmark")
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    if args.benchmark is not None:
+        matcher = BandMatcher(args.threads, args.bands, args.num_disparities, args.block_size)
+        try:
+            benchmark(matcher, args.benchmark or ["480p", "720p", "1080p"], args.frames)
+        finally:
+            matcher.close()
+    else:
+        rospy.init_node('UG_matcher_cpu')
+        node = CPUMatcher(args.threads, args.bands, args.num_disparities, args.block_size)
+        node.start()
+        rospy.spin()
+        node.matcher.close()
@@ -85,8 +85,10 @@ public:
 
     GPU_matcher(int argc, char **argv):
         it_(nh_), /* nh_ is a node handler*/
-        imL_sub_(it_, CAM_SUB_LEFT, 1), /* 'imL_sub' of type  ImageSubscriber and 'CAM_SUB_LEFT' is the msg*/
-        imR_sub_(it_, CAM_SUB_RIGHT, 1),  /* of type  ImageSubscriber*/
+        /* The pair comes through the transport named by the image_transport parameter in the node's namespace,
+           raw by default, compressed for the JPEG/PNG pairs bino_cam sends on input_*_image/compressed */
+        imL_sub_(it_, CAM_SUB_LEFT, 1, image_transport::TransportHints("raw", ros::TransportHints(), nh_)), /* 'imL_sub' of type  ImageSubscriber and 'CAM_SUB_LEFT' is the msg*/
+        imR_sub_(it_, CAM_SUB_RIGHT, 1, image_transport::TransportHints("raw", ros::TransportHints(), nh_)),  /* of type  ImageSubscriber*/
         sync(syncPolicy(1), imL_sub_, imR_sub_)//, sub_)
     {
 
@@ -3,9 +3,12 @@
 """
 Temporal node to avoid the memory leak on the GPU matcher.
 
-This opens, close and opens again an instance of the ROS node of
-the GPU matcher. As soon as the memory leak bug is corrected, This
-node will not longer be used.
+This runs an instance of the ROS node of the GPU matcher and, when
+~restart_every is set, closes and opens it again after that many
+results. ~restart_every defaults to 0, never: bino_cam's matcher
+supervisor switches to a warm spare instead. Set it when the matcher
+runs without bino_cam. As soon as the memory leak bug is corrected,
+This node will not longer be used.
 
 Authors: Gerardo Aragon-Camarasa. 2014
 """
@@ -24,37 +27,35 @@ import whereIam
 from ug_stereomatcher.msg import foveatedstack
 
 def messagesCBF(msL,msR):
-    global proc
-
     rospy.loginfo("Received foveated horizontal and vetical disparities")
-
-    # Close matcher after 5 seconds
-    time.sleep(5)
-    proc.send_signal(signal.SIGINT)
-    rospy.loginfo("GPU matcher closed...")
-    # Start again macther after 5 seconds of being closed
-    #time.sleep(5)
-    proc = subprocess.Popen(['rosrun', 'ug_stereomatcher', 'UG_matcher_gpu'])
-    rospy.loginfo("GPU matcher openned...")
+    resultReceived()
 
 def messagesCB(msL,msR):
-    global proc
-
     rospy.loginfo("Received horizontal and vetical disparities")
+    resultReceived()
+
+def resultReceived():
+    global proc, results
+
+    # The disparities are already published, so the matcher can be restarted straight away.
+    # With ~restart_every at 0 it is left running, bino_cam's matcher supervisor then recycles
+    # it in the background only once it has actually grown.
+    results += 1
+    restartEvery = rospy.get_param("~restart_every", 0)
+    if restartEvery <= 0 or results % restartEvery != 0:
+        return
 
-    # Close matcher after 5 seconds
-    time.sleep(5)
     proc.send_signal(signal.SIGINT)
+    proc.wait()
     rospy.loginfo("GPU matcher closed...")
-    # Start again macther after 5 seconds of being closed
-    #time.sleep(5)
     proc = subprocess.Popen(['rosrun', 'ug_stereomatcher', 'UG_matcher_gpu'])
     rospy.loginfo("GPU matcher openned...")
 
 # ********* MAIN *********
 if __name__ == '__main__':
-    global proc
+    global proc, results
 
+    results = 0
     rospy.init_node('RHmatcher_hack', anonymous=True)
     ### subscribers
     subDV = message_filters.Subscriber('output_disparityV', DisparityImage)
@@ -101,8 +101,9 @@ public:
 
     CdynamicCalibration() :
         it_(nh_),
-        imL_sub_(it_, CAM_SUB_LEFT, 5),
-        imR_sub_(it_, CAM_SUB_RIGHT, 5), // TODO: include PTU and tf broadcaster
+        // Same image_transport parameter as the matcher, so both take the pair the way bino_cam sends it
+        imL_sub_(it_, CAM_SUB_LEFT, 5, image_transport::TransportHints("raw", ros::TransportHints(), nh_)),
+        imR_sub_(it_, CAM_SUB_RIGHT, 5, image_transport::TransportHints("raw", ros::TransportHints(), nh_)), // TODO: include PTU and tf broadcaster
         infoL_sub_(nh_, CAMERA_INFO_L, 5),
         infoR_sub_(nh_, CAMERA_INFO_R, 5),
         dispH_sub_(nh_, DISPARITY_H, 5),